@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Scale benchmark of the agents with and without relay, using network namespaces of the local machine as nodes.
+
+Each namespace is connected to a bridge and runs an agent listening on TCP. The same scripts are then run on all the
+nodes, with a connection per script (like the pool engine without relay), a connection per node (like the async
+engine), and a single connection to the agent of the first node relaying for all the others. The wall time, the CPU
+time and the number of file descriptors of the controller are reported for each mode.
+
+It must run as root : python3 integration/relay_benchmark.py --nodes 100 --scripts 2
+"""
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from npf import npf
+from npf.executor.agentclient import AgentClient, PeerClient
+
+BRIDGE = 'npfrelaybr'
+PORT = 7432
+
+
+def ns(i):
+    return 'npfrelay%d' % i
+
+
+def addr(i):
+    return '10.78.%d.%d' % (i // 250, i % 250 + 2)
+
+
+def sh(cmd):
+    subprocess.run(cmd, shell=True, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def setup(n, token):
+    sh('ip link add %s type bridge && ip addr add 10.78.255.1/16 dev %s && ip link set %s up' % (BRIDGE, BRIDGE, BRIDGE))
+    agents = []
+    for i in range(n):
+        sh('ip netns add %s' % ns(i))
+        sh('ip link add veth%s type veth peer name eth0 netns %s' % (ns(i), ns(i)))
+        sh('ip link set veth%s master %s up' % (ns(i), BRIDGE))
+        sh('ip -n %s addr add %s/16 dev eth0 && ip -n %s link set eth0 up && ip -n %s link set lo up'
+           % (ns(i), addr(i), ns(i), ns(i)))
+        agents.append(subprocess.Popen(['ip', 'netns', 'exec', ns(i), sys.executable, AgentClient.source(), '--listen',
+                                        str(PORT), addr(i)], stdin=subprocess.PIPE, stdout=subprocess.PIPE))
+        agents[-1].stdin.write((token + '\n').encode())
+        agents[-1].stdin.close()
+    for agent in agents:
+        agent.stdout.readline()
+    return agents
+
+
+def cleanup(n, agents):
+    for agent in agents:
+        agent.kill()
+        agent.wait()
+    for i in range(n):
+        subprocess.run(['ip', 'netns', 'del', ns(i)], stderr=subprocess.DEVNULL)
+    subprocess.run(['ip', 'link', 'del', BRIDGE], stderr=subprocess.DEVNULL)
+
+
+def connect(i):
+    return AgentClient.connect(None, addr(i), 22, 'tcp:%d' % PORT, None)
+
+
+def run(clients, cmd, agent_filter):
+    """Run cmd once per client, all at once, and wait for all of them"""
+    remaining = [len(clients)]
+    done = threading.Event()
+    results = []
+    lock = threading.Lock()
+
+    for client in clients:
+        def handler(msg):
+            if 'out' in msg and msg['out'].startswith('RESULT'):
+                results.append(msg['out'])
+            if 'exit' in msg or 'error' in msg:
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        done.set()
+        client.request('exec', handler, cmd=cmd, filter=AgentClient.FILTER if agent_filter else None)
+    done.wait()
+    return results
+
+
+def measure(name, n, scripts, make_clients, cmd, agent_filter):
+    fds = len(os.listdir('/proc/self/fd'))
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    clients, opened = make_clients()
+    results = run(clients, cmd, agent_filter)
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    fds = len(os.listdir('/proc/self/fd')) - fds
+    for client in opened:
+        client.close()
+        client.thread.join()
+    assert len(results) == n * scripts, "%s : got %d results out of %d" % (name, len(results), n * scripts)
+    print("%-12s %6d connections %8.3fs wall %8.3fs CPU %6d fds" % (
+        name, len(opened), elapsed, after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime, fds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the NPF agents relay on network namespaces')
+    parser.add_argument('--nodes', type=int, default=50)
+    parser.add_argument('--scripts', type=int, default=4, help='Scripts per node, like NPF_MULTI')
+    parser.add_argument('--lines', type=int, default=200, help='Lines printed by each script')
+    parser.add_argument('--agent-filter', action='store_true', default=False, dest='agent_filter')
+    args = parser.parse_args()
+
+    if os.geteuid() != 0 or not shutil.which('ip'):
+        print("Warning: this benchmark must run as root with iproute2 to create network namespaces")
+        return 0
+
+    npf_parser = argparse.ArgumentParser()
+    npf.add_building_options(npf_parser)
+    npf.add_testing_options(npf_parser)
+    npf.parse_nodes(npf_parser.parse_args(args=[]))
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    n = args.nodes
+    cmd = 'for i in $(seq %d) ; do echo noise $i ; done ; echo RESULT 1' % args.lines
+    cleanup(n, [])
+    agents = setup(n, AgentClient.token())
+    try:
+        def per_script():
+            clients = [connect(i) for i in range(n) for s in range(args.scripts)]
+            return clients, clients
+
+        def per_node():
+            opened = [connect(i) for i in range(n)]
+            return [c for c in opened for s in range(args.scripts)], opened
+
+        def relay():
+            opened = [connect(0)]
+            peers = [opened[0]] + [PeerClient(opened[0], SimpleNamespace(user=None, addr=addr(i), port=22,
+                                                                         agent='tcp:%d' % PORT))
+                                   for i in range(1, n)]
+            return [c for c in peers for s in range(args.scripts)], opened
+
+        measure('per script', n, args.scripts, per_script, cmd, args.agent_filter)
+        measure('per node', n, args.scripts, per_node, cmd, args.agent_filter)
+        measure('relay', n, args.scripts, relay, cmd, args.agent_filter)
+    finally:
+        cleanup(n, agents)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
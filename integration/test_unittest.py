@@ -122,3 +122,887 @@ def test_local_executor():
     assert stdout == ""
     assert stderr == ""
     assert ret == 1
+
+def test_search_variable():
+    from npf.variable import VariableFactory, ListVariable
+    from npf.section import SearchVariableExpander
+
+    rate = VariableFactory.build("RATE", "SEARCH(1, 100, DROPPED == 0, 5)")
+    vlist = OrderedDict([("X", ListVariable("X", ["1", "2"])), ("RATE", rate)])
+    expander = SearchVariableExpander(vlist, set(), rate)
+    probes = {}
+    for v in expander:
+        probes.setdefault(v["X"], []).append(v["RATE"])
+        expander.tell(v, {"DROPPED": [10 if v["RATE"] > 37 * v["X"] else 0]})
+
+    for x, values in probes.items():
+        assert len(values) <= rate.expected_probes()
+        assert values[0] == 100
+        passing = max([r for r in values if r <= 37 * x])
+        assert 37 * x - passing <= 5
+    assert set(rate.makeValues()) == set(probes[1] + probes[2])
+
+    latency = VariableFactory.build("RATE", "SEARCH(1, 100, LATENCY < 2*baseline)")
+    search = latency.search()
+    assert next(search) == 1
+    assert search.send(({"RATE": 1}, {"LATENCY": [10]})) == 100
+
+
+def test_bayesian_expander():
+    from npf.variable import VariableFactory
+    from npf.expander import BayesianVariableExpander
+
+    vlist = OrderedDict([("A", VariableFactory.build("A", "[0-20]")),
+                         ("B", VariableFactory.build("B", "[0-20]")),
+                         ("MODE", VariableFactory.build("MODE", "{slow,fast}"))])
+    options = types.SimpleNamespace(expand_budget=25, expand_objective="PERF", expand_seed=0, quiet=True)
+    expander = BayesianVariableExpander(vlist, set(), options)
+    assert len(expander) == 25
+    best = 0
+    seen = set()
+    for v in expander:
+        seen.add((v["A"], v["B"], v["MODE"]))
+        perf = (1000 - (v["A"] - 13) ** 2 - (v["B"] - 5) ** 2) * (2 if v["MODE"] == "fast" else 1)
+        best = max(best, perf)
+        expander.tell(v, {"PERF": [perf]})
+    assert len(seen) == 25
+    assert best >= 1950
+
+
+def test_active_expander():
+    from npf.variable import VariableFactory
+    from npf.expander import ActiveVariableExpander
+
+    vlist = OrderedDict([("A", VariableFactory.build("A", "[1-10]")),
+                         ("B", VariableFactory.build("B", "[1-10]")),
+                         ("MODE", VariableFactory.build("MODE", "{slow,fast}"))])
+    options = types.SimpleNamespace(expand_budget=None, expand_batch=10, expand_tolerance=0.05, expand_seed=0, quiet=True)
+    expander = ActiveVariableExpander(vlist, set(), options)
+    perf = lambda v: (100 * v["A"] + v["B"]) * (2 if v["MODE"] == "fast" else 1)
+    n = 0
+    for v in expander:
+        n += 1
+        expander.tell(v, {"PERF": [perf(v)]})
+    assert n < len(expander) == 200
+    surface = list(expander.surface())
+    assert len(surface) == 200
+    assert sum(1 for v, r, measured in surface if measured) == n
+    for v, r, measured in surface:
+        if measured:
+            assert r["PERF"] == perf(v)
+        else:
+            assert abs(r["PERF"] - perf(v)) / perf(v) < 0.5
+
+
+def test_design():
+    from npf import design
+    from npf.variable import VariableFactory
+    from npf.expander import DesignVariableExpander
+
+    for method in design.GENERATORS.keys():
+        m = design.generate(method, 16, 5, seed=3)
+        assert m.shape == (16, 5)
+        assert ((m >= 0) & (m <= 1)).all()
+        assert (m == design.generate(method, 16, 5, seed=3)).all()
+
+    lhs = design.generate('lhs', 10, 3, seed=0)
+    for column in lhs.T:
+        assert sorted(int(x * 10) for x in column) == list(range(10))
+
+    ff = design.fractional_factorial(8, 5)
+    assert set(map(tuple, ff[:, :3])) == set((a, b, c) for a in (0, 1) for b in (0, 1) for c in (0, 1))
+    assert (ff.sum(axis=0) == 4).all()
+
+    vlist = OrderedDict([("A", VariableFactory.build("A", "[1-100]")),
+                         ("MODE", VariableFactory.build("MODE", "{slow,medium,fast}"))])
+    expander = DesignVariableExpander(vlist, set(), 'lhs', types.SimpleNamespace(expand_budget=30, expand_seed=None))
+    combinations = list(expander)
+    assert len(combinations) == len(expander) == 30
+    assert set(v["MODE"] for v in combinations) == {"slow", "medium", "fast"}
+    assert len(set(v["A"] for v in combinations)) == 30
+
+
+def test_design_late_variable():
+    from npf.variable import VariableFactory, ExperimentalDesign
+    args = get_args()
+    args.experimental_design = 'lhs'
+    args.experimental_design_points = 10
+    ExperimentalDesign.matrix = None
+    ExperimentalDesign.varmap = OrderedDict()
+    try:
+        a = VariableFactory.build("A", "[0-100#]")
+        values = list(a.makeValues())
+        # A variable declared once the design was generated does not change the values of the others
+        b = VariableFactory.build("B", "[0-100#]")
+        assert len(b.makeValues()) == 10
+        assert list(a.makeValues()) == values
+        for column in ExperimentalDesign.matrix:
+            assert sorted(int(x * 10) for x in column) == list(range(10))
+    finally:
+        ExperimentalDesign.matrix = None
+        ExperimentalDesign.varmap = OrderedDict()
+
+
+def test_slots():
+    from npf import npf
+    from npf.slots import SlotScheduler
+
+    scheduler = SlotScheduler([{"client": ["a"]}, {"client": ["b"]}])
+    done = []
+    for i in range(6):
+        done.extend(scheduler.submit(i, lambda slot, first: (slot, npf.roles["client"][0], first)))
+    done.extend(scheduler.drain())
+    assert sorted(key for key, outcome in done) == list(range(6))
+    for key, (slot, node, first) in done:
+        assert node == "ab"[slot]
+    assert sum(1 for key, (slot, node, first) in done if first) == 2
+
+
+def test_slots_search(tmp_path):
+    from npf import npf
+    args = get_args()
+    args.experiment_folder = str(tmp_path)
+    args.quiet = True
+    args.show_full = False
+    (tmp_path / "s.npf").write_text("%config\ndefault_repo=local\nn_runs=1\n\n%variables\n"
+                                    "RATE=SEARCH(1, 100, DROPPED == 0)\n\n"
+                                    "%script\nif [ ${RATE} -gt 37 ] ; then echo RESULT-DROPPED 10 ; else echo RESULT-DROPPED 0 ; fi\n")
+    test = Test(str(tmp_path / "s.npf"), options=args, tags=args.tags)
+    build = Build(Repository("local", args), "local", result_path=[str(tmp_path / "results")])
+    slots = list(npf.slots)
+    npf.slots[:] = [dict(npf.roles), dict(npf.roles)]
+    try:
+        all_results, kind_results, init_done = test.execute_all(build, options=args)
+    finally:
+        npf.slots[:] = slots
+    # Each probe of the search is chosen from the result of the previous one, even when it runs on another slot
+    probes = [run.variables["RATE"] for run in all_results.keys()]
+    assert probes == [100, 50, 25, 37, 43, 40, 38]
+    assert max(r for r in probes if r <= 37) == 37
+
+
+def test_shard_merge(tmp_path):
+    from npf.variable import VariableFactory
+    from npf.section import SectionVariable
+    from npf.merge import merge
+
+    section = SectionVariable()
+    section.vlist = OrderedDict([("A", VariableFactory.build("A", "[1-8]")), ("B", VariableFactory.build("B", "{x,y}"))])
+    cost = lambda v: v["A"]
+    shards = []
+    for i in range(3):
+        options = types.SimpleNamespace(shard="%d/3" % (i + 1), expand=None)
+        shards.append(list(section.expand(options=options, cost=cost)))
+    assert sorted(str(v) for shard in shards for v in shard) == sorted(str(v) for v in section.expand())
+    loads = [sum(cost(v) for v in shard) for shard in shards]
+    assert max(loads) - min(loads) <= 1
+    assert sorted(str(v) for v in section.expand(options=types.SimpleNamespace(shard="2/3"), method="shuffle", cost=cost)) == sorted(str(v) for v in shards[1])
+
+    for i, lines in enumerate([["A:1={PERF:1.0}\n", "A:2={PERF:2.0}\n"], ["A:2={PERF:2.0}\n", "A:3={PERF:3.0}\n"]]):
+        folder = tmp_path / ("s%d" % i) / "local" / "local"
+        folder.mkdir(parents=True)
+        (folder / "t.npf.results").write_text("".join(lines))
+    sources = [str(tmp_path / "s0"), str(tmp_path / "s1")]
+    assert merge(sources, str(tmp_path / "out"), quiet=True) == []
+    assert (tmp_path / "out" / "local" / "local" / "t.npf.results").read_text() == "A:1={PERF:1.0}\nA:2={PERF:2.0}\nA:3={PERF:3.0}\n"
+    provenance = (tmp_path / "out" / "local" / "local" / "t.npf.results.provenance").read_text().splitlines()
+    assert provenance == ["A:1=%s" % sources[0], "A:2=%s+%s" % tuple(sources), "A:3=%s" % sources[1]]
+
+    (tmp_path / "s1" / "local" / "local" / "t.npf.results").write_text("A:1={PERF:5.0}\n")
+    assert len(merge(sources, str(tmp_path / "conflict"), quiet=True)) == 1
+    assert not (tmp_path / "conflict").exists()
+
+def test_build_pipeline():
+    import threading
+    from npf.pipeline import BuildPipeline
+
+    events = []
+
+    class FakeBuild:
+        def __init__(self, version):
+            self.version = version
+            self.prebuilt = False
+
+        def isolate(self, folder):
+            self.folder = folder
+
+        def build(self, *args, activate=True):
+            events.append(("build", self.version, threading.current_thread() is threading.main_thread()))
+            return self.version != "bad"
+
+        def activate(self):
+            events.append(("activate", self.version))
+
+    options = types.SimpleNamespace(force_build=False, no_build=False, quiet_build=True, show_build_cmd=False)
+    builds = [FakeBuild(v) for v in ["a", "bad", "c"]]
+    done = [(b.version, ok) for b, ok in BuildPipeline(builds, options, depth=1)]
+    assert done == [("a", True), ("bad", False), ("c", True)]
+    assert [e[1] for e in events if e[0] == "build"] == ["a", "bad", "c"]
+    assert not any(e[2] for e in events if e[0] == "build")
+    assert [e[1] for e in events if e[0] == "activate"] == ["a", "c"]
+    assert all(b.prebuilt for b in builds if b.version != "bad")
+    # The builds take turns in depth + 1 folders
+    assert [b.folder for b in builds] == ["0", "1", "0"]
+
+def test_artifact_cache(tmp_path):
+    from npf.cache import ArtifactCache
+
+    repo = types.SimpleNamespace(reponame="r", url="u", configure="", clean="", make="make", bin_folder="bin",
+                                 env=OrderedDict(), tags=[])
+    cache = ArtifactCache(str(tmp_path / "cache"), max_size=250)
+
+    def build(version):
+        folder = tmp_path / version / "bin"
+        folder.mkdir(parents=True, exist_ok=True)
+        return types.SimpleNamespace(repo=repo, version=version, get_local_bin_folder=lambda: str(folder) + "/")
+
+    for version in ["a", "b"]:
+        b = build(version)
+        (tmp_path / version / "bin" / "prog").write_text(version * 100)
+        cache.store(b)
+    (tmp_path / "a" / "bin" / "prog").unlink()
+    (tmp_path / "a" / "bin" / "stale").write_text("b")
+    assert cache.restore(build("a"))
+    assert (tmp_path / "a" / "bin" / "prog").read_text() == "a" * 100
+    assert not (tmp_path / "a" / "bin" / "stale").exists()
+
+    # a was used last, b is evicted first
+    (tmp_path / "c" / "bin").mkdir(parents=True)
+    (tmp_path / "c" / "bin" / "prog").write_text("c" * 100)
+    cache.store(build("c"))
+    assert not cache.restore(build("b"))
+    assert cache.restore(build("a")) and cache.restore(build("c"))
+
+    repo.make = "make -j4"
+    assert not cache.restore(build("a"))
+    # The cache is opt-in
+    assert ArtifactCache.get(get_args()) is None
+
+def test_build_graph():
+    import threading
+    import time
+    from npf.pipeline import BuildGraph
+    from npf.build import Build
+
+    assert Build.set_jobs("make -j12 && make -j 4 install", 3) == "make -j3 && make -j3 install"
+    assert Build.set_jobs("ninja", 3) == "ninja"
+    assert Build.set_jobs("make -j $(nproc)", 3) == "make -j3"
+    assert Build.set_jobs("make -j$(($(nproc) * 2)) all && make -j$JOBS install", 3) == "make -j3 all && make -j3 install"
+    assert Build.set_jobs("make -j install", 3) == "make -j3 install"
+
+    lock = threading.Lock()
+    log = []
+
+    class FakeBuild:
+        def __init__(self, name, ok=True):
+            self.name = name
+            self.ok = ok
+
+        def build(self, jobs=None, force_build=False):
+            with lock:
+                log.append(("start", self.name, jobs))
+            time.sleep(0.2)
+            with lock:
+                log.append(("end", self.name, jobs))
+            return self.ok
+
+    graph = BuildGraph(jobs=4)
+    graph.add("dpdk", FakeBuild("dpdk"))
+    graph.add("daq", FakeBuild("daq"))
+    graph.add("fastclick", FakeBuild("fastclick"))
+    graph.add("metron", FakeBuild("metron"), after=["fastclick"])
+    graph.add("broken", FakeBuild("broken", ok=False))
+    graph.add("child", FakeBuild("child"), after=["broken"])
+    assert graph.run() == ["broken", "child"]
+    starts = [e for e in log if e[0] == "start"]
+    assert [e[2] for e in starts[:4]] == [1, 1, 1, 1]
+    assert log.index(("end", "fastclick", 1)) < log.index([e for e in starts if e[1] == "metron"][0])
+    assert "child" not in [e[1] for e in starts]
+
+    cycle = BuildGraph(jobs=2)
+    cycle.add("a", FakeBuild("a"), after=["b"])
+    cycle.add("b", FakeBuild("b"), after=["a"])
+    try:
+        cycle.run()
+        assert False
+    except Exception as e:
+        assert "Circular" in str(e)
+
+def test_object_store(tmp_path):
+    import git
+    from npf.repository import MethodGit, ObjectStore
+
+    args = get_args()
+    args.quiet_build = True
+    args._build_path = str(tmp_path / "build") + "/"
+    upstream = git.Repo.init(str(tmp_path / "upstream"), initial_branch="master")
+    (tmp_path / "upstream" / "f").write_text("1")
+    upstream.index.add(["f"])
+    upstream.index.commit("first")
+
+    clones = []
+    for name in ["variant-a", "variant-b"]:
+        repo = types.SimpleNamespace(url=str(tmp_path / "upstream"), options=args, reponame=name, branch="master")
+        repo.get_build_path = lambda name=name: args._build_path + name + "/"
+        clones.append(MethodGit(repo).checkout())
+    store = ObjectStore.path(str(tmp_path / "upstream"))
+    for clone in clones:
+        assert clone.remotes.origin.url == str(tmp_path / "upstream")
+        assert open(os.path.join(clone.git_dir, "objects", "info", "alternates")).read().strip() == store + "/objects"
+        assert clone.head.commit == upstream.head.commit
+
+    # Variants of the same URL built concurrently share the creation and the fetch of the store
+    from concurrent.futures import ThreadPoolExecutor
+    url = str(tmp_path / "upstream") + "/"
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        paths = list(executor.map(lambda i: ObjectStore.update(url, quiet=True), range(8)))
+    assert paths == [ObjectStore.path(url)] * 8
+    assert git.Repo(paths[0]).commit("master") == upstream.head.commit
+
+def test_history_cache(tmp_path):
+    import git
+    from npf.history import HistoryCache
+
+    repo = git.Repo.init(str(tmp_path / "repo"))
+    commits = []
+    for i in range(4):
+        (tmp_path / "repo" / "f").write_text(str(i))
+        repo.index.add(["f"])
+        commits.append(repo.index.commit("c%d" % i).hexsha)
+
+    history = HistoryCache(repo)
+    assert history.first_parents(commits[2], 10) == [commits[2], commits[1], commits[0]]
+    assert history.first_parents(commits[3][:7], 2) == [commits[3], commits[2]]
+    lines = open(history.filename).read().splitlines()
+    assert len(lines) == 4 and "%s %s" % (commits[1], commits[0]) in lines
+
+    # Reloaded from the file, without walking git again
+    reloaded = HistoryCache(repo)
+    reloaded.gitrepo = types.SimpleNamespace(commit=repo.commit)
+    assert reloaded.first_parents(commits[3], 10) == commits[::-1]
+
+    args = get_args()
+    r = Repository('click-2022', args)
+    b = Build(r, "abc", [str(tmp_path / "results")])
+    assert not b.hasResults()
+    b.writeResults()
+    assert b.hasResults()
+
+def test_remote_build(tmp_path):
+    import threading
+    from npf.remotebuild import RemoteBuild
+
+    args = get_args()
+    args.quiet_build = True
+    args._build_path = str(tmp_path / "build") + "/"
+    lock = threading.Lock()
+    log = []
+
+    class FakeExecutor:
+        def __init__(self, addr):
+            self.addr = addr
+            self.version = None
+
+        def exec(self, cmd, options=None, title=None, env=None):
+            with lock:
+                log.append((self.addr, cmd))
+            if cmd.startswith("cat "):
+                return 0, (self.version or "") + "\n", "", 0
+            if cmd.startswith("echo "):
+                self.version = cmd.split()[1]
+            return 0, "", "", 0
+
+        def sendFolder(self, path, local):
+            with lock:
+                log.append((self.addr, "send " + path))
+            return 1, 0
+
+        def recvFolder(self, path, local):
+            with lock:
+                log.append((self.addr, "recv " + path))
+            return 1, 0
+
+    nodes = []
+    for addr, arch in [("arm1", "aarch64"), ("arm2", "aarch64"), ("x1", "x86_64"), ("unknown", "")]:
+        nodes.append(types.SimpleNamespace(name=addr, addr=addr, arch=arch, nfs=False, executor=FakeExecutor(addr)))
+    repo = types.SimpleNamespace(reponame="fastclick", name="FastClick", env=OrderedDict(), configure="./configure",
+                                 clean="make clean", make="make", current_version=lambda: "abc",
+                                 get_build_path=lambda: str(tmp_path / "build" / "fastclick") + "/",
+                                 get_remote_build_path=lambda node: "build/fastclick/",
+                                 get_remote_bin_folder=lambda node, version=None: "build/fastclick/bin/",
+                                 pretty_name=lambda: "FastClick")
+    assert RemoteBuild(repo, args).run(nodes)
+    builds = [addr for addr, cmd in log if "make" in cmd]
+    assert sorted(builds) == ["arm1", "unknown", "x1"]
+    assert ("arm1", "recv build/fastclick/bin/") in log and ("arm2", "send build/fastclick/bin/") in log
+    assert all(node.executor.version == "abc" for node in nodes)
+
+    log.clear()
+    assert RemoteBuild(repo, args).run(nodes)
+    assert not [cmd for addr, cmd in log if "make" in cmd or cmd.startswith("send")]
+
+def test_recv_folder(tmp_path):
+    import paramiko
+    from npf.executor.sshexecutor import SSHExecutor
+
+    class LocalSFTP:
+        def listdir_attr(self, path):
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, f)), f) for f in os.listdir(path)]
+
+        def get(self, remote, local):
+            with open(remote, 'rb') as src, open(local, 'wb') as dst:
+                dst.write(src.read())
+
+        def close(self):
+            pass
+
+    executor = SSHExecutor(None, "node", str(tmp_path / "node"), 22)
+    executor.get_connection = lambda: types.SimpleNamespace(get_transport=lambda: None)
+    from_transport = paramiko.SFTPClient.from_transport
+    paramiko.SFTPClient.from_transport = lambda transport: LocalSFTP()
+    try:
+        (tmp_path / "node" / "bin").mkdir(parents=True)
+        (tmp_path / "node" / "bin" / "prog").write_text("v1")
+        assert executor.recvFolder("bin", str(tmp_path / "mirror")) == (2, 0)
+        assert executor.recvFolder("bin", str(tmp_path / "mirror")) == (0, 2)
+        # A rebuilt binary of the same size is received again
+        (tmp_path / "node" / "bin" / "prog").write_text("v2")
+        os.utime(str(tmp_path / "node" / "bin" / "prog"), (1, 1))
+        assert executor.recvFolder("bin", str(tmp_path / "mirror")) == (2, 0)
+        assert (tmp_path / "mirror" / "bin" / "prog").read_text() == "v2"
+        # An absolute remote folder stays under the local folder
+        executor.recvFolder(str(tmp_path / "node" / "bin"), str(tmp_path / "abs"))
+        assert (tmp_path / "abs" / str(tmp_path / "node" / "bin" / "prog").lstrip("/")).read_text() == "v2"
+    finally:
+        paramiko.SFTPClient.from_transport = from_transport
+
+
+def test_download_cache(tmp_path):
+    import hashlib
+    import tarfile
+    from npf.download import DownloadCache
+
+    (tmp_path / "src" / "pkg").mkdir(parents=True)
+    (tmp_path / "src" / "pkg" / "f").write_text("content")
+    archive = str(tmp_path / "pkg.tar.gz")
+    with tarfile.open(archive, "w:gz") as t:
+        t.add(str(tmp_path / "src" / "pkg"), arcname="pkg")
+    digest = hashlib.sha256(open(archive, "rb").read()).hexdigest()
+
+    cache = DownloadCache(str(tmp_path / "cache"))
+    url = "file://" + archive
+    filename = cache.get(url, extract_to=str(tmp_path / "out1"))
+    assert (tmp_path / "out1" / "pkg" / "f").read_text() == "content"
+    assert os.path.basename(filename) == digest
+
+    # Hits never read the URL again
+    os.unlink(archive)
+    cache.get(url, extract_to=str(tmp_path / "out2"))
+    assert (tmp_path / "out2" / "pkg" / "f").read_text() == "content"
+    assert cache.get("file:///nonexistent", checksum="sha256:" + digest) == filename
+    md5 = hashlib.md5(open(filename, "rb").read()).hexdigest()
+    assert cache.get(url, checksum="md5:" + md5) == filename
+
+    try:
+        cache.get("file://" + filename, checksum="sha256:" + "0" * 64)
+        assert False
+    except Exception as e:
+        assert "Checksum mismatch" in str(e)
+
+def test_killall():
+    import queue
+    import subprocess
+    import threading
+    import time
+    from npf.eventbus import EventBus
+    from npf.executor.localexecutor import LocalKiller
+
+    q = queue.Queue()
+    procs = [subprocess.Popen(["sleep", "60"], start_new_session=True),
+             subprocess.Popen(["sh", "-c", "trap '' TERM; sleep 60"], start_new_session=True)]
+    for p in procs:
+        # The scripts are not children of the killing process, something else reaps them
+        threading.Thread(target=p.wait).start()
+        q.put(LocalKiller(p.pid))
+    time.sleep(0.2)
+
+    start = time.time()
+    Test.killall(q, EventBus(), hardkill=500)
+    elapsed = time.time() - start
+    assert 0.4 < elapsed < 3
+    for p in procs:
+        p.wait(timeout=5)
+    assert procs[0].returncode == -15
+    assert procs[1].returncode == -9
+
+def test_setup_ahead(tmp_path):
+    from npf.section import SectionScript
+    args = get_args()
+    args.experiment_folder = str(tmp_path)
+    (tmp_path / "s.npf").write_text("%config\ndefault_repo=local\n\n%variables\nA=[1-3]\n\n"
+                                    "%file conf\nvalue ${A}\n\n%script\ncat conf\n")
+    test = Test(str(tmp_path / "s.npf"), options=args, tags=args.tags)
+    build = Build(Repository("local", args), "local")
+    folder = test.make_test_folder()
+
+    constants = {}
+    setups = [test.prepare(build, {"A": a}, allowed_types={SectionScript.TYPE_SCRIPT, SectionScript.TYPE_EXIT},
+                           test_folder=folder, constants=constants) for a in [1, 2]]
+    assert list(constants.keys()) == [npf.nodes_for_role("default")[0].get_name()]
+    for a, setup in zip([1, 2], setups):
+        assert len(setup.params) == 1
+        assert setup.params[0].commands.strip().endswith("cd %s;\ncat conf" % folder)
+        assert setup.file_list[0][1].strip() == "value %d" % a
+        test.stage_files(setup, folder)
+
+    # Staged files only appear in the test folder once committed
+    assert not (tmp_path / folder / "conf").exists()
+    assert (tmp_path / folder / setups[1].stage / "conf").read_text().strip() == "value 2"
+    for a, setup in zip([1, 2], setups):
+        test.commit_files(setup, folder)
+        assert (tmp_path / folder / "conf").read_text().strip() == "value %d" % a
+        assert not (tmp_path / folder / setup.stage).exists()
+
+def test_async_engine(tmp_path):
+    import time
+    from npf.engine import AsyncEngine
+    from npf.test import RemoteParameters
+    args = get_args()
+    args.quiet = True
+
+    def param(name, commands, **kwargs):
+        p = RemoteParameters()
+        p.role = "default"
+        p.role_id = 0
+        p.commands = commands
+        p.bin_paths = []
+        p.env = OrderedDict()
+        p.options = args
+        p.delay = 0
+        p.name = name
+        p.script = name
+        p.hardkill = 200
+        for k, v in kwargs.items():
+            setattr(p, k, v)
+        return p
+
+    server = param("server", "trap '' TERM; echo EVENT READY; pwd; sleep 30")
+    client = param("client", "echo RESULT 1; echo err >&2; printf last", waitfor="READY", delay=0.1)
+    late = param("late", "echo never", delay=10)
+    start = time.time()
+    results = AsyncEngine(args, str(tmp_path)).run([server, client, late], autokill=[[1, [client]]])
+    assert time.time() - start < 5
+    assert results[0] == (True, "EVENT READY\n%s\n" % tmp_path, "", 0, "server")
+    assert results[1] == (True, "RESULT 1\nlast", "err\n", 0, "client")
+    assert results[2] == (1, 'Killed before execution', 'Killed before execution', 0, "late")
+
+    expired = param("expired", "sleep 30", timeout=0.5)
+    results = AsyncEngine(args, str(tmp_path)).run([expired])
+    assert results[0][0] == False and results[0][4] == "expired"
+
+def test_agent(tmp_path):
+    import subprocess
+    import sys
+    import threading
+    import time
+    from npf.executor.agentclient import AgentClient
+    p = subprocess.Popen([sys.executable, AgentClient.source()], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    client = AgentClient(p.stdout, p.stdin)
+    try:
+        assert client.call('ping', timeout=5)['pid'] == p.pid
+
+        replies = []
+        done = threading.Event()
+
+        def handler(msg):
+            replies.append(msg)
+            if 'exit' in msg:
+                done.set()
+
+        client.request('exec', handler, cmd="echo RESULT 1; echo noise; echo err >&2; printf last; exit 3")
+        assert done.wait(5)
+        assert 'pid' in replies[0]
+        assert ''.join(r['out'] for r in replies if 'out' in r) == "RESULT 1\nnoise\nlast"
+        assert [r['err'] for r in replies if 'err' in r] == ["err\n"]
+        assert replies[-1]['exit'] == 3
+
+        replies.clear()
+        done.clear()
+        client.request('exec', handler, cmd="echo RESULT 2; echo noise", filter=AgentClient.FILTER)
+        assert done.wait(5)
+        assert [r['out'] for r in replies if 'out' in r] == ["RESULT 2\n"]
+
+        client.call('write', timeout=5, path=str(tmp_path / "sub" / "file"), content="content")
+        assert (tmp_path / "sub" / "file").read_text() == "content"
+
+        replies.clear()
+        done.clear()
+        client.request('exec', handler, cmd="trap '' TERM; sleep 30 & wait; sleep 30")
+        while not replies:
+            time.sleep(0.01)
+        start = time.time()
+        client.call('kill', timeout=5, pids=[replies[0]['pid']], grace=0.2)
+        assert done.wait(5)
+        assert time.time() - start < 2
+    finally:
+        client.close()
+        p.wait(5)
+
+def test_agent_relay(tmp_path):
+    import os
+    import subprocess
+    import sys
+    import threading
+    from types import SimpleNamespace
+    from npf.executor.agentclient import AgentClient, PeerClient
+    get_args()._build_path = str(tmp_path) + os.sep
+    peer = subprocess.Popen([sys.executable, AgentClient.source(), '--listen', '0'], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    peer.stdin.write((AgentClient.token() + '\n').encode())
+    peer.stdin.close()
+    port = int(peer.stdout.readline())
+    relay = subprocess.Popen([sys.executable, AgentClient.source()], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    client = AgentClient(relay.stdout, relay.stdin)
+    try:
+        executor = SimpleNamespace(user=None, addr='127.0.0.1', port=22, agent='tcp:%d' % port)
+        peers = [PeerClient(client, executor) for i in range(3)]
+        assert all(p.call('ping', timeout=5)['pid'] == peer.pid for p in peers)
+
+        outputs = [[] for p in peers]
+        done = [threading.Event() for p in peers]
+        for i, p in enumerate(peers):
+            def handler(msg, i=i):
+                if 'out' in msg:
+                    outputs[i].append(msg['out'])
+                if 'exit' in msg:
+                    done[i].set()
+            p.request('exec', handler, cmd="echo RESULT %d; echo noise" % i, filter=AgentClient.FILTER)
+        assert all(d.wait(5) for d in done)
+        assert outputs == [["RESULT %d\n" % i] for i in range(3)]
+    finally:
+        client.close()
+        relay.wait(5)
+        peer.kill()
+        peer.wait()
+
+def test_agent_token(tmp_path):
+    import json
+    import socket
+    import subprocess
+    import sys
+    from npf.executor.agentclient import AgentClient
+    get_args()._build_path = str(tmp_path) + os.sep
+    # The agent does not listen without a token
+    assert subprocess.run([sys.executable, AgentClient.source(), '--listen', '0'], input=b'',
+                          timeout=10).returncode != 0
+
+    agent = subprocess.Popen([sys.executable, AgentClient.source(), '--listen', '0', '127.0.0.1'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    agent.stdin.write((AgentClient.token() + '\n').encode())
+    agent.stdin.close()
+    try:
+        port = int(agent.stdout.readline())
+        for hello in [{}, {'token': 'wrong'}]:
+            sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+            sock.sendall((json.dumps(hello) + '\n').encode())
+            sock.sendall((json.dumps({'id': 1, 'op': 'ping'}) + '\n').encode())
+            assert sock.recv(1024) == b''
+            sock.close()
+        client = AgentClient.connect(None, '127.0.0.1', 22, 'tcp:%d' % port, None)
+        try:
+            assert client.call('ping', timeout=5)['pid'] == agent.pid
+        finally:
+            client.close()
+    finally:
+        agent.kill()
+        agent.wait()
+
+def test_bring_up(tmp_path):
+    import pytest
+    from npf.executor.sshexecutor import SSHExecutor
+    args = get_args()
+    args._build_path = str(tmp_path) + os.sep
+    args.do_test = True
+    args.conntest_ttl = 60
+    nodes = []
+    for i in range(3):
+        node = Node('bringup%d' % i, SSHExecutor(None, '127.0.0.1', str(tmp_path), 2200 + i), args.tags)
+        node.parsed = True
+        nodes.append(node)
+
+    # Nodes that passed the test recently are not tested again
+    nodes[0]._conntest_passed()
+    nodes[1]._conntest_passed()
+    Node.bring_up_all(nodes[:2] + nodes[:1], args)
+    assert all(node.ip == '127.0.0.1' and 'access' in node.bring_up_times for node in nodes[:2])
+
+    with pytest.raises(Exception):
+        Node.bring_up_all(nodes, args)
+    args.conntest_ttl = 0
+    with pytest.raises(Exception):
+        Node.bring_up_all(nodes[:1], args)
+
+def test_find_nics(tmp_path):
+    from npf.executor.localexecutor import LocalExecutor
+    args = get_args()
+    args._build_path = str(tmp_path) + os.sep
+    devices = sorted(n for n in os.listdir('/sys/class/net') if os.path.exists('/sys/class/net/%s/device' % n))
+    node = Node('nicsnode', LocalExecutor(), args.tags)
+    node._find_nics()
+    assert sorted(node._nics[i].ifname for i in range(len(devices))) == devices
+    for i in range(len(devices)):
+        with open('/sys/class/net/%s/address' % node._nics[i].ifname) as f:
+            assert node._nics[i].mac == f.read().strip()
+    with open('/proc/sys/kernel/random/boot_id') as f:
+        assert node.boot_id == f.read().strip()
+
+    # On the same boot, the NICs are not looked for again
+    class NoExecutor(LocalExecutor):
+        def exec(self, *args, **kwargs):
+            raise AssertionError("The NICs should come from the cache")
+    again = Node('nicsnode', NoExecutor(), args.tags)
+    again.boot_id = node.boot_id
+    again._find_nics()
+    assert [again._nics[i].mac for i in range(len(devices))] == [node._nics[i].mac for i in range(len(devices))]
+
+    # NICs of the same speed keep the order of the PCI bus, an address that cannot be parsed is skipped
+    class FakeExecutor(LocalExecutor):
+        def exec(self, *args, **kwargs):
+            return 0, "boot_id=\n" \
+                      "nic=eth0 /sys/devices/pci0000:00/0000:00:03.0/net/eth0 00:00:00:00:00:01 1000 10.0.0.1/24\n" \
+                      "nic=eth1 /sys/devices/pci0000:00/0000:00:02.0/net/eth1 00:00:00:00:00:02 1000 bogus\n" \
+                      "nic=eth2 /sys/devices/pci0000:00/0000:00:04.0/net/eth2 00:00:00:00:00:03 10000\n", "", 0
+    fake = Node('fakenics', FakeExecutor(), args.tags)
+    fake._find_nics()
+    assert [fake._nics[i].ifname for i in range(3)] == ["eth2", "eth1", "eth0"]
+    assert fake._nics[1].ip == "" and fake._nics[2].ip == "10.0.0.1"
+
+def test_capture(tmp_path):
+    import pickle
+    import re
+    from npf.capture import Capture
+    regex = r"RESULT-(?P<type>[A-Z]+)[ \t]+(?P<value>[0-9.]+)"
+    small = Capture(tmp_path, 'small', limit=1000)
+    small += "RESULT-A 1\n"
+    assert not small.spilled and str(small) == "RESULT-A 1\n"
+    assert [m.group("value") for m in small.finditer(regex)] == ["1"]
+
+    big = Capture(tmp_path, 'big', limit=1000)
+    big += "RESULT-A 1\n"
+    for i in range(1000):
+        big += "line %d µs\n" % i
+    big += "RESULT-B 2\n"
+    assert big.spilled and len(big._chunks[0]) <= 2000
+    assert str(big).startswith("RESULT-A 1\nline 0 µs\n") and str(big).endswith("line 999 µs\nRESULT-B 2\n")
+    assert [(m.group("type"), m.group("value")) for m in big.finditer(regex)] == [("A", "1"), ("B", "2")]
+    assert [m.group(1) for m in big.finditer(r"line (99[0-9]) µs")] == [str(i) for i in range(990, 1000)]
+    assert big.tail(11).endswith("\nRESULT-B 2\n") and big.path in big.tail(11)
+
+    # Given to another process and back, then merged in the output of a run
+    big = pickle.loads(pickle.dumps(big))
+    big += "RESULT-C 3\n"
+    run = Capture(tmp_path, 'run', limit=1000)
+    run += small
+    run += big
+    assert len(run) == len(small) + len(big)
+    assert [m.group("type") for m in run.finditer(regex)] == ["A", "A", "B", "C"]
+    big.discard()
+    assert not os.path.exists(big.path)
+    run.close()
+    assert run.tail().endswith("RESULT-C 3\n") and len(run._chunks[0]) <= Capture.TAIL
+    assert str(run).startswith("RESULT-A 1\nRESULT-A 1\nline 0 µs\n")
+
+def test_console():
+    import io
+    from npf.console import Console
+    out = io.StringIO()
+    console = Console(rate=2, out=out)
+    for i in range(10):
+        console.write('[a]', 'line %d' % i)
+    console.write('[a]', 'RESULT 1')
+    console.flush()
+    lines = out.getvalue().splitlines()
+    assert lines == ['[a] line 0', '[a] line 1', '[a] RESULT 1', '[a] ... 8 lines not shown']
+
+def test_output_archive(tmp_path):
+    from npf.archive import OutputArchive
+    from npf.capture import Capture
+    build = types.SimpleNamespace(result_folder=lambda: str(tmp_path / "results") + "/", version="v1")
+    archive = OutputArchive(build, types.SimpleNamespace(filename="t.npf"))
+    run = Run({"A": 1, "B": "x"})
+    assert archive.indexes(run) == []
+    big = Capture(str(tmp_path / "out"), "big", limit=64)
+    for i in range(100):
+        big += "line %d\n" % i
+    big += "RESULT-X 3\n"
+    assert archive.store(run, big, "err") == 0
+    assert archive.store(run, "RESULT-X 4\n", "") == 1
+    assert archive.indexes(Run({"A": 1, "B": "y"})) == []
+    runs = archive.load(run, str(tmp_path / "reparse"), limit=64)
+    assert [i for i, o, e in runs] == [0, 1]
+    assert str(runs[0][1]) == str(big) and runs[0][1].spilled and str(runs[0][2]) == "err"
+    assert [m.group(1) for m in runs[1][1].finditer(r"RESULT-X (\d+)")] == ["4"]
+    archive.clear(run)
+    assert archive.indexes(run) == []
+
+    # Beyond its size, the combinations stored the longest ago are removed, never the one just stored
+    assert OutputArchive.get(build, types.SimpleNamespace(filename="t.npf"), types.SimpleNamespace(output_archive='0')) is None
+    archive = OutputArchive.get(build, types.SimpleNamespace(filename="t.npf"), types.SimpleNamespace(output_archive='3K'))
+    for i in range(10):
+        archive.store(Run({"A": i}), os.urandom(600).hex(), "")
+        os.utime(os.path.join(archive.path, archive.key(Run({"A": i})), "run"), (i, i))
+    kept = [i for i in range(10) if archive.indexes(Run({"A": i}))]
+    assert kept[-1] == 9 and kept == list(range(10 - len(kept), 10)) and 1 <= len(kept) < 10
+
+def test_trace(tmp_path):
+    import json
+    from npf import trace
+    assert trace.span("nothing") is trace.span("recorded")
+    path = str(tmp_path / "trace.json")
+    trace.start(path)
+    try:
+        with trace.span("outer", run=1):
+            with trace.track("script on node"):
+                trace.instant("post READY", "event", script="script")
+        trace.finish()
+    finally:
+        trace._path = None
+    events = json.load(open(path))["traceEvents"]
+    spans = {e["name"]: e for e in events}
+    assert spans["outer"]["ph"] == "X" and spans["outer"]["args"] == {"run": 1} and spans["outer"]["dur"] >= 0
+    assert spans["thread_name"]["args"]["name"] == "script on node"
+    assert spans["post READY"]["tid"] == spans["thread_name"]["tid"] != spans["outer"]["tid"]
+    assert not os.path.exists(path + ".events")
+
+def test_run_times(tmp_path):
+    from npf.runtimes import RunTimes, format_duration
+    assert format_duration(3.21) == "3.2s" and format_duration(75) == "1m15s" and format_duration(3725) == "1h02m05s"
+    build = types.SimpleNamespace(result_folder=lambda: str(tmp_path / "results") + "/", version="v1")
+    test = types.SimpleNamespace(filename="t.npf", max_run_time=lambda: 40)
+    times = RunTimes(build, test)
+    assert times.estimate(Run({"A": 1})) == 40
+    times.add(Run({"A": 1}), 30, 3, cost=1)
+    times.add(Run({"A": 2}), 40, 2, cost=2)
+    times.init = 5
+    times.write()
+    times = RunTimes(build, test)
+    assert times.init == 5
+    assert times.estimate(Run({"A": 1})) == 10
+    assert times.estimate(Run({"A": 2})) == 20
+    # Unknown combinations are estimated from the others, scaled by their cost
+    assert times.estimate(Run({"A": 3}), cost=4) == 70 / 7 * 4
+
+def test_failing_script(tmp_path):
+    from npf.section import SectionScript
+    args = get_args()
+    args.experiment_folder = str(tmp_path)
+    args.quiet = True
+    (tmp_path / "f.npf").write_text("%config\ndefault_repo=local\n\n%variables\nA=[1-2]\n\n"
+                                    "%script\necho RESULT-X ${A}\nexit 3\n")
+    test = Test(str(tmp_path / "f.npf"), options=args, tags=args.tags)
+    build = Build(Repository("local", args), "local")
+    data_results, kind_results, output, err, n_exec, n_err = test.execute(
+        build, Run({"A": 1}), {"A": 1}, n_runs=1, allowed_types={SectionScript.TYPE_SCRIPT, SectionScript.TYPE_EXIT})
+    # A script that fails is reported, its results are kept unless it is critical
+    assert n_err == 1
+    assert data_results["X"] == [1.0]
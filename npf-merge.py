@@ -0,0 +1 @@
+npf_merge.py
\ No newline at end of file
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+NPF remote agent, deployed by NPF on the nodes using agent= in their cluster file or --agent. It replaces a SSH
+session wrapped in unbuffer per script : NPF keeps a single connection to the agent, either the stdin and stdout of
+the agent started through SSH, or a TCP connection to an agent started with --listen PORT [ADDR].
+
+An agent listening on TCP binds ADDR only, 127.0.0.1 by default. When NPF starts it through SSH, ADDR is the address
+of the node the SSH connection came to. The first line of its stdin must give a secret that each connection starts
+with, as {"token": ...}, the agent refusing to listen without one. It is never put on a command line, where the other
+users of the node could read it.
+
+Requests and replies are JSON objects, one per line. Each request has an id, repeated in all its replies :
+ - {"op": "exec", "cmd": ..., "stdin": ..., "filter": regex} runs cmd with bash in a new process group, its stdout
+   being a PTY so it is line-buffered. Replies {"pid": n}, then {"out": line} and {"err": line} as the output comes,
+   only the lines matching filter if one is given, then {"exit": return code}.
+ - {"op": "kill", "pids": [...], "grace": seconds} sends SIGTERM to the process groups, then SIGKILL to the ones
+   still alive after grace. Replies {"ok": true}.
+ - {"op": "write", "path": ..., "content": ...} writes a file. Replies {"ok": true}.
+ - {"op": "ping"} replies {"ok": true, "pid": pid of the agent}.
+A failed request replies {"error": message}.
+
+An agent can also relay the requests for its peers, so NPF keeps a single connection for a whole group of nodes. A
+request with "node": "addr:port" is forwarded to the agent listening on that address, and its replies are sent back
+on the connection of the request. The connection to a peer is opened on its first request using "token", the agent
+of the peer being started through SSH with the user and port given by "deploy" if it does not listen yet.
+
+It only uses the python standard library.
+"""
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import pty
+import re
+import select
+import signal
+import socket
+import subprocess
+import sys
+import termios
+import threading
+import time
+
+
+class Peer:
+    """The connection of a relay to the agent of one of its peers"""
+
+    def __init__(self, agent, sock):
+        self.agent = agent
+        self.sock = sock
+        self.wfile = sock.makefile('wb')
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        # Id of the requests on the connection to the peer, to the id of the request of NPF
+        self.requests = {}
+        self.closed = False
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def send(self, req):
+        with self.lock:
+            if self.closed:
+                raise ConnectionError('Connection to the peer lost')
+            rid = next(self.ids)
+            self.requests[rid] = req['id']
+            req = dict(req, id=rid)
+            self.wfile.write((json.dumps(req) + '\n').encode())
+            self.wfile.flush()
+
+    def _read(self):
+        buffer = b''
+        try:
+            while True:
+                data = self.sock.recv(Agent.CHUNK)
+                if not data:
+                    break
+                lines = (buffer + data).split(b'\n')
+                buffer = lines.pop()
+                # All the replies received at once go up together
+                replies = []
+                for line in lines:
+                    msg = json.loads(line)
+                    rid = self.requests.get(msg.get('id', None), None)
+                    if 'exit' in msg or 'ok' in msg or 'error' in msg:
+                        self.requests.pop(msg.get('id', None), None)
+                    msg['id'] = rid
+                    replies.append(json.dumps(msg) + '\n')
+                self.agent.write(''.join(replies).encode())
+        except (OSError, ValueError):
+            pass
+        with self.lock:
+            self.closed = True
+        for rid in list(self.requests.values()):
+            self.agent.send(id=rid, error='Connection to the peer lost')
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class Agent:
+    CHUNK = 65536
+
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.lock = threading.Lock()
+        self.procs = {}
+        self.peers = {}
+        self.peers_lock = threading.Lock()
+
+    def send(self, **msg):
+        self.write((json.dumps(msg) + '\n').encode())
+
+    def write(self, data):
+        with self.lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except (OSError, ValueError):
+                pass
+
+    def serve(self):
+        for line in self.rfile:
+            try:
+                req = json.loads(line)
+            except ValueError:
+                continue
+            op = getattr(self, 'op_' + str(req.get('op')), None)
+            if req.get('node', None):
+                op = self.forward
+            if op is None:
+                self.send(id=req.get('id'), error='Unknown operation %s' % req.get('op'))
+                continue
+            threading.Thread(target=self._call, args=(op, req), daemon=True).start()
+        # NPF is gone, its scripts must not survive it, nor the ones of the peers that lose their connection too
+        for peer in self.peers.values():
+            peer.close()
+        self.kill(list(self.procs.keys()), 1)
+
+    def _call(self, op, req):
+        try:
+            op(req)
+        except Exception as e:
+            self.send(id=req.get('id'), error=str(e))
+
+    def peer(self, node, token, deploy) -> Peer:
+        """The connection to the agent of a peer, opened if needed"""
+        with self.peers_lock:
+            peer = self.peers.get(node, None)
+            if peer is not None and not peer.closed:
+                return peer
+            addr, port = node.rsplit(':', 1)
+            for i in range(50):
+                try:
+                    sock = socket.create_connection((addr, int(port)), timeout=5)
+                    break
+                except ConnectionRefusedError:
+                    if i == 0 and deploy is not None:
+                        self.deploy(addr, int(port), token, deploy)
+                    time.sleep(0.1)
+            else:
+                raise ConnectionError('Could not connect to the agent of %s' % node)
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall((json.dumps({'token': token}) + '\n').encode())
+            peer = Peer(self, sock)
+            self.peers[node] = peer
+            return peer
+
+    @staticmethod
+    def deploy(addr, port, token, deploy):
+        """Start an agent listening on port on a peer, copying this one through SSH"""
+        with open(os.path.abspath(__file__), 'rb') as f:
+            source = f.read()
+        remote = '/tmp/npf-agent-%s.py' % hashlib.sha256(source).hexdigest()[:12]
+        target = (deploy['user'] + '@' + addr) if deploy.get('user', None) else addr
+        subprocess.run(['ssh', '-o', 'BatchMode=yes', '-p', str(deploy.get('port', None) or 22), target,
+                        listen_command(remote, port, 'cat > %s.tmp && mv %s.tmp %s' % (remote, remote, remote))],
+                       input=token.encode() + b'\n' + source, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       timeout=30)
+
+    def forward(self, req):
+        peer = self.peer(req['node'], req.get('token', None), req.get('deploy', None))
+        peer.send({k: v for k, v in req.items() if k not in ['node', 'token', 'deploy']})
+
+    def op_ping(self, req):
+        self.send(id=req['id'], ok=True, pid=os.getpid())
+
+    def op_write(self, req):
+        path = req['path']
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(req['content'])
+        self.send(id=req['id'], ok=True)
+
+    def op_exec(self, req):
+        rid = req['id']
+        master, slave = pty.openpty()
+        # Raw output, without echo nor \r\n
+        attrs = termios.tcgetattr(slave)
+        attrs[1] &= ~termios.OPOST
+        attrs[3] &= ~termios.ECHO
+        termios.tcsetattr(slave, termios.TCSANOW, attrs)
+        env = dict(os.environ)
+        env.update(req.get('env', None) or {})
+        p = subprocess.Popen(['bash', '-c', req['cmd']], stdin=subprocess.PIPE, stdout=slave, stderr=subprocess.PIPE,
+                             cwd=req.get('cwd', None) or None, env=env, start_new_session=True)
+        os.close(slave)
+        self.procs[p.pid] = p
+        self.send(id=rid, pid=p.pid)
+        if req.get('stdin', None) is not None:
+            try:
+                p.stdin.write(req['stdin'].encode())
+                p.stdin.flush()
+            except OSError:
+                pass
+        regex = re.compile(req['filter']) if req.get('filter', None) else None
+
+        fds = {master: ['out', b''], p.stderr.fileno(): ['err', b'']}
+
+        def emit(kind, line):
+            text = line.decode(errors='replace')
+            if regex is None or regex.search(text):
+                self.send(id=rid, **{kind: text})
+
+        try:
+            while fds:
+                readable, _, _ = select.select(list(fds.keys()), [], [], 0.1)
+                if not readable and p.poll() is not None:
+                    # Children of the script may keep the terminal open, the script is done when it exits
+                    break
+                for fd in readable:
+                    kind, buffer = fds[fd]
+                    try:
+                        data = os.read(fd, self.CHUNK)
+                    except OSError:
+                        data = b''
+                    if not data:
+                        if buffer:
+                            emit(kind, buffer)
+                        del fds[fd]
+                        continue
+                    lines = (buffer + data).split(b'\n')
+                    fds[fd][1] = lines.pop()
+                    for line in lines:
+                        emit(kind, line + b'\n')
+            for kind, buffer in fds.values():
+                if buffer:
+                    emit(kind, buffer)
+            self.send(id=rid, exit=p.wait())
+        finally:
+            os.close(master)
+            p.stderr.close()
+            try:
+                p.stdin.close()
+            except OSError:
+                pass
+            self.procs.pop(p.pid, None)
+
+    @staticmethod
+    def alive(pid):
+        try:
+            os.killpg(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def kill(self, pids, timeout):
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            for pid in pids:
+                try:
+                    os.killpg(pid, sig)
+                except OSError:
+                    pass
+            deadline = time.time() + timeout
+            while time.time() < deadline and any(self.alive(pid) for pid in pids):
+                time.sleep(0.01)
+
+    def op_kill(self, req):
+        self.kill([int(pid) for pid in req['pids']], float(req.get('grace', 5)))
+        self.send(id=req['id'], ok=True)
+
+
+def listen_command(path, port, before=None) -> str:
+    """The shell command starting the agent at path in the background through SSH, listening on port of the address
+    of the node the SSH connection came to, so on the address its controller reaches it with. The token is the first
+    line of the stdin of the command, read by the shell and given to the agent through a pipe. before runs once it
+    is read, with the rest of stdin."""
+    return ('read -r T && %s{ printf "%%s\\n" "$T" | nohup python3 %s --listen %d '
+            '$(echo $SSH_CONNECTION | cut -d" " -f3) > /dev/null 2>&1 & }' % ((before + ' && ') if before else '', path, port))
+
+
+def listen(port, token, addr='127.0.0.1'):
+    """Serve the connections to port of addr, that must start with the token"""
+    if not token:
+        raise ValueError('The agent only listens with a token')
+    server = socket.socket(socket.AF_INET6 if ':' in addr else socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((addr, port))
+    server.listen()
+    print(server.getsockname()[1], flush=True)
+
+    def handle(conn):
+        rfile = conn.makefile('rb')
+        wfile = conn.makefile('wb')
+        try:
+            hello = json.loads(rfile.readline() or b'{}')
+        except ValueError:
+            hello = {}
+        if not hmac.compare_digest(str(hello.get('token', None)).encode(), token.encode()):
+            conn.close()
+            return
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        Agent(rfile, wfile).serve()
+        conn.close()
+
+    while True:
+        conn, addr = server.accept()
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--listen':
+        token = sys.stdin.readline().strip()
+        if not token:
+            sys.exit('The first line of stdin must give the token of the connections to the agent')
+        listen(int(sys.argv[2]), token, *sys.argv[3:4])
+    else:
+        Agent(sys.stdin.buffer, sys.stdout.buffer).serve()
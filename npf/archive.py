@@ -0,0 +1,115 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+from npf import npf
+from npf.capture import Capture
+from npf.types.dataset import Run
+
+
+class OutputArchive:
+    """The raw stdout and stderr of the runs of a test for a build, kept compressed next to its results so the results
+    can be parsed again with --reparse. Each combination of variables has its own folder, with the outputs of its runs
+    numbered in the order they were done. The combinations stored the longest ago are removed when the archive grows
+    beyond max_size bytes."""
+
+    def __init__(self, build, test, max_size=None):
+        self.path = os.path.abspath(os.path.join(build.result_folder() + build.version, test.filename + '.outputs'))
+        self.max_size = max_size
+
+    @classmethod
+    def get(cls, build, test, options):
+        """The archive of test for build if --output-archive enables it, else None"""
+        size = getattr(options, 'output_archive', None)
+        if not size or size == '0':
+            return None
+        return OutputArchive(build, test, npf.parseUnit(size))
+
+    @staticmethod
+    def key(run: Run) -> str:
+        variables = [(k, str(v[1] if type(v) is tuple else v)) for k, v in sorted(run.variables.items())]
+        return hashlib.sha256(json.dumps(variables).encode()).hexdigest()[:32]
+
+    def _folder(self, run):
+        return os.path.join(self.path, self.key(run))
+
+    def indexes(self, run):
+        """The indexes of the runs archived for the combination run"""
+        folder = self._folder(run)
+        if not os.path.exists(folder):
+            return []
+        return sorted(int(f[:-len('.out.gz')]) for f in os.listdir(folder) if f.endswith('.out.gz'))
+
+    def clear(self, run):
+        """Forget the outputs of the combination run, its results being done again"""
+        shutil.rmtree(self._folder(run), ignore_errors=True)
+
+    def store(self, run, output, err) -> int:
+        """Archive the outputs of a new run of the combination run, which may be Captures or strings
+        :return: The index of the run
+        """
+        folder = self._folder(run)
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'run'), 'w') as f:
+            f.write(run.format_variables() + '\n')
+        indexes = self.indexes(run)
+        index = indexes[-1] + 1 if indexes else 0
+        for ext, content in [('err', err), ('out', output)]:
+            path = os.path.join(folder, '%d.%s.gz' % (index, ext))
+            # The output is written last and renamed once complete, a run only exists once it is there
+            with gzip.open(path + '.tmp', 'wt', encoding='utf-8', errors='replace') as f:
+                for chunk in (content.chunks() if isinstance(content, Capture) else [content]):
+                    f.write(chunk)
+            os.replace(path + '.tmp', path)
+        if self.max_size:
+            self.evict(run)
+        return index
+
+    def _entries(self):
+        """The folders of all combinations with their size and the time of their last run, oldest first"""
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        for key in os.listdir(self.path):
+            folder = os.path.join(self.path, key)
+            try:
+                last = os.path.getmtime(os.path.join(folder, 'run'))
+                size = sum(f.stat().st_size for f in os.scandir(folder))
+            except OSError:
+                continue
+            entries.append((last, key, size))
+        return sorted(entries)
+
+    def evict(self, run=None):
+        """Remove the outputs of the combinations stored the longest ago, but run, until the archive fits in
+        max_size"""
+        entries = self._entries()
+        total = sum(size for t, key, size in entries)
+        keep = self.key(run) if run is not None else None
+        for t, key, size in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+            total -= size
+
+    def load(self, run, folder, limit=None):
+        """The archived outputs of the combination run, as Captures spilling to folder if they are large
+        :return: A list of (index, output, err)
+        """
+        runs = []
+        for index in self.indexes(run):
+            captures = []
+            for ext in ['out', 'err']:
+                capture = Capture(folder, 'reparse%d.%s' % (index, ext), limit=limit)
+                path = os.path.join(self._folder(run), '%d.%s.gz' % (index, ext))
+                if os.path.exists(path):
+                    with gzip.open(path, 'rt', encoding='utf-8', errors='replace') as f:
+                        for chunk in iter(lambda: f.read(Capture.CHUNK), ''):
+                            capture += chunk
+                captures.append(capture)
+            runs.append((index, captures[0], captures[1]))
+        return runs
@@ -5,6 +5,7 @@ from subprocess import PIPE
 from pathlib import Path
 import re
 from npf import variable, npf
+from npf.cache import ArtifactCache
 from npf.types.dataset import Run, Dataset
 import copy
 
@@ -38,6 +39,8 @@ class Build:
         self._line = '-'
         self.cache = {}
         self._result_path = result_path
+        self._build_path = None
+        self.prebuilt = False
 
     def copy(self):
         return copy.copy(self)
@@ -100,6 +103,7 @@ class Build:
         else:
             filename = self.__resultFilename(test)
             self._writeversion(filename, all_results, allow_overwrite)
+        self.repo._results_index.clear()
 
     def _writeversion(self, filename, all_results, allow_overwrite):
         try:
@@ -194,27 +198,49 @@ class Build:
         return all_results
 
     def hasResults(self, script=None):
-        return os.path.exists(self.__resultFilename(script))
+        return self.version in self.repo.results_index(self.result_folder(), script)
 
     def writeResults(self):
         filename = self.__resultFilename()
         if not os.path.exists(os.path.dirname(filename)):
             os.makedirs(os.path.dirname(filename))
         open(filename, 'a').close()
+        self.repo._results_index.clear()
 
     def build_path(self):
-        return self.repo.get_build_path()
+        return self._build_path if self._build_path else self.repo.get_build_path()
+
+    def isolate(self, folder):
+        """
+        Use the build folder named folder for this version, so it can be checked out and compiled while another
+        version of the same repository is in use in another folder. Only for methods that can check out a version
+        in any folder.
+        """
+        if self.repo.url and self.repo.method.isolated_checkout:
+            # Absolute, as tests change the working directory while this build may be compiling
+            self._build_path = os.path.abspath(self.repo.get_isolated_build_path(folder)) + '/'
+
+    def activate(self):
+        """
+        Make the repository use the build folder of this build, so the test finds its binaries
+        """
+        if self._build_path:
+            self.repo._build_path = self._build_path
+        self.repo._current_build = self
 
     def checkout(self,quiet = False):
         if not self.repo.url:
             return True
-        if not self.repo.method.checkout(self.version):
+        if self._build_path:
+            if not self.repo.method.checkout(self.version, path=self._build_path):
+                return False
+        elif not self.repo.method.checkout(self.version):
             return False
         self.__write_file(self.build_path() + '/.checkout_version', self.version)
         return True
 
     def get_build_version(self):
-        c_ver = Build.__read_file(self.repo.get_build_path() + '/.checkout_version')
+        c_ver = Build.__read_file(self.build_path() + '/.checkout_version')
         return c_ver
 
     def is_checkout_needed(self):
@@ -226,30 +252,37 @@ class Build:
 
 
     def is_compile_needed(self):
-        bin_path=npf.replace_path(self.repo.get_local_bin_path(self.version),build=self)
+        bin_path=npf.replace_path(self.repo.get_local_bin_path(self.version, build_path=self.build_path()),build=self)
+        current = Build.get_current_version(self.repo, build_path=self.build_path())
         if not os.path.exists(bin_path):
             return "could not find %s" % bin_path
-        elif not Build.get_current_version(self.repo) == self.version:
-            return "current version is %s, the newest is %s" % (Build.get_current_version(self.repo), self.version)
+        elif not current == self.version:
+            return "current version is %s, the newest is %s" % (current, self.version)
         else:
             return None
 
-    def compile(self, quiet = False, show_cmd = False):
+    def compile(self, quiet = False, show_cmd = False, use_cache = True, jobs = None):
         """
         Compile the currently checked out repo, assuming it is currently at self.version
+        :param jobs: Number of parallel jobs given to make, instead of the -j of the repository's make command
         :return: True upon success, False if not
         """
         if not self.repo.url:
             return True
-        pwd = os.getcwd()
-        os.chdir(self.build_path())
+
+        cache = ArtifactCache.get(self.repo.options)
+        if cache and use_cache and cache.restore(self):
+            if not quiet:
+                print("Restored %s from the build cache" % self.version)
+            self.__write_file(Build.__get_build_version_path(self.repo, self.build_path()), self.version)
+            return True
 
         if self.repo.build_info:
             print(self.repo.build_info)
 
         for what,command in [("Configuring %s..." % self.version,npf.replace_path(self.repo.configure,build=self)),
                              ("Cleaning %s..." % self.version,npf.replace_path(self.repo.clean,build=self)),
-                             ("Building %s..." % self.version,npf.replace_path(self.repo.make,build=self))]:
+                             ("Building %s..." % self.version,Build.set_jobs(npf.replace_path(self.repo.make,build=self), jobs))]:
             if not command:
                 continue
             if not quiet:
@@ -258,7 +291,8 @@ class Build:
                 print(command)
             env = os.environ.copy()
             env.update(self.repo.env)
-            p = subprocess.Popen(command, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, env=env)
+            # Do not change the working directory of NPF, a test may be running while another version builds
+            p = subprocess.Popen(command, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, env=env, cwd=self.build_path())
             output, err = [x.decode() for x in p.communicate()]
             p.wait()
             if not p.returncode == 0:
@@ -267,16 +301,23 @@ class Build:
                 print(output)
                 print("stderr :")
                 print(err)
-                self.__write_file('.build_version', '')
-                os.chdir(pwd)
+                self.__write_file(Build.__get_build_version_path(self.repo, self.build_path()), '')
                 print("Compilation of %s FAILED. Check the log above, or look at the source at %s" % (self.repo.pretty_name(), self.build_path()) )
                 return False
 
-        os.chdir(pwd)
-        self.__write_file(Build.__get_build_version_path(self.repo), self.version)
+        if cache:
+            cache.store(self)
+        self.__write_file(Build.__get_build_version_path(self.repo, self.build_path()), self.version)
         return True
 
-    def build(self, force_build : bool = False, never_build : bool = False, quiet_build : bool = False, show_build_cmd : bool = False, executor=None):
+    def build(self, force_build : bool = False, never_build : bool = False, quiet_build : bool = False, show_build_cmd : bool = False, executor=None, activate : bool = True, jobs : int = None, checkout_only : bool = False):
+        # A build forced with --force-build is really compiled again, not restored from the cache
+        use_cache = force_build is not True
+        if self.prebuilt:
+            # Already built ahead by a BuildPipeline, with the same options
+            if activate:
+                self.activate()
+            return True
         if force_build or self.is_checkout_needed():
             if self.get_build_version() == None:
                 force_build = "it is the first checkout"
@@ -289,32 +330,48 @@ class Build:
                 print("Checking out %s" % (self.repo.name))
             if not self.checkout(quiet_build):
                 return False
+        if checkout_only:
+            # Compiled elsewhere, such as on the nodes with remote_build
+            if activate:
+                self.activate()
+            return True
         reason = self.is_compile_needed()
         if force_build or (reason != None):
             if never_build:
                 print("Warning : version changed but you disallowed build. Test will be done with an unknown state of build")
-                self.repo._current_build = self
+                if activate:
+                    self.activate()
                 return True
             if not quiet_build and self.repo.name != "Local":
                 print("Building %s (because %s)" % (self.repo.name, "you force the build with --force-build" if force_build is True else reason if not force_build else force_build ))
-            if not self.compile(quiet_build, show_build_cmd):
+            if not self.compile(quiet_build, show_build_cmd, use_cache=use_cache, jobs=jobs):
                 return False
-        self.repo._current_build = self
+        if activate:
+            self.activate()
         return True
 
     def get_local_bin_folder(self):
-        return self.repo.get_local_bin_folder(version=self.version)
+        return self.repo.get_local_bin_folder(version=self.version, build_path=self._build_path)
 
     def get_remote_bin_folder(self, node):
-        return self.repo.get_remote_bin_folder(version=self.version, remote=node)
+        return self.repo.get_remote_bin_folder(version=self.version, remote=node, build_path=self._build_path)
 
     def __str__(self):
         return "Build(repo = %s, version = %s)" % (self.repo,self.version)
 
     @staticmethod
-    def get_current_version(repo):
-        return Build.__read_file(Build.__get_build_version_path(repo))
+    def set_jobs(command, jobs):
+        """Replace the number of jobs of a make command, if it gives one with -j. The number may be computed by the
+        shell, such as -j $(nproc) or -j$JOBS"""
+        if not jobs or not command:
+            return command
+        return re.sub(r'(?<![\w-])-j(\s*([0-9]+|\$\((?:[^()]|\((?:[^()]|\([^()]*\))*\))*\)|\$\{\w+\}|\$\w+|`[^`]*`))?(?![\w-])',
+                      '-j%d' % jobs, command)
+
+    @staticmethod
+    def get_current_version(repo, build_path=None):
+        return Build.__read_file(Build.__get_build_version_path(repo, build_path))
 
     @staticmethod
-    def __get_build_version_path(repo):
-        return repo.get_build_path() + '/.build_version'
+    def __get_build_version_path(repo, build_path=None):
+        return (build_path if build_path else repo.get_build_path()) + '/.build_version'
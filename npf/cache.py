@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from npf import npf
+
+
+class ArtifactCache:
+    """Keep the bin folder of past builds, so going back to a version already built restores its binaries
+    instead of compiling it again. Entries are keyed by everything that changes the outcome of a build : the
+    repository, the version and the build commands, environment and tags, but not the versions of the libraries
+    the binaries were built against, which is why the cache is disabled by default. The least recently used
+    entries are evicted when the cache grows beyond max_size bytes."""
+
+    _instances = {}
+    # Files of the bin folder that belong to the checkout rather than to the build, never cached nor replaced
+    CHECKOUT = ('.git', '.build_version', '.checkout_version')
+
+    def __init__(self, path, max_size):
+        self.path = os.path.join(path, '')
+        self.max_size = max_size
+
+    @classmethod
+    def get(cls, options):
+        """The cache configured by --build-cache, or None if it is disabled"""
+        size = getattr(options, 'build_cache', None)
+        if not size or size == '0':
+            return None
+        path = npf.get_build_path() + '.cache'
+        if path not in cls._instances:
+            cls._instances[path] = ArtifactCache(path, npf.parseUnit(size))
+        return cls._instances[path]
+
+    @staticmethod
+    def key(build) -> str:
+        repo = build.repo
+        identity = [repo.reponame, repo.url, build.version, repo.configure, repo.clean, repo.make, repo.bin_folder,
+                    sorted(repo.env.items()), sorted(repo.tags)]
+        return hashlib.sha256(json.dumps(identity, default=str).encode()).hexdigest()[:32]
+
+    def _entry(self, key):
+        return self.path + key
+
+    def _entries(self):
+        """All complete entries with their size and last use, least recently used first"""
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        for key in os.listdir(self.path):
+            meta = os.path.join(self._entry(key), 'meta.json')
+            if not os.path.exists(meta):
+                continue
+            with open(meta) as f:
+                size = json.load(f).get('size', 0)
+            entries.append((os.path.getmtime(meta), key, size))
+        return sorted(entries)
+
+    def restore(self, build) -> bool:
+        """Replace the bin folder of build by its cached binaries
+        :return: True if the build was in the cache
+        """
+        entry = self._entry(self.key(build))
+        meta = os.path.join(entry, 'meta.json')
+        if not os.path.exists(meta):
+            return False
+        dst = build.get_local_bin_folder()
+        os.makedirs(dst, exist_ok=True)
+        # The files of another version must not survive the restore
+        for name in os.listdir(dst):
+            if name in self.CHECKOUT:
+                continue
+            path = os.path.join(dst, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        src = os.path.join(entry, 'bin')
+        for name in os.listdir(src):
+            path = os.path.join(src, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.copytree(path, os.path.join(dst, name), symlinks=True)
+            else:
+                shutil.copy2(path, os.path.join(dst, name), follow_symlinks=False)
+        # The modification time of the metadata is the last use, for the LRU eviction
+        os.utime(meta)
+        return True
+
+    def store(self, build):
+        """Copy the bin folder of a successful build in the cache, then evict old entries if needed"""
+        src = build.get_local_bin_folder()
+        if not os.path.isdir(src):
+            return
+        key = self.key(build)
+        entry = self._entry(key)
+        tmp = "%s.tmp-%d" % (entry, os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        try:
+            shutil.copytree(src, os.path.join(tmp, 'bin'), symlinks=True,
+                            ignore=shutil.ignore_patterns(*self.CHECKOUT))
+        except (OSError, shutil.Error) as e:
+            print("Could not cache the binaries of %s : %s" % (build.version, e))
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(tmp):
+            size += sum(os.lstat(os.path.join(dirpath, f)).st_size for f in filenames)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'repo': build.repo.reponame, 'version': build.version, 'size': size, 'time': time.time()}, f)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.rename(tmp, entry)
+        self.evict()
+
+    def evict(self):
+        entries = self._entries()
+        total = sum(size for t, key, size in entries)
+        for t, key, size in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
@@ -0,0 +1,162 @@
+import itertools
+import mmap
+import os
+import re
+
+
+class Capture:
+    """
+    The output of a script or of a run. Only its last characters are kept in memory : once it is larger than limit,
+    the whole output is written to a file, which results are then parsed from with mmap. It can be given to another
+    process, the file being shared, as long as only one of them writes at a time.
+    """
+
+    LIMIT = 1 << 20
+    # What is printed of an output when something went wrong in quiet mode
+    TAIL = 4096
+    CHUNK = 1 << 20
+
+    _ids = itertools.count()
+
+    def __init__(self, folder, name, limit=None):
+        """
+        :param folder: Where the output is written if it is too large, created if needed
+        :param name: Name of the file, made unique for the process
+        """
+        self.path = os.path.join(os.path.abspath(folder), '%s-%d-%d' % (name, os.getpid(), next(Capture._ids)))
+        self.limit = limit if limit is not None else Capture.LIMIT
+        self.size = 0
+        self.spilled = False
+        self._chunks = []
+        self._len = 0
+        self._f = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._f:
+            self._f.flush()
+        state['_f'] = None
+        return state
+
+    def __iadd__(self, other):
+        if isinstance(other, Capture):
+            for chunk in other.chunks():
+                self._append(chunk)
+        else:
+            self._append(other)
+        return self
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return ''.join(self.chunks())
+
+    def _file(self):
+        if self._f is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._f = open(self.path, 'a', encoding='utf-8', errors='replace')
+        return self._f
+
+    def _keep(self, n):
+        """Keep the last n characters in memory"""
+        if self._len > n:
+            text = ''.join(self._chunks)[-n:]
+            self._chunks = [text]
+            self._len = len(text)
+
+    def _append(self, s):
+        if not s:
+            return
+        self.size += len(s)
+        if not self.spilled and self._len + len(s) > self.limit:
+            self._file().write(''.join(self._chunks))
+            self.spilled = True
+        if self.spilled:
+            self._file().write(s)
+        self._chunks.append(s)
+        self._len += len(s)
+        # Trimmed once the memory holds twice the limit, so appending a line does not copy the whole tail
+        if self.spilled and self._len > 2 * self.limit:
+            self._keep(self.limit)
+
+    def chunks(self):
+        """The content of the output, read from its file if needed"""
+        if not self.spilled:
+            yield ''.join(self._chunks)
+            return
+        if self._f:
+            self._f.flush()
+        try:
+            with open(self.path, encoding='utf-8', errors='replace') as f:
+                for chunk in iter(lambda: f.read(self.CHUNK), ''):
+                    yield chunk
+        except FileNotFoundError:
+            yield self.tail()
+
+    def tail(self, n=None) -> str:
+        """The last n characters of the output, preceded by a note if there is more"""
+        n = n if n is not None else Capture.TAIL
+        text = ''.join(self._chunks)[-n:]
+        if self.size > len(text):
+            where = (', the full output is in %s' % self.path) if self.spilled else ''
+            return "[... %d characters before%s]\n%s" % (self.size - len(text), where, text)
+        return text
+
+    def close(self):
+        """The output is complete, only its tail is kept in memory"""
+        if not self.spilled and self.size > Capture.TAIL:
+            self._file().write(''.join(self._chunks))
+            self.spilled = True
+        if self.spilled:
+            self._keep(Capture.TAIL)
+        if self._f:
+            self._f.close()
+            self._f = None
+
+    def discard(self):
+        """The output is not needed anymore"""
+        self.close()
+        if self.spilled and os.path.exists(self.path):
+            os.unlink(self.path)
+        self._chunks = []
+        self._len = 0
+
+    def finditer(self, pattern, flags=0):
+        """Like re.finditer on the stripped output, a spilled output being scanned in its file"""
+        if not self.spilled:
+            yield from re.finditer(pattern, ''.join(self._chunks).strip(), flags)
+            return
+        if self._f:
+            self._f.flush()
+        if os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if pattern.isascii():
+                for match in re.finditer(pattern.encode(), m, flags):
+                    yield DecodedMatch(match)
+            else:
+                # A non-ASCII pattern cannot be matched on bytes, the file is scanned line by line instead
+                for line in iter(m.readline, b''):
+                    yield from re.finditer(pattern, line.decode(errors='replace'), flags)
+
+
+class DecodedMatch:
+    """A match on the bytes of a file, giving its groups as strings"""
+
+    def __init__(self, match):
+        self.match = match
+
+    def group(self, *args):
+        g = self.match.group(*args)
+        return g.decode(errors='replace') if isinstance(g, bytes) else g
+
+
+def tail(output, n=None) -> str:
+    """The end of the output of a script, which may be a Capture or a string"""
+    if isinstance(output, Capture):
+        return output.tail(n)
+    n = n if n is not None else Capture.TAIL
+    if len(output) > n:
+        return "[... %d characters before]\n%s" % (len(output) - n, output[-n:])
+    return output
@@ -0,0 +1,125 @@
+import atexit
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class Console:
+    """
+    Prints the output of the scripts from a thread of its own, so printing never slows down the executors. Lines are
+    given through a bounded queue, and the lines waiting are printed together, grouped by script. A script printing
+    more than rate lines per second only gets the first ones printed, and its results, followed by the number of lines
+    not shown. If the queue is full, lines are dropped and counted instead of waiting. There is one console per
+    process.
+    """
+
+    QUEUE = 10000
+    # Lines always printed, whatever the rate
+    KEEP = re.compile(r'RESULT|EVENT')
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, rate=0, out=None):
+        """
+        :param rate: Number of lines printed per second for each script, 0 for no limit
+        """
+        self.rate = rate
+        self.out = out if out is not None else sys.stdout
+        self.pid = os.getpid()
+        self.queue = queue.Queue(maxsize=self.QUEUE)
+        self.dropped = OrderedDict()
+        self.dropped_lock = threading.Lock()
+        # For each title, the start of its current second, the lines printed and the lines not shown during it
+        self.windows = {}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def get(cls) -> 'Console':
+        """The console of this process, forked processes creating their own"""
+        with cls._lock:
+            if cls._instance is None or cls._instance.pid != os.getpid():
+                from npf import npf
+                rate = getattr(npf.options, 'console_rate', 0) if npf.options else 0
+                cls._instance = Console(rate)
+                atexit.register(cls._instance.flush)
+            return cls._instance
+
+    def write(self, title, line):
+        """Print line after title, without ever waiting"""
+        try:
+            self.queue.put_nowait((title, line))
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped[title] = self.dropped.get(title, 0) + 1
+
+    def flush(self, timeout=1):
+        """Wait for the lines given so far to be printed, for at most timeout seconds"""
+        if not self.thread.is_alive():
+            return
+        done = threading.Event()
+        try:
+            self.queue.put((None, done), timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def _summary(self, title, window):
+        return "%s ... %d lines not shown" % (title, window[2])
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.QUEUE:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            now = time.time()
+            blocks = OrderedDict()
+            flushed = []
+            for title, line in items:
+                if title is None:
+                    flushed.append(line)
+                    continue
+                lines = blocks.setdefault(title, [])
+                window = self.windows.get(title, None)
+                if window is None or now - window[0] >= 1:
+                    if window is not None and window[2]:
+                        lines.append(self._summary(title, window))
+                    window = [now, 0, 0]
+                    self.windows[title] = window
+                if self.rate and window[1] >= self.rate and not self.KEEP.search(line):
+                    window[2] += 1
+                    continue
+                window[1] += 1
+                lines.append(title + ' ' + line)
+
+            if flushed:
+                # Everything given before is printed, even the count of the lines not shown yet
+                for title, window in self.windows.items():
+                    if window[2]:
+                        blocks.setdefault(title, []).append(self._summary(title, window))
+                        window[2] = 0
+            with self.dropped_lock:
+                dropped, self.dropped = self.dropped, OrderedDict()
+            for title, n in dropped.items():
+                blocks.setdefault(title, []).append("%s ... %d lines dropped, the console could not keep up" % (title, n))
+
+            text = ''.join(line + '\n' for lines in blocks.values() for line in lines)
+            if text:
+                try:
+                    self.out.write(text)
+                    self.out.flush()
+                except UnicodeEncodeError:
+                    self.out.write("Lines ignored due to invalid encoding\n")
+                except (OSError, ValueError):
+                    pass
+            for done in flushed:
+                done.set()
@@ -0,0 +1,62 @@
+import math
+import warnings
+from itertools import combinations
+
+import numpy as np
+
+
+def latin_hypercube(n, d, seed):
+    from scipy.stats import qmc
+    return qmc.LatinHypercube(d=d, seed=seed).random(n)
+
+
+def sobol(n, d, seed):
+    from scipy.stats import qmc
+    sampler = qmc.Sobol(d=d, seed=seed)
+    with warnings.catch_warnings():
+        # Sobol sequences are only balanced for powers of 2, any other size is still fine for us
+        warnings.simplefilter('ignore', UserWarning)
+        return sampler.random(n)
+
+
+def halton(n, d, seed):
+    from scipy.stats import qmc
+    return qmc.Halton(d=d, seed=seed).random(n)
+
+
+def fractional_factorial(n, d, seed=None):
+    """Two-level fractional factorial design, with levels 0 and 1. The number of runs is the smallest
+    power of 2 that is at least n and can hold d factors. The first factors form a full factorial,
+    each of the others is aliased with the interaction of several of them, highest order first."""
+    k = min(max(1, math.ceil(math.log2(max(n, d + 1, 2)))), d)
+    runs = np.array([[(i >> j) & 1 for j in range(k)] for i in range(2 ** k)])
+    interactions = []
+    for order in range(k, 1, -1):
+        interactions.extend(combinations(range(k), order))
+    if d - k > len(interactions):
+        raise Exception("Cannot build a fractional factorial design of %d factors in %d runs" % (d, 2 ** k))
+    columns = [runs[:, j] for j in range(k)]
+    for generator in interactions[:d - k]:
+        columns.append(np.bitwise_xor.reduce(runs[:, list(generator)], axis=1))
+    return np.array(columns, dtype=float).T
+
+
+GENERATORS = {
+    'lhs': latin_hypercube,
+    'sobol': sobol,
+    'halton': halton,
+    'fracfact': fractional_factorial,
+}
+
+
+def generate(method, n, d, seed=0):
+    """A design of n points (rows) in d dimensions (columns), each coordinate in [0,1]"""
+    if method not in GENERATORS:
+        raise Exception("Unknown experimental design %s, choose one of %s" % (method, ', '.join(GENERATORS.keys())))
+    if d == 0:
+        return np.zeros((n, 0))
+    return GENERATORS[method](n, d, seed)
+
+
+def default_points(d):
+    return 10 * max(d, 1)
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import tarfile
+import threading
+import urllib.request
+from urllib.parse import urlparse
+
+from npf import npf
+
+
+def parse_checksum(checksum):
+    """Split a checksum given as algorithm:digest, sha256 being the default algorithm"""
+    if not checksum:
+        return None, None
+    algorithm, sep, digest = str(checksum).rpartition(':')
+    algorithm = algorithm.lower() if sep else 'sha256'
+    if algorithm not in hashlib.algorithms_available:
+        raise Exception("Unknown checksum algorithm %s" % algorithm)
+    return algorithm, digest.lower()
+
+
+def open_url(url):
+    """Open an URL for reading, file:// URLs and local paths being read directly"""
+    if not urlparse(url).scheme:
+        return open(url, 'rb')
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+    opener.addheaders = [('User-Agent', 'NPF')]
+    return opener.open(url)
+
+
+class DownloadCache:
+    """Archives downloaded by repositories using the get method, stored by the sha256 of their content in
+    build/.downloads/. An index remembers the content of each URL, so getting an URL again, for another build or
+    another version of the build folder, never touches the network. A checksum can be given to verify the content.
+    A sha256 checksum directly names the archive in the cache, other algorithms are checked on every use."""
+
+    CHUNK = 1 << 20
+
+    def __init__(self, path=None):
+        self.path = os.path.join(path if path else npf.get_build_path() + '.downloads', '')
+        self.index_file = self.path + 'index.json'
+
+    def _index(self) -> dict:
+        if not os.path.exists(self.index_file):
+            return {}
+        with open(self.index_file) as f:
+            return json.load(f)
+
+    def _object(self, sha256):
+        return self.path + sha256
+
+    def lookup(self, url, checksum=None):
+        """The cached archive of url, or None"""
+        algorithm, digest = parse_checksum(checksum)
+        sha256 = digest if algorithm == 'sha256' else self._index().get(url, None)
+        if not sha256 or not os.path.exists(self._object(sha256)):
+            return None
+        if algorithm and algorithm != 'sha256':
+            h = hashlib.new(algorithm)
+            with open(self._object(sha256), 'rb') as f:
+                for chunk in iter(lambda: f.read(self.CHUNK), b''):
+                    h.update(chunk)
+            if h.hexdigest() != digest:
+                return None
+        return self._object(sha256)
+
+    def get(self, url, checksum=None, extract_to=None) -> str:
+        """
+        The archive of url, downloaded if it is not in the cache yet
+        :param extract_to: Also extract the archive in that folder. Without checksum, a downloaded archive is extracted
+                           while it is received instead of after.
+        :return: The path of the archive in the cache
+        """
+        filename = self.lookup(url, checksum)
+        if filename:
+            if extract_to:
+                extract(filename, extract_to)
+            return filename
+
+        algorithm, digest = parse_checksum(checksum)
+        os.makedirs(self.path, exist_ok=True)
+        tmp = "%s.tmp-%d-%d" % (self.path, os.getpid(), threading.get_ident())
+        sha256 = hashlib.sha256()
+        h = hashlib.new(algorithm) if algorithm else None
+        streamed = extract_to and not checksum
+        pipe = StreamedExtraction(extract_to) if streamed else None
+        try:
+            with open_url(url) as src, open(tmp, 'wb') as dst:
+                for chunk in iter(lambda: src.read(self.CHUNK), b''):
+                    dst.write(chunk)
+                    sha256.update(chunk)
+                    if h:
+                        h.update(chunk)
+                    if pipe:
+                        pipe.write(chunk)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        finally:
+            if pipe:
+                pipe.close()
+        if h and h.hexdigest() != digest:
+            os.unlink(tmp)
+            raise Exception("Checksum mismatch for %s : expected %s, got %s" % (url, digest, h.hexdigest()))
+
+        filename = self._object(sha256.hexdigest())
+        os.replace(tmp, filename)
+        index = self._index()
+        index[url] = sha256.hexdigest()
+        with open(self.index_file + '.tmp', 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(self.index_file + '.tmp', self.index_file)
+        if extract_to and not streamed:
+            extract(filename, extract_to)
+        return filename
+
+
+def extract(filename, path):
+    """Extract a tar archive, reading it sequentially"""
+    with open(filename, 'rb') as f:
+        with tarfile.open(fileobj=f, mode='r|*') as t:
+            t.extractall(path)
+
+
+class StreamedExtraction:
+    """Extract a tar archive in a thread while its content is given with write()"""
+
+    def __init__(self, path):
+        r, w = os.pipe()
+        self._w = os.fdopen(w, 'wb')
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(os.fdopen(r, 'rb'), path))
+        self._thread.start()
+
+    def _run(self, src, path):
+        try:
+            with tarfile.open(fileobj=src, mode='r|*') as t:
+                t.extractall(path)
+        except Exception as e:
+            self._error = e
+        finally:
+            # Drain the pipe so that the writer is never blocked, by an error or the padding after the archive
+            for chunk in iter(lambda: src.read(DownloadCache.CHUNK), b''):
+                pass
+            src.close()
+
+    def write(self, chunk):
+        self._w.write(chunk)
+
+    def close(self):
+        self._w.close()
+        self._thread.join()
+        if self._error:
+            raise self._error
@@ -0,0 +1,377 @@
+import asyncio
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict
+
+from npf import trace
+from npf.console import Console
+from npf.executor.localexecutor import LocalExecutor, LocalKiller
+from npf.executor.sshexecutor import RemoteKiller, AgentKiller
+
+
+def kill_all(killers, hardkill=5000):
+    """
+    Kill the scripts of killers all at once. They are sent SIGTERM, and SIGKILL if they are still alive after hardkill
+    milliseconds. The scripts of a remote node are killed through a single SSH channel.
+    """
+    deadline = time.time() + float(hardkill) / 1000
+
+    remotes = OrderedDict()
+    for killer in killers:
+        if isinstance(killer, RemoteKiller):
+            remotes.setdefault((type(killer), killer.node()), []).append(killer)
+    threads = [threading.Thread(target=cls.kill_all, args=(node_killers, float(hardkill) / 1000))
+               for (cls, node), node_killers in remotes.items()]
+    for thread in threads:
+        thread.start()
+
+    local = [killer for killer in killers if isinstance(killer, LocalKiller)]
+    for killer in local:
+        try:
+            killer.terminate()
+        except OSError:
+            pass
+    for killer in LocalKiller.wait_all(local, deadline):
+        try:
+            killer.kill()
+        except OSError:
+            pass
+    for thread in threads:
+        thread.join()
+
+
+class AsyncEventBus:
+    """The EventBus of the scripts of a run, for the scripts running in a single event loop"""
+
+    def __init__(self):
+        self.list = []
+        self.terminated = asyncio.Event()
+        self._changed = asyncio.Event()
+
+    def post(self, ev):
+        self.list.append(ev)
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def terminate(self):
+        self.terminated.set()
+        self._changed.set()
+
+    def is_terminated(self):
+        return self.terminated.is_set()
+
+    async def wait_for_termination(self, t):
+        try:
+            await asyncio.wait_for(self.terminated.wait(), t)
+        except asyncio.TimeoutError:
+            pass
+
+    async def listen(self, ev):
+        while ev not in self.list and not self.is_terminated():
+            await self._changed.wait()
+
+
+class AsyncEngine:
+    """
+    Run all the scripts of a run as coroutines of a single event loop, instead of a process per script. Local scripts
+    are subprocesses of the loop started from an explicit folder, and the scripts of a remote node share a single SSH
+    connection, each one in a channel of its own. Delays, waitfor, autokill and timeouts are handled by the loop.
+    run() gives the same tuples as _parallel_exec.
+    """
+
+    CHUNK = 65536
+    # Time given to the scripts to flush their output when the run is terminated, like the last turn of the executors
+    FLUSH = 0.2
+
+    def __init__(self, options, cwd):
+        self.options = options
+        self.cwd = cwd
+        self.bus = None
+        self.killers = []
+        self.connections = {}
+        self.autokill = {}
+
+    def run(self, params, autokill=()):
+        """
+        Run the scripts given by params
+        :param autokill: The [count, params] of the scripts that terminate the run when they all finished
+        :return: A (worked, stdout, stderr, return code, script) tuple for each script
+        """
+        return asyncio.run(self._run(params, autokill))
+
+    async def _run(self, params, autokill):
+        from npf import npf
+
+        self.bus = AsyncEventBus()
+        self.killers = []
+        self.autokill = {}
+        for group in autokill:
+            remaining = [group[0]]
+            for param in group[1]:
+                self.autokill[id(param)] = remaining
+        try:
+            return await asyncio.gather(*[self._script(param, npf.nodes_for_role(param.role)[param.role_id])
+                                          for param in params])
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            self.bus.terminate()
+            kill_all(self.killers, 0)
+            raise
+        finally:
+            for ssh in self.connections.values():
+                ssh.close()
+            self.connections = {}
+            Console.get().flush()
+
+    async def _script(self, param, node):
+        # Each script is a task of its own, with its own track in the trace
+        with trace.track("%s on %s" % (param.name, node.get_name())):
+            return await self._script_exec(param, node)
+
+    async def _script_exec(self, param, node):
+        executor = node.executor
+        for wf in param.waitfor if type(param.waitfor) is list else [param.waitfor]:
+            if wf is None:
+                continue
+            n = 1
+            if wf[0].isdigit():
+                n = int(wf[0])
+                wf = wf[1:]
+            for i in range(n):
+                with trace.span("waitfor " + wf, "event"):
+                    await self.bus.listen(wf)
+                trace.instant("receive " + wf, "event", script=param.name, node=node.get_name())
+
+        if param.delay:
+            with trace.span("delay"):
+                await self.bus.wait_for_termination(param.delay)
+        if self.bus.is_terminated():
+            if param.options.debug:
+                print("[DEBUG] Script %s killed before its execution" % param.name)
+            return 1, 'Killed before execution', 'Killed before execution', 0, param.script
+
+        with trace.span("exec", script=param.name, node=node.get_name()):
+            if isinstance(executor, LocalExecutor):
+                pid, o, e, c = await self._local(param, executor)
+            elif executor.agent:
+                pid, o, e, c = await self._agent(param, executor)
+            else:
+                pid, o, e, c = await self._remote(param, executor)
+
+        if pid == 0:
+            return False, o, e, c, param.script
+        remaining = self.autokill.get(id(param), None)
+        if remaining is not None:
+            if param.options.debug:
+                print("[DEBUG] Script %s finished, killing all other scripts" % param.name)
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                await self.terminate(param.hardkill)
+        elif param.options.debug:
+            print("[DEBUG] Script %s finished, autokill=false so it will not terminate the other scripts." % param.name)
+        return True, o, e, c, param.script
+
+    async def terminate(self, hardkill):
+        with trace.span("autokill"):
+            self.bus.terminate()
+            await asyncio.get_running_loop().run_in_executor(None, kill_all, list(self.killers), hardkill)
+
+    def _output(self, executor, title, outputs, i, data, end=False):
+        """Add data received on the channel i of a script to its outputs, line by line"""
+        lines = (outputs[2 + i] + data).split(b'\n')
+        # The last line is not complete yet, or not terminated at the end of the output
+        last = lines.pop()
+        outputs[2 + i] = b'' if end else last
+        lines = [line + b'\n' for line in lines] + ([last] if end and last else [])
+        for line in lines:
+            line = line.decode(errors='replace')
+            outputs[i] += line
+            executor.searchEvent(line, self.bus, title)
+            if self.options and not self.options.quiet:
+                executor._print(title, line.rstrip(), True)
+
+    async def _local(self, param, executor):
+        title = param.name if param.name else "local"
+        cmd, env = executor.command(param.commands, self.cwd, bin_paths=param.bin_paths, options=param.options,
+                                    sudo=param.sudo, env=param.env, virt=param.virt)
+        p = await asyncio.create_subprocess_shell(cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                                                  stderr=asyncio.subprocess.PIPE, cwd=self.cwd, env=env,
+                                                  start_new_session=True)
+        self.killers.append(LocalKiller(p.pid))
+        outputs = (list(param.capture) if param.capture else ['', '']) + [b'', b'']
+
+        async def read(stream, i):
+            while True:
+                data = await stream.read(self.CHUNK)
+                if not data:
+                    self._output(executor, title, outputs, i, b'', end=True)
+                    return
+                self._output(executor, title, outputs, i, data)
+
+        finished = asyncio.ensure_future(asyncio.gather(p.wait(), read(p.stdout, 0), read(p.stderr, 1)))
+        # It is cancelled when the script is killed or expires
+        finished.add_done_callback(lambda f: f.cancelled() or f.exception())
+        terminated = asyncio.ensure_future(self.bus.terminated.wait())
+        try:
+            done, _ = await asyncio.wait([finished, terminated], timeout=param.timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                print("Test expired")
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                return 0, outputs[0], outputs[1], None
+            if finished not in done:
+                # The other scripts kill this one, its output is flushed for a last turn
+                await asyncio.wait([finished], timeout=self.FLUSH)
+                return p.pid, outputs[0], outputs[1], 0
+            return p.pid, outputs[0], outputs[1], 0 if self.bus.is_terminated() else p.returncode
+        finally:
+            finished.cancel()
+            terminated.cancel()
+            p.stdin.close()
+
+    def _connection(self, executor):
+        """One connection per node for all the scripts of the run"""
+        key = (executor.user, executor.addr, executor.port)
+        if key not in self.connections:
+            self.connections[key] = executor.get_connection(cache=False)
+        return self.connections[key]
+
+    async def _remote(self, param, executor):
+        import paramiko
+        import socket
+
+        title = executor.addr + ' - ' + param.name if param.name else executor.addr
+        cmd = executor.command(param.commands, bin_paths=param.bin_paths, options=param.options, stdin=param.stdin,
+                               sudo=param.sudo, testdir=param.testdir, env=param.env, virt=param.virt)
+        loop = asyncio.get_running_loop()
+        try:
+            ssh = self._connection(executor)
+            chan = ssh.get_transport().open_session()
+            chan.exec_command(cmd)
+        except (socket.gaierror, paramiko.ssh_exception.SSHException) as e:
+            print("Error while connecting to %s" % executor.addr)
+            print(e)
+            return 0, '', '', -1
+        if param.stdin is not None:
+            chan.sendall(param.stdin)
+
+        # The channel gives a file descriptor that is readable when it receives data or closes
+        ready = asyncio.Event()
+        loop.add_reader(chan.fileno(), ready.set)
+        # Like SSHExecutor.exec, the stderr of a node is part of its stdout
+        outputs = (list(param.capture) if param.capture else ['', '']) + [b'', b'']
+        rpid = [None]
+        pid = os.getpid()
+
+        def receive():
+            while chan.recv_ready() or chan.recv_stderr_ready():
+                data = chan.recv(self.CHUNK) if chan.recv_ready() else chan.recv_stderr(self.CHUNK)
+                if rpid[0] is None:
+                    line, sep, data = (outputs[2] + data).partition(b'\n')
+                    if not sep:
+                        outputs[2] = line
+                        continue
+                    outputs[2] = b''
+                    rpid[0] = int(line)
+                    self.killers.append(RemoteKiller(executor.user, executor.addr, executor.port, rpid[0]))
+                self._output(executor, title, outputs, 0, data)
+
+        deadline = loop.time() + param.timeout if param.timeout is not None else None
+        try:
+            while not chan.exit_status_ready() or chan.recv_ready() or chan.recv_stderr_ready():
+                if self.bus.is_terminated():
+                    break
+                ready.clear()
+                receive()
+                if chan.exit_status_ready() and not (chan.recv_ready() or chan.recv_stderr_ready()):
+                    break
+                wait = [asyncio.ensure_future(ready.wait()), asyncio.ensure_future(self.bus.terminated.wait())]
+                timeout = max(0, deadline - loop.time()) if deadline is not None else None
+                done, pending = await asyncio.wait(wait, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for future in pending:
+                    future.cancel()
+                if not done:
+                    self.bus.terminate()
+                    pid = 0
+                    break
+            receive()
+            self._output(executor, title, outputs, 0, b'', end=True)
+            if self.bus.is_terminated():
+                if not chan.closed:
+                    chan.send(chr(3))
+                # The killers kill it with the other scripts of the node, this is only a fallback
+                for i in range(20):
+                    if chan.exit_status_ready():
+                        break
+                    await asyncio.sleep(0.05)
+                if not chan.exit_status_ready() and rpid[0] is not None:
+                    ssh.exec_command("kill " + str(rpid[0]))
+                return pid, outputs[0], outputs[1], 0
+            return pid, outputs[0], outputs[1], chan.recv_exit_status()
+        finally:
+            loop.remove_reader(chan.fileno())
+            chan.close()
+
+    async def _agent(self, param, executor):
+        """A script of a node using an agent, the replies of the agent being given to the loop by its reader thread"""
+        from npf.executor.agentclient import AgentClient
+
+        title = executor.addr + ' - ' + param.name if param.name else executor.addr
+        cmd = executor.command(param.commands, bin_paths=param.bin_paths, options=param.options, stdin=param.stdin,
+                               sudo=param.sudo, testdir=param.testdir, env=param.env, virt=param.virt, raw=True,
+                               pid=False)
+        loop = asyncio.get_running_loop()
+        replies = asyncio.Queue()
+        try:
+            client = await loop.run_in_executor(None, AgentClient.get, executor)
+            client.request('exec', lambda msg: loop.call_soon_threadsafe(replies.put_nowait, msg), cmd=cmd,
+                           stdin=param.stdin,
+                           filter=AgentClient.FILTER if self.options.quiet and getattr(self.options, 'agent_filter', False) else None)
+        except Exception as e:
+            print("Error while connecting to the agent of %s" % executor.addr)
+            print(e)
+            return 0, '', '', -1
+
+        outputs = (list(param.capture) if param.capture else ['', '']) + [b'', b'']
+        rpid = None
+        pid = os.getpid()
+        deadline = loop.time() + param.timeout if param.timeout is not None else None
+        terminated = asyncio.ensure_future(self.bus.terminated.wait())
+        try:
+            while True:
+                get = asyncio.ensure_future(replies.get())
+                timeout = max(0, deadline - loop.time()) if deadline is not None else None
+                done, _ = await asyncio.wait([get, terminated], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if get not in done:
+                    get.cancel()
+                    if not done:
+                        print("Test expired")
+                        self.bus.terminate()
+                        pid = 0
+                    # The killers kill it with the other scripts of the node, this is only a fallback
+                    if rpid is not None:
+                        await asyncio.sleep(self.FLUSH)
+                        client.request('kill', lambda msg: None, pids=[rpid], grace=0)
+                    self._output(executor, title, outputs, 0, b'', end=True)
+                    return pid, outputs[0], outputs[1], 0 if pid else None
+                msg = get.result()
+                if 'pid' in msg:
+                    rpid = msg['pid']
+                    self.killers.append(AgentKiller(executor.user, executor.addr, executor.port, rpid, executor.agent,
+                                                    executor.relay))
+                for kind in ['out', 'err']:
+                    if kind in msg:
+                        # Like SSHExecutor.exec, the stderr of a node is part of its stdout
+                        self._output(executor, title, outputs, 0, msg[kind].encode())
+                if 'error' in msg:
+                    print("Agent of %s : %s" % (executor.addr, msg['error']))
+                    return 0, outputs[0], outputs[1], -1
+                if 'exit' in msg:
+                    self._output(executor, title, outputs, 0, b'', end=True)
+                    return pid, outputs[0], outputs[1], 0 if self.bus.is_terminated() else msg['exit']
+        finally:
+            terminated.cancel()
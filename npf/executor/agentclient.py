@@ -0,0 +1,239 @@
+import hashlib
+import itertools
+import json
+import os
+import secrets
+import socket
+import threading
+import time
+
+from .. import npf
+from ..agent import listen_command
+
+
+class AgentClient:
+    """
+    A connection to the NPF agent of a node, see npf/agent.py. Requests are multiplexed on the connection : a thread
+    reads the replies and gives them to the handler of their request. There is one client per node and per process, as
+    scripts may be run by forked processes.
+    """
+
+    _clients = {}
+    _lock = threading.Lock()
+    # The lines the agents send back with --agent-filter, the others are only useful to be displayed
+    FILTER = r'RESULT|EVENT'
+
+    def __init__(self, rfile, wfile, close=None):
+        self.rfile = rfile
+        self.wfile = wfile
+        self._close = close
+        self.handlers = {}
+        self.ids = itertools.count(1)
+        self.wlock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        try:
+            for line in self.rfile:
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    continue
+                handler = self.handlers.get(msg.get('id', None), None)
+                if handler:
+                    handler(msg)
+                    if 'exit' in msg or 'ok' in msg or 'error' in msg:
+                        self.handlers.pop(msg['id'], None)
+        except (OSError, EOFError):
+            pass
+        self.closed = True
+        # Requests still pending will never get an answer
+        for rid, handler in list(self.handlers.items()):
+            handler({'id': rid, 'error': 'Connection to the agent lost'})
+        self.handlers = {}
+
+    def request(self, op, handler, **kwargs) -> int:
+        """Send a request, handler being called with each reply from the reader thread
+        :return: The id of the request
+        """
+        if self.closed:
+            raise ConnectionError("Connection to the agent lost")
+        rid = next(self.ids)
+        self.handlers[rid] = handler
+        kwargs.update({'id': rid, 'op': op})
+        with self.wlock:
+            self.wfile.write((json.dumps(kwargs) + '\n').encode())
+            self.wfile.flush()
+        return rid
+
+    def call(self, op, timeout=None, **kwargs) -> dict:
+        """Send a request and wait for its reply"""
+        done = threading.Event()
+        reply = {}
+
+        def handler(msg):
+            reply.update(msg)
+            done.set()
+
+        self.request(op, handler, **kwargs)
+        if not done.wait(timeout):
+            raise TimeoutError("The agent did not answer to %s" % op)
+        if 'error' in reply:
+            raise Exception("Agent error : %s" % reply['error'])
+        return reply
+
+    def close(self):
+        self.closed = True
+        try:
+            self.wfile.close()
+        except OSError:
+            pass
+        if self._close:
+            self._close()
+
+    @staticmethod
+    def source() -> str:
+        return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'agent.py')
+
+    @classmethod
+    def deploy(cls, ssh) -> str:
+        """Copy the agent on the node if it is not there yet, under a name given by its content
+        :return: Its path on the node
+        """
+        with open(cls.source(), 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:12]
+        remote = '/tmp/npf-agent-%s.py' % digest
+        sftp = ssh.open_sftp()
+        try:
+            try:
+                sftp.stat(remote)
+            except IOError:
+                sftp.put(cls.source(), remote + '.tmp')
+                sftp.posix_rename(remote + '.tmp', remote)
+        finally:
+            sftp.close()
+        return remote
+
+    @staticmethod
+    def token() -> str:
+        """The secret that TCP connections to the agents must give, kept in the build folder"""
+        path = npf.get_build_path() + '.agent-token'
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(16))
+            os.replace(path + '.tmp', path)
+        with open(path) as f:
+            return f.read().strip()
+
+    @classmethod
+    def connect(cls, user, addr, port, agent, get_connection) -> 'AgentClient':
+        """
+        Connect to the agent of a node
+        :param agent: ssh to start an agent speaking through its SSH session, or tcp:PORT to connect to an agent
+                      listening on PORT, started through SSH if there is none
+        :param get_connection: Gives a new paramiko SSH connection to the node
+        """
+        if agent.startswith('tcp'):
+            tcp_port = cls.tcp_port(agent)
+            token = cls.token()
+            for i in range(50):
+                try:
+                    sock = socket.create_connection((addr, tcp_port), timeout=5)
+                    break
+                except ConnectionRefusedError:
+                    if i == 0:
+                        ssh = get_connection()
+                        try:
+                            remote = cls.deploy(ssh)
+                            stdin, stdout, stderr = ssh.exec_command(listen_command(remote, tcp_port))
+                            stdin.write(token + '\n')
+                            stdin.flush()
+                            stdin.channel.shutdown_write()
+                            stdout.channel.recv_exit_status()
+                        finally:
+                            ssh.close()
+                    time.sleep(0.1)
+            else:
+                raise ConnectionError("Could not connect to the agent of %s on port %d" % (addr, tcp_port))
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            wfile = sock.makefile('wb')
+            wfile.write((json.dumps({'token': token}) + '\n').encode())
+            wfile.flush()
+
+            def close():
+                # Ends the reader thread too
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                sock.close()
+
+            return AgentClient(sock.makefile('rb'), wfile, close=close)
+
+        ssh = get_connection()
+        remote = cls.deploy(ssh)
+        chan = ssh.get_transport().open_session()
+        chan.exec_command('python3 -u %s' % remote)
+        return AgentClient(chan.makefile('rb'), chan.makefile('wb'), close=ssh.close)
+
+    @staticmethod
+    def tcp_port(agent) -> int:
+        return int(agent.split(':')[1]) if agent and agent.startswith('tcp:') else 7432
+
+    @classmethod
+    def get(cls, executor) -> 'AgentClient':
+        """The connection of this process to the agent of the node of executor, opened if needed"""
+        if getattr(executor, 'relay', None) and executor.relay != executor.addr:
+            return PeerClient(cls.get(cls._relay_executor(executor)), executor)
+        key = (os.getpid(), executor.user, executor.addr, executor.port)
+        with cls._lock:
+            client = cls._clients.get(key, None)
+            if client is None or client.closed:
+                client = cls.connect(executor.user, executor.addr, executor.port, executor.agent,
+                                     lambda: executor.get_connection(cache=False))
+                cls._clients[key] = client
+            return client
+
+    @staticmethod
+    def _relay_executor(executor):
+        """The executor of the relay of a node, the relay being another node or only an address"""
+        from npf.node import Node
+        from .sshexecutor import SSHExecutor
+        node = Node._nodes.get(executor.relay, None)
+        if node is not None and isinstance(node.executor, SSHExecutor):
+            relay = node.executor
+        else:
+            relay = SSHExecutor(executor.user, executor.relay, '/', executor.port)
+        if not relay.agent:
+            relay.agent = executor.agent
+        return relay
+
+
+class PeerClient(AgentClient):
+    """
+    The connection to the agent of a node through the agent of its relay, that forwards the requests to the node and
+    sends its replies back on the connection of the relay. The agent of the node always listens on TCP, it is started
+    by the relay through SSH if needed.
+    """
+
+    def __init__(self, relay, executor):
+        self.relay = relay
+        self.node = '%s:%d' % (executor.addr, self.tcp_port(executor.agent))
+        self.deploy = {'user': executor.user, 'port': executor.port}
+        self._token = self.token()
+
+    @property
+    def closed(self):
+        return self.relay.closed
+
+    def request(self, op, handler, **kwargs) -> int:
+        kwargs.update({'node': self.node, 'token': self._token, 'deploy': self.deploy})
+        return self.relay.request(op, handler, **kwargs)
+
+    def close(self):
+        pass
@@ -2,6 +2,9 @@ import re
 
 from colorama import Fore, Back, Style
 
+from .. import trace
+from ..console import Console
+
 foreColors = [Fore.BLACK, Fore.RED, Fore.GREEN, Fore.YELLOW, Fore.BLUE, Fore.MAGENTA, Fore.CYAN, Fore.WHITE]
 
 class Executor:
@@ -13,14 +16,13 @@ class Executor:
         Executor.index = Executor.index + 1
         self.path = None
 
-    def searchEvent(self, output, eb):
+    def searchEvent(self, output, eb, title=None):
         results = re.finditer("EVENT ([a-zA-Z_-]+)", output)
         for result in results:
+            trace.instant("post " + result.group(1), "event", script=title)
             eb.post(result.group(1))
 
     def _print(self, title, line, nl = True):
-        try:
-            print(self.color + title + Style.RESET_ALL + ' ' + line, end=None if nl else '')
-        except UnicodeEncodeError:
-            print("Line ignored due to invalid encoding")
+        # Printed by the console thread, so a script printing a lot does not slow down the executor
+        Console.get().write(self.color + title + Style.RESET_ALL, line if nl else line.rstrip('\n'))
 
@@ -2,6 +2,7 @@ import os
 import pwd
 import signal
 import select
+import time
 from multiprocessing import Queue, Event
 from subprocess import PIPE, Popen, TimeoutExpired
 from typing import List
@@ -10,12 +11,12 @@ class LocalKiller:
     def __init__(self, pgpid):
         self.pgpid = pgpid
 
+    def terminate(self):
+        os.killpg(self.pgpid, signal.SIGTERM)
+
     def kill(self):
         os.killpg(self.pgpid, signal.SIGKILL)
 
-    def force_kill(self):
-        os.killpg(self.pgpid, signal.SIGTERM)
-
     def is_alive(self):
         try:
             os.killpg(self.pgpid, 0)
@@ -25,14 +26,73 @@ class LocalKiller:
             return False
         return True
 
+    def pidfd(self):
+        """A file descriptor that becomes readable when the leader of the process group exits, or None if the
+        system does not support it"""
+        try:
+            return os.pidfd_open(self.pgpid)
+        except (AttributeError, OSError):
+            return None
+
+    @staticmethod
+    def wait_all(killers, deadline):
+        """Wait until all the process groups are gone or the deadline (a time.time()) is reached, polling the pidfds of
+        their leaders instead of sleeping.
+        :return: The killers still alive at the deadline
+        """
+        fds = {}
+        for killer in killers:
+            fd = killer.pidfd()
+            if fd is not None:
+                fds[fd] = killer
+        try:
+            poller = select.poll()
+            for fd in fds:
+                poller.register(fd, select.POLLIN)
+            while fds and time.time() < deadline:
+                for fd, event in poller.poll(max(0, deadline - time.time()) * 1000):
+                    poller.unregister(fd)
+                    os.close(fd)
+                    del fds[fd]
+        finally:
+            for fd in fds:
+                os.close(fd)
+        # Other processes of the groups may still be exiting, and groups without a pidfd were not waited for
+        alive = [killer for killer in killers if killer.is_alive()]
+        delay = 0.001
+        while alive and time.time() < deadline:
+            time.sleep(min(delay, max(0, deadline - time.time())))
+            delay = min(delay * 2, 0.05)
+            alive = [killer for killer in alive if killer.is_alive()]
+        return alive
+
 class LocalExecutor(Executor):
     def __init__(self):
         super().__init__()
 
+    def command(self, cmd : str, cwd : str, bin_paths : List[str]=[], options = None, sudo = False, env = {}, virt=""):
+        """The shell command and the environment to run cmd from cwd, see exec()"""
+        env = env.copy()
+        env.update(os.environ)
+        if bin_paths:
+            if not sudo:
+                env["PATH"] = ':'.join([cwd + '/' + path if not os.path.abspath(path) else path for path in bin_paths]) + ":" + env["PATH"]
+            else:
+                cmd = 'export PATH=' + ':'.join([cwd + '/' + path if not os.path.abspath(path) else path for path in bin_paths]) + ":" + '$PATH\n' + cmd
+
+        if options is not None and options.show_cmd:
+            print("Executing (PATH+=%s) :\n%s" % (':'.join(bin_paths), cmd.strip()))
+
+        if sudo and pwd.getpwuid(os.getuid()).pw_name != "root":
+            cmd = "sudo -E " + virt + "  bash -c '"+ cmd.replace("'", "'\"'\"'") + "'";
+        else:
+            cmd = virt + " bash -c '"+ cmd.replace("'", "'\"'\"'") + "'";
+        return cmd, env
+
     def exec(self, cmd : str, bin_paths : List[str]=[],
              queue: Queue = None, options = None,
              stdin = None, timeout = None, sudo = False,
-             testdir=None, event=None, title=None, env = {}, virt="" ) -> [int, str, str, int]:
+             testdir=None, event=None, title=None, env = {}, virt="", capture=None) -> [int, str, str, int]:
         """Runs a command in local
 
         Args:
@@ -48,6 +108,7 @@ class LocalExecutor(Executor):
             title (_type_, optional): Title for the script. Defaults to None.
             env (dict, optional): Env array. Defaults to {}.
             virt (str, optional): Virtualisation decorator (eg namespaces). Defaults to "".
+            capture (tuple, optional): The Capture objects to write stdout and stderr to instead of strings. Defaults to None.
 
         Returns:
             [int, str, str, int]: pid, stdout, stderr, return code
@@ -56,24 +117,9 @@ class LocalExecutor(Executor):
             os.chdir("..")
         if not title:
             title = "local"
-        cwd = os.getcwd()
-        env = env.copy()
-        env.update(os.environ)
-        if bin_paths:
-            if not sudo:
-                env["PATH"] = ':'.join([cwd + '/' + path if not os.path.abspath(path) else path for path in bin_paths]) + ":" + env["PATH"]
-            else:
-                cmd = 'export PATH=' + ':'.join([cwd + '/' + path if not os.path.abspath(path) else path for path in bin_paths]) + ":" + '$PATH\n' + cmd
-
-        if options is not None and options.show_cmd:
-            print("Executing (PATH+=%s) :\n%s" % (':'.join(bin_paths), cmd.strip()))
-
-        if sudo and pwd.getpwuid(os.getuid()).pw_name != "root":
-            cmd = "sudo -E " + virt + "  bash -c '"+ cmd.replace("'", "'\"'\"'") + "'";
-        else:
-            cmd = virt + " bash -c '"+ cmd.replace("'", "'\"'\"'") + "'";
+        cmd, env = self.command(cmd, os.getcwd(), bin_paths=bin_paths, options=options, sudo=sudo, env=env, virt=virt)
 
-        outputs = ['', '']
+        outputs = list(capture) if capture else ['', '']
 
         p = Popen(cmd,
                   stdin=PIPE, stdout=PIPE, stderr=PIPE,
@@ -90,6 +136,7 @@ class LocalExecutor(Executor):
         flushing = False
 
         step = 0.2
+        deadline = time.time() + timeout if timeout is not None else None
         killer = LocalKiller(pgpid)
         if queue:
             queue.put(killer)
@@ -100,7 +147,7 @@ class LocalExecutor(Executor):
                     for line in channel.readlines():
                         line = line.decode()
                         outputs[ichannel] += line
-                        self.searchEvent(line, event)
+                        self.searchEvent(line, event, title)
                         if options and not options.quiet:
                             self._print(title, line.rstrip(), True)
 
@@ -112,10 +159,9 @@ class LocalExecutor(Executor):
                         flushing = True
 
 
-                if timeout is not None:
-                    timeout -= step
-                    if timeout < 0:
-                        raise TimeoutExpired(cmd, timeout)
+                # Measured on the clock, as a busy output makes the turns shorter than step
+                if timeout is not None and time.time() > deadline:
+                    raise TimeoutExpired(cmd, timeout)
 
             p.stdin.close()
             p.stderr.close()
@@ -141,8 +187,12 @@ class LocalExecutor(Executor):
                 os.chdir(testdir)
             return -1, outputs[0], outputs[1], p.returncode
 
-    def writeFile(self,filename,path_to_root,content,sudo=False):
-        f = open(filename, "w")
+    def writeFile(self,filename,path_to_root,content,sudo=False,local_path=None):
+        local = filename
+        if local_path:
+            local = os.path.join(local_path, filename)
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+        f = open(local, "w")
         f.write(content)
         f.close()
         return True
@@ -14,6 +14,90 @@ from .. import npf
 from paramiko.buffered_pipe import PipeTimeout
 import socket
 import stat
+import threading
+
+class RemoteKiller:
+    """Kills the shell of a script started on a node with SSHExecutor.exec, and its children"""
+
+    # (pid, user, addr, port) -> SSH connection of this process to the node, kept from one run to the next
+    _connections = {}
+    _lock = threading.Lock()
+
+    def __init__(self, user, addr, port, pid):
+        self.user = user
+        self.addr = addr
+        self.port = port
+        self.pid = pid
+
+    def node(self):
+        return self.user, self.addr, self.port
+
+    @classmethod
+    def connection(cls, user, addr, port, cache=True):
+        """The connection of this process to the node, opened with the executor of the node if needed. A connection
+        inherited from the parent of a forked process is not used."""
+        from npf.node import Node
+        key = (os.getpid(), user, addr, port)
+        with cls._lock:
+            ssh = cls._connections.get(key, None)
+            if not cache or ssh is None or not ssh.get_transport() or not ssh.get_transport().is_active():
+                if ssh is not None:
+                    ssh.close()
+                node = Node._nodes.get(addr, None)
+                if node is not None and isinstance(node.executor, SSHExecutor):
+                    executor = node.executor
+                else:
+                    executor = SSHExecutor(user, addr, '/', port)
+                ssh = executor.get_connection(cache=False)
+                cls._connections[key] = ssh
+            return ssh
+
+    @staticmethod
+    def kill_all(killers, timeout):
+        """Kill the processes of killers, all of the same node, with a single command : they are sent SIGTERM, then
+        SIGKILL if they did not exit after timeout seconds
+        :return: True if the command could be run
+        """
+        import paramiko
+        user, addr, port = killers[0].node()
+        pids = ' '.join(str(k.pid) for k in killers)
+        cmd = ("P='%s'; C=$(for p in $P; do pgrep -P $p; done); kill -TERM $P $C 2>/dev/null; "
+               "timeout %.3f sh -c 'for p in $0; do tail --pid=$p -s 0.01 -f /dev/null; done' \"$P $C\"; "
+               "kill -KILL $P $C 2>/dev/null; true") % (pids, timeout)
+        for cache in [True, False]:
+            try:
+                # A new channel on the connection kept for the node, reconnecting once if it was lost
+                ssh = RemoteKiller.connection(user, addr, port, cache=cache)
+                stdin, stdout, stderr = ssh.exec_command(cmd)
+                return stdout.channel.recv_exit_status() == 0
+            except (paramiko.ssh_exception.SSHException, socket.error, EOFError) as e:
+                if not cache:
+                    print("Could not kill the scripts on %s : %s" % (addr, e))
+        return False
+
+
+class AgentKiller(RemoteKiller):
+    """Kills the process group of a script started by the agent of a node"""
+
+    def __init__(self, user, addr, port, pid, agent, relay=None):
+        super().__init__(user, addr, port, pid)
+        self.agent = agent
+        self.relay = relay
+
+    @staticmethod
+    def kill_all(killers, timeout):
+        from .agentclient import AgentClient
+        user, addr, port = killers[0].node()
+        executor = SSHExecutor(user, addr, '/', port)
+        executor.agent = killers[0].agent
+        executor.relay = killers[0].relay
+        try:
+            AgentClient.get(executor).call('kill', timeout=timeout + 5, pids=[k.pid for k in killers], grace=timeout)
+            return True
+        except Exception as e:
+            print("Could not kill the scripts on %s : %s" % (addr, e))
+            return False
+
 
 class SSHExecutor(Executor):
 
@@ -27,6 +111,10 @@ class SSHExecutor(Executor):
             self.path = path + '/'
         self.port = port
         self.ssh = False
+        # ssh or tcp:PORT to run the scripts through the NPF agent of the node, see npf/agent.py
+        self.agent = None
+        # The node whose agent relays the requests for this one, see npf/agent.py
+        self.relay = None
         #Executor should not make any connection in init as parameters can be overwritten afterward
 
     def __del__(self):
@@ -45,14 +133,8 @@ class SSHExecutor(Executor):
             self.ssh = ssh
         return ssh
 
-
-    def exec(self, cmd, bin_paths : List[str] = None, queue: Queue = None, options = None, stdin = None, timeout=None, sudo=False, testdir=None, event=None, title=None, env={}, virt = "", raw = False):
-        if not title:
-            title = self.addr
-        else:
-            title = self.addr + ' - ' + title
-        if not event:
-            event = EventBus()
+    def command(self, cmd, bin_paths : List[str] = None, options = None, stdin = None, sudo=False, testdir=None, env={}, virt = "", raw = False, pid = True):
+        """The command to run cmd on the node, see exec(). With pid, the first line it prints is the pid of its shell."""
         if bin_paths is None:
             bin_paths = []
         path_list = [p if os.path.isabs(p) else os.path.join(self.path, p) for p in bin_paths]
@@ -88,18 +170,34 @@ class SSHExecutor(Executor):
         else:
             cmd = virt + " " + unbuffer +" bash -c '" + path_cmd + cmd.replace("'", "'\"'\"'") + "'";
 
+        #First echo the pid of the shell, so it can be recovered and killed in case of kill from another script
+        #Then launch the pre-command (goes to the right folder)
+        #Then the user command, wrapped with sudo and/or bash if needed
+        return ("echo $$;" if pid else "") + pre + cmd + " ; echo '' ;"
+
+    def exec(self, cmd, bin_paths : List[str] = None, queue: Queue = None, options = None, stdin = None, timeout=None, sudo=False, testdir=None, event=None, title=None, env={}, virt = "", raw = False, capture = None):
+        if not title:
+            title = self.addr
+        else:
+            title = self.addr + ' - ' + title
+        if not event:
+            event = EventBus()
+        if self.agent:
+            return self._agent_exec(cmd, bin_paths=bin_paths, queue=queue, options=options, stdin=stdin,
+                                    timeout=timeout, sudo=sudo, testdir=testdir, event=event, title=title, env=env,
+                                    virt=virt, capture=capture)
+        cmd = self.command(cmd, bin_paths=bin_paths, options=options, stdin=stdin, sudo=sudo, testdir=testdir, env=env,
+                           virt=virt, raw=raw)
+
         ssh = None
         try:
             ssh = self.get_connection(cache=False)
 
-            #First echo the pid of the shell, so it can be recovered and killed in case of kill from another script
-            #Then launch the pre-command (goes to the right folder)
-            #Then the user command, wrapped with sudo and/or bash if needed
-            ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command("echo $$;"+ pre + cmd + " ; echo '' ;")
+            ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command(cmd)
             if stdin is not None:
                 ssh_stdin.write(stdin)
             channels = [ssh_stdout, ssh_stderr]
-            output = ['','']
+            output = list(capture) if capture else ['','']
             buffers = ['','']
             rpid = -1
             pid = os.getpid()
@@ -123,13 +221,15 @@ class SSHExecutor(Executor):
                                     buffers[ichannel] = buffers[ichannel][p+1:]
                                     if rpid == -1:
                                         rpid = int(line)
+                                        if queue is not None:
+                                            queue.put(RemoteKiller(self.user, self.addr, self.port, rpid))
                                     else:
                                         if options and not options.quiet:
                                             self._print(title, line, False)
-                                        self.searchEvent(line, event)
+                                        self.searchEvent(line, event, title)
                                         output[ichannel] += line
                                     if buffers[ichannel]:
-                                        self.searchEvent(buffers[ichannel], event)
+                                        self.searchEvent(buffers[ichannel], event, title)
                             except UnicodeDecodeError:
                                         print("Could not decode SSH input")
                             except Exception as e:
@@ -163,10 +263,11 @@ class SSHExecutor(Executor):
                         if options and options.debug:
                             print("[DEBUG] %s: Sending SIGKILL to %d" % (title,rpid))
                         ssh_stdin.channel.send(chr(3))
-                    ssh.exec_command("kill "+str(rpid))
-#                   unneeded ssh.exec_command("kill $(ps -s  "+str(rpid)+" -o pid=)" )
-                    i=0
-                    ssh_stdout.channel.status_event.wait(timeout=1)
+                    # The killer given to the queue kills it with the other scripts of the node, this is only a fallback
+                    if queue is None or not ssh_stdout.channel.status_event.wait(timeout=1):
+                        ssh.exec_command("kill "+str(rpid))
+#                       unneeded ssh.exec_command("kill $(ps -s  "+str(rpid)+" -o pid=)" )
+                        ssh_stdout.channel.status_event.wait(timeout=1)
                 # end of loop
 
             if event.is_terminated():
@@ -191,11 +292,89 @@ class SSHExecutor(Executor):
                     ssh.close()
             return 0,'','',-1
 
-    def writeFile(self,filename,path_to_root,content,sudo=False):
-        f = open(filename, "w")
+    def _agent_exec(self, cmd, bin_paths, queue, options, stdin, timeout, sudo, testdir, event, title, env, virt,
+                    capture=None):
+        """exec() through the agent of the node. The script is not wrapped by unbuffer, as the agent gives it a PTY."""
+        from queue import SimpleQueue, Empty
+        from .agentclient import AgentClient
+        cmd = self.command(cmd, bin_paths=bin_paths, options=options, stdin=stdin, sudo=sudo, testdir=testdir, env=env,
+                           virt=virt, raw=True, pid=False)
+        replies = SimpleQueue()
+        try:
+            client = AgentClient.get(self)
+            client.request('exec', replies.put, cmd=cmd, stdin=stdin,
+                           filter=AgentClient.FILTER if options and options.quiet and getattr(options, 'agent_filter', False) else None)
+        except (OSError, paramiko.ssh_exception.SSHException) as e:
+            print("Error while connecting to the agent of %s" % self.addr)
+            print(e)
+            return 0, '', '', -1
+
+        output = list(capture) if capture else ['', '']
+        rpid = None
+        pid = os.getpid()
+        ret = None
+        step = 0.2
+        terminated_at = None
+        while ret is None:
+            try:
+                msg = replies.get(timeout=step)
+            except Empty:
+                msg = {}
+            except KeyboardInterrupt:
+                event.terminate()
+                return -1, output[0], output[1], -1
+            if 'pid' in msg:
+                rpid = msg['pid']
+                if queue is not None:
+                    queue.put(AgentKiller(self.user, self.addr, self.port, rpid, self.agent, self.relay))
+            for ichannel, kind in enumerate(['out', 'err']):
+                if kind in msg:
+                    line = msg[kind]
+                    if options and not options.quiet:
+                        self._print(title, line, False)
+                    self.searchEvent(line, event, title)
+                    # Like exec(), the stderr of a node is part of its stdout
+                    output[0] += line
+            if 'exit' in msg:
+                ret = msg['exit']
+            elif 'error' in msg:
+                print("Agent of %s : %s" % (self.addr, msg['error']))
+                return 0, output[0], output[1], -1
+            if not msg and timeout is not None:
+                timeout -= step
+                if timeout < 0 and terminated_at is None:
+                    event.terminate()
+                    pid = 0
+            if event.is_terminated() and ret is None:
+                if terminated_at is None:
+                    terminated_at = time.time()
+                # The killer given to the queue kills it with the other scripts of the node, this is only a fallback
+                elif time.time() - terminated_at > 1 and rpid is not None:
+                    client.request('kill', lambda msg: None, pids=[rpid], grace=0)
+                    break
+        if event.is_terminated():
+            ret = 0
+        return pid, output[0], output[1], ret
+
+    def writeFile(self,filename,path_to_root,content,sudo=False,local_path=None):
+        local = filename
+        if local_path:
+            local = os.path.join(local_path, filename)
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+        f = open(local, "w")
         f.write(content)
         f.close()
 
+        if self.agent and not sudo:
+            from .agentclient import AgentClient
+            try:
+                AgentClient.get(self).call('write', timeout=30, path='%s/%s/%s' % (self.path, path_to_root, filename),
+                                           content=content)
+                return True
+            except Exception as e:
+                print("Could not write %s with the agent of %s : %s" % (filename, self.addr, e))
+                return False
+
         try:
             with paramiko.SSHClient() as ssh:
                 ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -327,6 +506,50 @@ class SSHExecutor(Executor):
             raise e
 
 
+    def recvFolder(self, path, local):
+        """Copy the remote folder path, relative to the node's path unless it is absolute, to local + path. Files
+        are received with the modification time they have on the node, those with the same size and time are
+        considered up to date.
+        :return: The number of bytes received and the number of bytes already up to date
+        """
+        try:
+            ssh = self.get_connection()
+        except Exception as e:
+            print("Cannot connect to %s with username %s" % (self.addr,self.user))
+            raise e
+        sftp = paramiko.SFTPClient.from_transport(ssh.get_transport())
+
+        def _recv(path):
+            total = 0
+            skipped = 0
+            # An absolute remote folder goes under local too
+            lpath = os.path.join(local, path.lstrip('/'))
+            os.makedirs(lpath, exist_ok=True)
+            for entry in sftp.listdir_attr(path if os.path.isabs(path) else self.path + path):
+                rpath = path + '/' + entry.filename
+                if stat.S_ISDIR(entry.st_mode):
+                    t, s = _recv(rpath)
+                    total += t
+                    skipped += s
+                    continue
+                lfile = os.path.join(lpath, entry.filename)
+                if os.path.exists(lfile):
+                    lstat = os.stat(lfile)
+                    # A rebuilt binary often keeps the same size
+                    if lstat.st_size == entry.st_size and int(lstat.st_mtime) == int(entry.st_mtime):
+                        skipped += entry.st_size
+                        continue
+                sftp.get(rpath if os.path.isabs(rpath) else self.path + rpath, lfile)
+                os.chmod(lfile, stat.S_IMODE(entry.st_mode))
+                os.utime(lfile, (entry.st_atime, entry.st_mtime))
+                total += entry.st_size
+            return total, skipped
+
+        try:
+            return _recv(os.path.normpath(path))
+        finally:
+            sftp.close()
+
     def deleteFolder(self, path):
         try:
             with paramiko.SSHClient() as ssh:
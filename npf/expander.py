@@ -0,0 +1,333 @@
+import random
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
+from npf import design
+from npf.variable import is_numeric, get_numeric
+
+
+class VariableSpace:
+    """The discrete space of all combinations of the dynamic variables. Points are tuples of
+    indexes, one per dynamic variable, into the values of that variable."""
+
+    def __init__(self, vlist, overriden):
+        self.statics = OrderedDict()
+        self.dims = OrderedDict()
+        for k, v in vlist.items():
+            if k in overriden:
+                continue
+            values = v.makeValues()
+            if len(values) > 1:
+                self.dims[k] = values
+            elif len(values) == 1:
+                self.statics[k] = values[0]
+        self.shape = tuple(len(values) for values in self.dims.values())
+        self.size = int(np.prod(self.shape)) if self.shape else 1
+
+        # Numerical variables are a single feature scaled to [0,1], others are one-hot encoded
+        self._columns = []
+        for k, values in self.dims.items():
+            if all(not isinstance(x, (tuple, dict)) and is_numeric(x) for x in values):
+                nums = np.array([float(get_numeric(x)) for x in values])
+                lo, hi = nums.min(), nums.max()
+                self._columns.append(((nums - lo) / (hi - lo) if hi > lo else np.zeros(len(nums))).reshape(-1, 1))
+            else:
+                self._columns.append(np.eye(len(values)))
+
+    def variables(self, point) -> OrderedDict:
+        """The variables of a point, as the brute expander would have given them"""
+        z = OrderedDict()
+        for k, v in self.statics.items():
+            z.update(v if type(v) is OrderedDict else {k: v})
+        for (k, values), i in zip(self.dims.items(), point):
+            v = values[i]
+            z.update(v if type(v) is OrderedDict else {k: v})
+        return z
+
+    def point(self, variables):
+        """The point of a set of variables, or None if they are not part of the space"""
+        point = []
+        for k, values in self.dims.items():
+            found = None
+            for i, v in enumerate(values):
+                if type(v) is OrderedDict:
+                    if all(_same(variables.get(vk, None), vv) for vk, vv in v.items()):
+                        found = i
+                        break
+                elif _same(variables.get(k, None), v):
+                    found = i
+                    break
+            if found is None:
+                return None
+            point.append(found)
+        return tuple(point)
+
+    def features(self, points) -> np.ndarray:
+        points = np.array(points, dtype=int, ndmin=2).reshape(-1, len(self.dims))
+        if not self._columns:
+            return np.zeros((len(points), 0))
+        return np.hstack([column[points[:, i]] for i, column in enumerate(self._columns)])
+
+    def candidates(self, rng, limit=20000):
+        """All points, or a random sample of them if the space is too big"""
+        if self.size <= limit:
+            return [tuple(p) for p in np.ndindex(*self.shape)]
+        return list(set(tuple(rng.randrange(n) for n in self.shape) for i in range(limit)))
+
+
+def _same(a, b):
+    if type(a) is tuple:
+        a = a[1]
+    if type(b) is tuple:
+        b = b[1]
+    if is_numeric(a) and is_numeric(b):
+        return get_numeric(a) == get_numeric(b)
+    return a == b
+
+
+def parse_objective(objective):
+    """Returns the result type to optimize and the sign to apply so that the objective is maximized.
+    A leading '-' asks for the minimum instead."""
+    if objective is None:
+        return None, 1
+    if objective.startswith('-'):
+        return objective[1:], -1
+    return objective, 1
+
+
+class BayesianVariableExpander:
+    """Find the best combination of variables for one result type, treating the test as a black box.
+    A few random combinations are tried first, then a Gaussian process is fitted on the results obtained
+    so far and the combination with the highest expected improvement is tried next, until the budget of
+    combinations is exhausted. Categorical variables are one-hot encoded."""
+    adaptive = True
+
+
+    def __init__(self, vlist, overriden, options):
+        self.space = VariableSpace(vlist, overriden)
+        self.options = options
+        self.objective, self.sign = parse_objective(getattr(options, 'expand_objective', None))
+        budget = getattr(options, 'expand_budget', None)
+        if not budget:
+            budget = max(10, self.space.size // 10)
+        self.budget = min(budget, self.space.size)
+        self.rng = random.Random(getattr(options, 'expand_seed', None))
+        self.n_init = max(2, min(5, self.budget // 4))
+        self.observed = OrderedDict()
+
+    def __len__(self):
+        return self.budget
+
+    def tell(self, variables, results):
+        point = self.space.point(variables)
+        if point is None:
+            return
+        if self.objective is None and results:
+            self.objective = next(iter(results.keys()))
+            if not self.options.quiet:
+                print("No objective given with --expand-objective, maximizing %s"
+                      % (self.objective if self.objective else "RESULT"))
+        r = results.get(self.objective, None) if results else None
+        self.observed[point] = self.sign * np.mean(r) if r else np.nan
+
+    def _next(self):
+        candidates = [p for p in self.space.candidates(self.rng) if p not in self.observed]
+        if not candidates:
+            return None
+        measured = [(p, y) for p, y in self.observed.items() if not np.isnan(y)]
+        if len(measured) < self.n_init:
+            return self.rng.choice(candidates)
+
+        from scipy.stats import norm
+        from sklearn.exceptions import ConvergenceWarning
+        from sklearn.gaussian_process import GaussianProcessRegressor
+        from sklearn.gaussian_process.kernels import Matern, WhiteKernel
+
+        X = self.space.features([p for p, y in measured])
+        y = np.array([y for p, y in measured])
+        gp = GaussianProcessRegressor(kernel=Matern(nu=2.5) + WhiteKernel(), normalize_y=True,
+                                      random_state=self.rng.randrange(2**31))
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', category=ConvergenceWarning)
+            gp.fit(X, y)
+        mu, sigma = gp.predict(self.space.features(candidates), return_std=True)
+        sigma = np.maximum(sigma, 1e-9)
+        improvement = mu - y.max()
+        z = improvement / sigma
+        ei = improvement * norm.cdf(z) + sigma * norm.pdf(z)
+        return candidates[int(np.argmax(ei))]
+
+    def __iter__(self):
+        while len(self.observed) < self.budget:
+            point = self._next()
+            if point is None:
+                break
+            self.observed.setdefault(point, np.nan)
+            yield self.space.variables(point)
+        self.print_best()
+
+    def print_best(self):
+        measured = [(p, y) for p, y in self.observed.items() if not np.isnan(y)]
+        if not measured or self.options.quiet:
+            return
+        point, y = max(measured, key=lambda m: m[1])
+        print("Best %s after %d combinations : %s for %s" % (
+            self.objective if self.objective else "RESULT", len(self.observed), self.sign * y,
+            ', '.join("%s = %s" % (k, v) for k, v in self.space.variables(point).items() if k not in self.space.statics)))
+
+
+class ActiveVariableExpander:
+    """Map the whole space of combinations while measuring only a fraction of it. After each batch of
+    --expand-batch combinations, a forest of decision trees is fitted on the results obtained so far and
+    the spread of the trees' predictions is used as the uncertainty of the unmeasured combinations. Only
+    those whose relative uncertainty is above --expand-tolerance are measured next, the most uncertain
+    first. The search stops when no combination is uncertain anymore or when --expand-budget
+    combinations were measured. The model-completed surface can then be written with write_surface."""
+    adaptive = True
+
+
+    def __init__(self, vlist, overriden, options):
+        self.space = VariableSpace(vlist, overriden)
+        self.options = options
+        budget = getattr(options, 'expand_budget', None)
+        self.budget = min(budget, self.space.size) if budget else self.space.size
+        batch = getattr(options, 'expand_batch', None)
+        self.batch = batch if batch else max(10, self.space.size // 200)
+        tolerance = getattr(options, 'expand_tolerance', None)
+        self.tolerance = tolerance if tolerance is not None else 0.05
+        self.rng = random.Random(getattr(options, 'expand_seed', None))
+        self.observed = OrderedDict()
+        self.result_types = []
+
+    def __len__(self):
+        return self.budget
+
+    def tell(self, variables, results):
+        point = self.space.point(variables)
+        if point is None:
+            return
+        means = OrderedDict()
+        for result_type, r in (results.items() if results else []):
+            if r:
+                means[result_type] = np.mean(r)
+                if result_type not in self.result_types:
+                    self.result_types.append(result_type)
+        self.observed[point] = means
+
+    def _measured(self):
+        return [(p, r) for p, r in self.observed.items() if r]
+
+    def _fit(self):
+        """Fit one forest per result type on the measured combinations"""
+        from sklearn.ensemble import RandomForestRegressor
+
+        measured = self._measured()
+        X = self.space.features([p for p, r in measured])
+        models = OrderedDict()
+        for result_type in self.result_types:
+            rows = [i for i, (p, r) in enumerate(measured) if result_type in r]
+            if len(rows) < 2:
+                continue
+            y = np.array([measured[i][1][result_type] for i in rows])
+            model = RandomForestRegressor(n_estimators=50, random_state=self.rng.randrange(2**31))
+            models[result_type] = model.fit(X[rows], y)
+        return models
+
+    @staticmethod
+    def _predict(models, X):
+        """Mean and relative spread of the trees' predictions, the spread being the worst of all result types"""
+        prediction = OrderedDict()
+        uncertainty = np.zeros(len(X))
+        for result_type, model in models.items():
+            trees = np.array([tree.predict(X) for tree in model.estimators_])
+            mean = trees.mean(axis=0)
+            prediction[result_type] = mean
+            uncertainty = np.maximum(uncertainty, trees.std(axis=0) / np.maximum(np.abs(mean), 1e-9))
+        return prediction, uncertainty
+
+    def _next_batch(self):
+        candidates = [p for p in self.space.candidates(self.rng) if p not in self.observed]
+        n = min(self.batch, self.budget - len(self.observed), len(candidates))
+        if n <= 0:
+            return []
+        if len(self._measured()) < self.batch:
+            return self.rng.sample(candidates, n)
+        models = self._fit()
+        if not models:
+            return self.rng.sample(candidates, n)
+        prediction, uncertainty = self._predict(models, self.space.features(candidates))
+        order = np.argsort(-uncertainty, kind='stable')
+        return [candidates[i] for i in order[:n] if uncertainty[i] > self.tolerance]
+
+    def __iter__(self):
+        while len(self.observed) < self.budget:
+            batch = self._next_batch()
+            if not batch:
+                break
+            for point in batch:
+                self.observed.setdefault(point, OrderedDict())
+                yield self.space.variables(point)
+        if not self.options.quiet:
+            print("Measured %d combinations out of %d" % (len(self._measured()), self.space.size))
+
+    def surface(self):
+        """Yields every combination of the space with its results, measured or predicted by the model"""
+        models = self._fit() if self._measured() else OrderedDict()
+        points = [tuple(p) for p in np.ndindex(*self.space.shape)]
+        for start in range(0, len(points), 10000):
+            chunk = points[start:start + 10000]
+            unmeasured = [p for p in chunk if not self.observed.get(p)]
+            prediction, uncertainty = self._predict(models, self.space.features(unmeasured)) if unmeasured and models else ({}, [])
+            predicted = {p: i for i, p in enumerate(unmeasured)}
+            for point in chunk:
+                if self.observed.get(point):
+                    yield self.space.variables(point), self.observed[point], True
+                else:
+                    i = predicted[point]
+                    yield self.space.variables(point), OrderedDict((t, v[i]) for t, v in prediction.items()), False
+
+    def write_surface(self, filename):
+        import pandas as pd
+
+        rows = []
+        for variables, results, measured in self.surface():
+            row = OrderedDict((k, v[1] if type(v) is tuple else v) for k, v in variables.items())
+            for result_type in self.result_types:
+                row[result_type if result_type else 'RESULT'] = results.get(result_type, np.nan)
+            row['measured'] = measured
+            rows.append(row)
+        pd.DataFrame(rows).to_csv(filename, index=False)
+        if not self.options.quiet:
+            print("Surface of %d combinations written to %s" % (len(rows), filename))
+
+
+class DesignVariableExpander:
+    """Test only the combinations of an experimental design generated by npf.design, such as a latin
+    hypercube, instead of all of them. Each dynamic variable is one dimension of the design, whose
+    coordinates in [0,1] are mapped to the values of the variable, so lists are covered as well as
+    ranges. The design has --expand-budget points, or 10 per variable, and is the same for the same
+    --expand-seed."""
+    adaptive = False
+
+
+    def __init__(self, vlist, overriden, method, options):
+        self.space = VariableSpace(vlist, overriden)
+        budget = getattr(options, 'expand_budget', None)
+        if not budget:
+            budget = design.default_points(len(self.space.shape))
+        seed = getattr(options, 'expand_seed', None)
+        matrix = design.generate(method, budget, len(self.space.shape), seed if seed is not None else 0)
+        self.points = list(OrderedDict.fromkeys(
+            tuple(min(int(x * n), n - 1) for x, n in zip(row, self.space.shape)) for row in matrix))
+
+    def __len__(self):
+        return len(self.points)
+
+    def tell(self, variables, results):
+        pass
+
+    def __iter__(self):
+        for point in self.points:
+            yield self.space.variables(point)
@@ -0,0 +1,52 @@
+import os
+
+
+class HistoryCache:
+    """First-parent history of a git repository, persisted in its .git folder. The first parent of a commit never
+    changes, so the cache is never invalidated : commits fetched since the last walk are resolved with a single
+    git rev-list and added to the file, the older ones are then found in the cache."""
+
+    FILENAME = 'npf-history'
+
+    def __init__(self, gitrepo):
+        self.gitrepo = gitrepo
+        self.filename = os.path.join(gitrepo.git_dir, self.FILENAME)
+        self.parents = {}
+        self._new = []
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                for line in f:
+                    commit, _, parent = line.strip().partition(' ')
+                    if commit:
+                        self.parents[commit] = parent
+
+    def _resolve(self, commit, limit):
+        """Add the first parents of commit and its ancestors, up to limit of them, to the cache"""
+        out = self.gitrepo.git.rev_list('--first-parent', '--parents', '--max-count=%d' % max(limit, 1), commit)
+        for line in out.splitlines():
+            ids = line.split()
+            if not ids or ids[0] in self.parents:
+                continue
+            parent = ids[1] if len(ids) > 1 else ''
+            self.parents[ids[0]] = parent
+            self._new.append((ids[0], parent))
+
+    def first_parents(self, version, limit) -> list:
+        """The full ids of version and of its first parents, up to limit commits in total"""
+        commit = self.gitrepo.commit(str(version)).hexsha
+        chain = []
+        while commit and len(chain) < limit:
+            chain.append(commit)
+            if commit not in self.parents:
+                self._resolve(commit, limit - len(chain) + 1)
+            commit = self.parents.get(commit, '')
+        self.save()
+        return chain
+
+    def save(self):
+        if not self._new:
+            return
+        with open(self.filename, 'a') as f:
+            for commit, parent in self._new:
+                f.write("%s %s\n" % (commit, parent))
+        self._new = []
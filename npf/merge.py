@@ -0,0 +1,126 @@
+import os
+import re
+from collections import OrderedDict
+
+PROVENANCE_EXT = '.provenance'
+
+
+def parse_line(line):
+    """Split a line of a results file in its run part and its results, as a dict of result type to the
+    list of values. The run part is kept as written, it is already canonical as variables are sorted."""
+    run, sep, results_data = line.strip().rpartition('={')
+    if not sep:
+        raise Exception("Malformed results line : %s" % line)
+    results = OrderedDict()
+    results_data = results_data[:-1]
+    if results_data.strip():
+        for type_data in results_data.split('},{'):
+            t, _, values = type_data.rpartition(':')
+            results[t] = [v for v in values.split(',') if v.strip()]
+    return run, results
+
+
+def format_line(run, results):
+    return run + "={" + '},{'.join(t + ':' + ','.join(values) for t, values in results.items()) + "}\n"
+
+
+def read_results(filename):
+    all_results = OrderedDict()
+    with open(filename, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            run, results = parse_line(line)
+            all_results[run] = results
+    return all_results
+
+
+def read_provenance(filename):
+    """Provenance of each run already merged, if the file was itself produced by a merge"""
+    provenance = OrderedDict()
+    if os.path.exists(filename + PROVENANCE_EXT):
+        with open(filename + PROVENANCE_EXT, 'r') as f:
+            for line in f:
+                if line.strip():
+                    run, _, source = line.rstrip('\n').rpartition('=')
+                    provenance[run] = source
+    return provenance
+
+
+def results_files(root):
+    """All results and kind results files under a results folder, relative to that folder"""
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if re.search(r"\.results(-[^.]+)?$", filename):
+                files.append(os.path.relpath(os.path.join(dirpath, filename), root))
+    return sorted(files)
+
+
+class Conflict:
+    def __init__(self, path, run, sources):
+        self.path = path
+        self.run = run
+        self.sources = sources
+
+    def __str__(self):
+        return "%s : %s has different results in %s" % (self.path, self.run, ', '.join(self.sources))
+
+
+def merge(sources, output, on_conflict='error', quiet=False):
+    """
+    Merge the results folders of multiple NPF invocations, such as the shards of a campaign
+    :param sources: List of results folders, such as results/ of each invocation
+    :param output: Results folder to write, it may be one of the sources
+    :param on_conflict: What to do when a run has different results in multiple sources. error refuses to
+                        write anything, first and last keep the results of the first or last source, append
+                        concatenates them.
+    :return: The list of conflicts found
+    """
+    merged = OrderedDict()  # path -> run -> results
+    origins = OrderedDict()  # path -> run -> [source]
+    conflicts = []
+    for source in sources:
+        for path in results_files(source):
+            filename = os.path.join(source, path)
+            provenance = read_provenance(filename)
+            results = merged.setdefault(path, OrderedDict())
+            origin = origins.setdefault(path, OrderedDict())
+            for run, run_results in read_results(filename).items():
+                where = provenance.get(run, source)
+                if run not in results:
+                    results[run] = run_results
+                    origin[run] = [where]
+                    continue
+                if where not in origin[run]:
+                    origin[run].append(where)
+                if run_results == results[run]:
+                    continue
+                conflicts.append(Conflict(path, run, origin[run]))
+                if on_conflict == 'last':
+                    results[run] = run_results
+                elif on_conflict == 'append':
+                    for t, values in run_results.items():
+                        results[run].setdefault(t, []).extend(values)
+
+    if conflicts and not quiet:
+        for conflict in conflicts:
+            print(conflict)
+    if conflicts and on_conflict == 'error':
+        return conflicts
+
+    for path, results in merged.items():
+        filename = os.path.join(output, path)
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            for run, run_results in results.items():
+                f.write(format_line(run, run_results))
+        # Kind results share the runs of the main results file, only the latter has a provenance file
+        if path.endswith('.results'):
+            with open(filename + PROVENANCE_EXT, 'w') as f:
+                for run, where in origins[path].items():
+                    f.write("%s=%s\n" % (run, '+'.join(where)))
+        if not quiet:
+            print("Merged %d runs into %s" % (len(results), filename))
+    return conflicts
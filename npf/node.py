@@ -1,20 +1,42 @@
+import ipaddress
+import json
 import os
 import random
 import sys
 import re
 import socket
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from npf.executor.localexecutor import LocalExecutor
 from npf.executor.sshexecutor import SSHExecutor
 from npf.variable import Variable,get_bool
 from npf.nic import NIC
 from npf.executor.executor import Executor
-from npf import npf
+from npf import npf, trace
 
 
 class Node:
     _nodes = {}
+    _conntest_lock = threading.Lock()
+    CONNTEST_CACHE = '.conntest.json'
+    NICS_CACHE = '.nics.json'
+    BOOT_ID = "echo boot_id=$(cat /proc/sys/kernel/random/boot_id 2> /dev/null);"
+
+    # Prints the boot id of the node, then if it is not the one given to the script, a line per NIC with its name,
+    # device path, MAC address, speed and IPv4 address
+    SYSFS_NICS = """boot_id=$(cat /proc/sys/kernel/random/boot_id 2> /dev/null)
+echo "boot_id=$boot_id"
+if [ -z "$boot_id" ] || [ "$boot_id" != "%s" ] ; then
+  for d in /sys/class/net/* ; do
+    if [ -e $d/device ] ; then
+      n=$(basename $d)
+      echo "nic=$n $(readlink -f $d/device) $(cat $d/address) $(cat $d/speed 2> /dev/null || echo 0) $(ip -4 -o addr show dev $n 2> /dev/null | awk '{print $4}' | head -n 1)"
+    fi
+  done
+fi"""
 
     def __init__(self, name, executor : Executor, tags):
         self.executor = executor
@@ -28,6 +50,8 @@ class Node:
         self.active_nics = range(32)
         self.multi = None
         self.mode = "bash"
+        # Known once the node was tested, to reuse the NICs found on the same boot
+        self.boot_id = None
 
         # Always fill 32 random nics address that will be overwriten by config eventually
         self._gen_random_nics()
@@ -53,6 +77,8 @@ class Node:
                 if match:
                     if match.group('var') == 'nfs':
                         self.nfs = get_bool(match.group('val'))
+                    elif match.group('var') == 'arch':
+                        self.arch = match.group('val')
                     setattr(executor, match.group('var'), match.group('val'))
                     continue
                 raise Exception("%s:%d : Unknown node config line %s" % (clusterFilePath, i, line))
@@ -97,14 +123,111 @@ class Node:
     def _find_nics(self):
         if self.parsed:
             return
+        cache = self._nics_cache()
+        cached = cache.get(self.name, {})
+        if self.boot_id and cached.get('boot_id', None) == self.boot_id:
+            self._set_nics(self._nics_from_cache(cached))
+            return
         print("Looking for NICs on %s..." % self.name)
         if not npf.options.cluster_autosave:
             print("To avoid this message write down the configuration in cluster/%s.node or run again NPF with --cluster-autosave to create the file automatically." % (self.name))
+        nics = self._find_nics_sysfs(cached)
+        if nics is None:
+            nics = self._find_nics_lshw()
+            if nics is None:
+                return
+        self._set_nics(nics)
+
+    def _find_nics_sysfs(self, cached):
+        """
+        NICs of the node found in /sys/class/net in a single command, without sudo. The NICs found on the same boot
+        of the node are reused.
+        :return: The NICs, or None if they could not be found that way
+        """
+        pid, out, err, ret = self.executor.exec(cmd=self.SYSFS_NICS % cached.get('boot_id', ''), title="Listing network devices")
+        if ret != 0:
+            return None
+        nics = []
+        boot_id = None
+        for line in out.splitlines():
+            line = line.strip()
+            if line.startswith('boot_id='):
+                boot_id = line[len('boot_id='):] or None
+                continue
+            if not line.startswith('nic='):
+                continue
+            words = line[len('nic='):].split()
+            if len(words) < 4:
+                continue
+            # The PCI address is the closest parent of the device looking like one (virtio devices are on a PCI device)
+            pci = ''
+            for part in reversed(words[1].split('/')):
+                if re.match(r'^[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-9a-f]$', part, re.IGNORECASE):
+                    pci = part
+                    break
+            ip, mask = '', '255.255.255.0'
+            if len(words) > 4:
+                try:
+                    interface = ipaddress.ip_interface(words[4])
+                    ip, mask = str(interface.ip), str(interface.netmask)
+                except ValueError:
+                    pass
+            nic = NIC(pci=pci, mac=words[2], ip=ip, ip6="", ifname=words[0], mask=mask)
+            try:
+                nic.speed = max(0, int(words[3]))
+            except ValueError:
+                nic.speed = 0
+            nics.append(nic)
+        if boot_id and boot_id == cached.get('boot_id', None):
+            self.boot_id = boot_id
+            return self._nics_from_cache(cached)
+        if not nics:
+            return None
+        self.boot_id = boot_id
+        if boot_id:
+            self._nics_cached(nics)
+        return nics
+
+    @classmethod
+    def _nics_cache(cls) -> dict:
+        """The NICs found on each node, with the boot id of the node when they were found"""
+        path = npf.get_build_path() + cls.NICS_CACHE
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    @staticmethod
+    def _nics_from_cache(cached):
+        nics = []
+        for n in cached['nics']:
+            nic = NIC(pci=n['pci'], mac=n['mac'], ip=n['ip'], ip6="", ifname=n['ifname'], mask=n['mask'])
+            nic.speed = n['speed']
+            nics.append(nic)
+        return nics
+
+    def _nics_cached(self, nics):
+        path = npf.get_build_path() + self.NICS_CACHE
+        with Node._conntest_lock:
+            cache = self._nics_cache()
+            cache[self.name] = {'boot_id': self.boot_id,
+                                'nics': [{'pci': n.pci, 'mac': n.mac, 'ip': n.ip, 'ifname': n.ifname, 'mask': n.mask,
+                                          'speed': n.speed} for n in nics]}
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(cache, f, indent=1)
+            os.replace(path + '.tmp', path)
+
+    def _find_nics_lshw(self):
+        """NICs found with lshw and a command per NIC, for nodes without /sys/class/net"""
         pid, out, err, ret = self.executor.exec(cmd="sudo lshw -class network -businfo -quiet", title="Listing network devices")
         if ret != 0:
             print("WARNING: %s has no configuration file and the NICs could not be found automatically. Please refer to the cluster documentation in NPF to define NIC order and addresses." % self.name)
             print(out)
-            return
+            return None
 
         header=out[:out.find('====')].splitlines()[-1]
         descpos = header.find('Description') - 1
@@ -136,26 +259,138 @@ class Node:
             nic = NIC(pci=words[0][4:], mac=mac, ip=ip, ip6="", ifname=words[1])
             nic.speed = speed
             speeds[speed].append(nic)
+        return [nic for speed in reversed(sorted(speeds.keys())) for nic in speeds[speed]]
+
+    def _set_nics(self, nics):
+        """Use the NICs found on the node, the fastest first, then in the order of their PCI address"""
         i = 0
         conf=""
         nl="\n"
 
-        for speed in reversed(sorted(speeds.keys())):
-            for n in speeds[speed]:
-                self._nics[i] = n
-                conf += "%d:pci=%s" % (i, n.pci) + nl
-                conf += "%d:ifname=%s" % (i, n.ifname)  + nl
-                #print("%d:speed=%s" % (i, n.speed))
-                conf += "%d:mac=%s" % (i, n.mac) + nl
-                if n.ip:
-                    conf += "%d:ip=%s" % (i, n.ip) + nl
-                i = i + 1
+        for n in sorted(nics, key=lambda n: (-n.speed, not n.pci, n.pci.lower(), n.ifname)):
+            self._nics[i] = n
+            conf += "%d:pci=%s" % (i, n.pci) + nl
+            conf += "%d:ifname=%s" % (i, n.ifname)  + nl
+            #print("%d:speed=%s" % (i, n.speed))
+            conf += "%d:mac=%s" % (i, n.mac) + nl
+            if n.ip:
+                conf += "%d:ip=%s" % (i, n.ip) + nl
+            i = i + 1
         print(conf)
         if npf.options.cluster_autosave:
             os.makedirs("cluster", exist_ok=True)
             open("cluster/%s.node" % self.name, 'w').write(conf)
 
 
+    def _conntest_key(self) -> str:
+        return "%s@%s:%s:%s nfs=%d agent=%s" % (self.executor.user, self.executor.addr, self.executor.port,
+                                                self.experiment_path(), self.nfs, self.executor.agent)
+
+    @classmethod
+    def _conntest_cache(cls) -> dict:
+        """The time of the last successful access check of each node"""
+        path = npf.get_build_path() + cls.CONNTEST_CACHE
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def _conntest_passed(self):
+        path = npf.get_build_path() + self.CONNTEST_CACHE
+        with Node._conntest_lock:
+            cache = self._conntest_cache()
+            cache[self._conntest_key()] = time.time()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(cache, f, indent=1)
+            os.replace(path + '.tmp', path)
+
+    def conntest(self, options):
+        """Check that the node can be reached, that it sees the experiment folder and that it has the dependencies of
+        the executor. A successful check is remembered for --conntest-ttl seconds."""
+        ttl = getattr(options, 'conntest_ttl', 0)
+        if ttl and time.time() - self._conntest_cache().get(self._conntest_key(), 0) < ttl:
+            if not options.quiet:
+                print("Connection to %s was tested less than %ds ago" % (self.executor.addr, ttl))
+            return
+        print("Testing connection to %s..." % self.executor.addr)
+        time.sleep(0.01)
+        if not self.nfs:
+            print("Remote is not shared through nfs... Sending .access_test")
+            assert(isinstance(self.executor, SSHExecutor))
+            try:
+
+                self.executor.sendFolder(".access_test", local=npf.experiment_path())
+            except FileNotFoundError as e:
+                print("While checking if file .access_test can be sent from local path %s to remote %s" % (npf.experiment_path(),self.executor.addr))
+                raise e
+
+        if self.executor.agent:
+            # The agent gives a PTY to the scripts, unbuffer is not needed
+            pid, out, err, ret = self.executor.exec(cmd="pwd;ls -al;" + self.BOOT_ID + "test -e " + ".access_test" + " && echo 'access_ok' && sudo echo 'test'", raw=True, title="Agent connection test")
+        else:
+            pid, out, err, ret = self.executor.exec(cmd="pwd;ls -al;" + self.BOOT_ID + "test -e " + ".access_test" + " && echo 'access_ok' && if ! type 'unbuffer' ; then ( ( sudo apt-get update && sudo apt-get install -y expect ) || sudo yum install -y expect ) && sudo echo 'test' ; else sudo echo 'test' ; fi", raw=True, title="SSH dependencies installation")
+        out = out.strip()
+        for line in out.splitlines():
+            if line.startswith('boot_id=') and len(line) > len('boot_id='):
+                self.boot_id = line[len('boot_id='):].strip()
+
+        if not self.nfs:
+            self.executor.deleteFolder(".access_test")
+        if ret != 0:
+            #Something was wrong, try first with a more basic test to help the user pinpoint the problem
+            pidT, outT, errT, retT = self.executor.exec(cmd="echo -n 'test'", raw=True, title="SSH echo test")
+            if retT != 0 or outT.split("\n")[-1] != "test":
+                raise Exception("Could not communicate with%s node %s, got return code %d : %s" %  (" user "+ self.executor.user if self.executor.user else "", self.executor.addr, retT, outT + errT))
+            if not "access_ok" in out:
+                raise Exception(("Could not find the access test file at %s on %s. Verify the path= paramater in the cluster file and that this directory already exists. It must match --experiment-folder on the remote equivalent when nfs is active. If the path is not shared accross clusters, ensure you set nfs=0 in the cluster file.\n\nIf you think the above is not correct, please paste the output of the test script below to the github issues:\n" % (self.executor.path, self.executor.addr)) + "\n---" + out + err + "\n---")
+            if out.split("\n")[-1] != "test":
+                raise Exception("Could not communicate with user %s on node %s, unbuffer (expect package) could not be installed, or passwordless sudo is not working, got return code %d : %s" %  (self.executor.user, self.executor.addr, ret, out + err))
+        self._conntest_passed()
+
+    def bring_up(self, options):
+        """Resolve, test and discover the NICs of a node, the time of each step being kept in bring_up_times"""
+        self.bring_up_times = OrderedDict()
+        start = time.time()
+        if options.do_test and options.do_conntest:
+            try:
+                self.ip = socket.gethostbyname(self.executor.addr)
+            except Exception as e:
+                print("Could not resolve hostname '%s'" % self.executor.addr)
+                raise(e)
+            self.bring_up_times['resolve'] = time.time() - start
+            with trace.span("connection test", node=self.name):
+                self.conntest(options)
+            self.bring_up_times['access'] = time.time() - start - self.bring_up_times['resolve']
+        if options.do_test:
+            t = time.time()
+            with trace.span("find NICs", node=self.name):
+                self._find_nics()
+            self.bring_up_times['nics'] = time.time() - t
+        self.bring_up_times['total'] = time.time() - start
+
+    @classmethod
+    def bring_up_all(cls, nodes, options):
+        """Bring up nodes concurrently, with at most --bring-up-jobs at once, then print the time each one took"""
+        nodes = list(OrderedDict((id(node), node) for node in nodes).values())
+        if not nodes:
+            return
+        with ThreadPoolExecutor(max_workers=max(1, min(getattr(options, 'bring_up_jobs', 8), len(nodes)))) as pool:
+            for future in [pool.submit(node.bring_up, options) for node in nodes]:
+                future.result()
+        if options.quiet or not any(node.bring_up_times.get('total', 0) > 0.1 for node in nodes):
+            return
+        steps = ['resolve', 'access', 'nics', 'total']
+        width = max(len(node.name) for node in nodes)
+        print("Node bring-up times (s) :")
+        print("  %s  %s" % ("node".ljust(width), "  ".join("%8s" % step for step in steps)))
+        for node in nodes:
+            print("  %s  %s" % (node.name.ljust(width), "  ".join(
+                "%8.2f" % node.bring_up_times[step] if step in node.bring_up_times else "%8s" % "-" for step in steps)))
+
     @classmethod
     def makeLocal(cls, options, test_access = True):
         node = cls._nodes.get('localhost', None)
@@ -170,7 +405,7 @@ class Node:
         return node
 
     @classmethod
-    def makeSSH(cls, user, addr, path, options, port=22, nfs=None):
+    def makeSSH(cls, user, addr, path, options, port=22, nfs=None, agent=None, relay=None, bring_up=True):
         if path is None:
             path = os.path.abspath(npf.experiment_path())
         node = cls._nodes.get(addr, None)
@@ -178,42 +413,18 @@ class Node:
             return node
         sshex = SSHExecutor(user, addr, path, port)
         node = Node(addr, sshex, options.tags)
+        if agent:
+            sshex.agent = agent
+        if relay:
+            sshex.relay = relay
+        if not sshex.agent and getattr(options, 'agent', None):
+            sshex.agent = options.agent
+        if sshex.relay and not sshex.agent:
+            sshex.agent = 'tcp'
         if nfs is not None:
             node.nfs = nfs
         cls._nodes[addr] = node
 
-        if options.do_test and options.do_conntest:
-            try:
-                node.ip = socket.gethostbyname(node.executor.addr)
-            except Exception as e:
-                print("Could not resolve hostname '%s'" % node.executor.addr)
-                raise(e)
-            print("Testing connection to %s..." % node.executor.addr)
-            time.sleep(0.01)
-            if not node.nfs:
-                print("Remote is not shared through nfs... Sending .access_test")
-                assert(isinstance(node.executor, SSHExecutor))
-                try:
-
-                    node.executor.sendFolder(".access_test", local=npf.experiment_path())
-                except FileNotFoundError as e:
-                    print("While checking if file .access_test can be sent from local path %s to remote %s" % (npf.experiment_path(),node.executor.addr))
-                    raise e
-
-            pid, out, err, ret = sshex.exec(cmd="pwd;ls -al;test -e " + ".access_test" + " && echo 'access_ok' && if ! type 'unbuffer' ; then ( ( sudo apt-get update && sudo apt-get install -y expect ) || sudo yum install -y expect ) && sudo echo 'test' ; else sudo echo 'test' ; fi", raw=True, title="SSH dependencies installation")
-            out = out.strip()
-
-            if not node.nfs:
-                node.executor.deleteFolder(".access_test")
-            if ret != 0:
-                #Something was wrong, try first with a more basic test to help the user pinpoint the problem
-                pidT, outT, errT, retT = sshex.exec(cmd="echo -n 'test'", raw=True, title="SSH echo test")
-                if retT != 0 or outT.split("\n")[-1] != "test":
-                    raise Exception("Could not communicate with%s node %s, got return code %d : %s" %  (" user "+ sshex.user if sshex.user else "", sshex.addr, retT, outT + errT))
-                if not "access_ok" in out:
-                    raise Exception(("Could not find the access test file at %s on %s. Verify the path= paramater in the cluster file and that this directory already exists. It must match --experiment-folder on the remote equivalent when nfs is active. If the path is not shared accross clusters, ensure you set nfs=0 in the cluster file.\n\nIf you think the above is not correct, please paste the output of the test script below to the github issues:\n" % (sshex.path, sshex.addr)) + "\n---" + out + err + "\n---")
-                if out.split("\n")[-1] != "test":
-                    raise Exception("Could not communicate with user %s on node %s, unbuffer (expect package) could not be installed, or passwordless sudo is not working, got return code %d : %s" %  (sshex.user, sshex.addr, ret, out + err))
-        if options.do_test:
-            node._find_nics()
+        if bring_up:
+            node.bring_up(options)
         return node
@@ -9,6 +9,7 @@ import re
 from decimal import Decimal
 
 from npf.node import Node
+from npf import trace
 from .variable import VariableFactory
 
 import numpy as np
@@ -44,6 +45,8 @@ def add_verbosity_options(parser: ArgumentParser):
                    default=False)
 
     v.add_argument('--quiet', help='Quiet mode', dest='quiet', action='store_true', default=False)
+    v.add_argument('--console-rate', metavar='lines', type=int, default=500, dest='console_rate',
+                   help='Lines of output printed per second for each script, the others are only counted. 0 prints all of them')
     v.add_argument('--quiet-regression', help='Do not tell about the regression process', dest='quiet_regression',
                     action='store_true', default=False)
 
@@ -130,12 +133,21 @@ def add_testing_options(parser: ArgumentParser, regression: bool = False):
                     help='Force re-doing all tests even if data for the given version and '
                          'variables is already known, and replace it', dest='force_retest', action='store_true',
                     default=False)
+    tf.add_argument('--reparse',
+                    help='Do not run any tests, parse again the outputs of the previous runs archived with '
+                         '--output-archive to replace their results, for instance after changing result_regex, pyexit '
+                         'or var_repeat', dest='reparse',
+                    action='store_true', default=False)
     t.add_argument('--no-init',
                    help='Do not run any init scripts', dest='do_init', action='store_false',
                    default=True)
     t.add_argument('--no-conntest',
                    help='Do not run connection tests', dest='do_conntest', action='store_false',
                    default=True)
+    t.add_argument('--conntest-ttl', metavar='seconds', type=int, default=3600, dest='conntest_ttl',
+                   help='Do not test again the connection to a node that passed the test less than this time ago. 0 always tests the nodes')
+    t.add_argument('--bring-up-jobs', metavar='N', type=int, default=8, dest='bring_up_jobs',
+                   help='Number of nodes tested and inspected at once at startup')
     t.add_argument('--max-results',
                    help='Count the number of valid previous tests as the maxium number of points in all tests, instead of the minimum', dest='min_test', action='store_false',
                    default=True)
@@ -166,15 +178,49 @@ def add_testing_options(parser: ArgumentParser, regression: bool = False):
     t.add_argument('--no-mp', dest='allow_mp', action='store_false',
                    default=True, help='Run tests in the same thread. If there is multiple script, they will run '
                                       'one after the other, hence breaking most of the tests.')
-    t.add_argument('--expand', type=str, default=None, dest="expand")
+    t.add_argument('--engine', choices=['pool', 'async'], default='pool', dest='engine',
+                   help='How the scripts of a run are executed : a process per script (pool), or all of them in a '
+                        'single asyncio event loop (async). The "engine" configuration of a test overrides it')
+    t.add_argument('--expand', type=str, default=None, dest="expand",
+                   help='Order in which variables combinations are tested. By default all combinations are tested, shuffle tests them in a random order, bayesian tests --expand-budget combinations chosen to find the best --expand-objective, active measures only the combinations a model cannot predict and writes the completed surface, lhs, sobol, halton and fracfact test the --expand-budget combinations of an experimental design')
+    t.add_argument('--expand-budget', metavar='N', type=int, default=None, dest="expand_budget",
+                   help='Number of combinations to test when the expansion method does not test all of them')
+    t.add_argument('--expand-objective', metavar='result', type=str, default=None, dest="expand_objective",
+                   help='Result type to maximize with --expand bayesian. Prefix it with - to minimize it instead')
+    t.add_argument('--expand-batch', metavar='N', type=int, default=None, dest="expand_batch",
+                   help='Number of combinations tested between two fits of the model with --expand active')
+    t.add_argument('--expand-tolerance', metavar='ratio', type=float, default=None, dest="expand_tolerance",
+                   help='Relative uncertainty of the model under which a combination is predicted instead of tested with --expand active. Default 0.05')
+    t.add_argument('--expand-seed', metavar='seed', type=int, default=None, dest="expand_seed",
+                   help='Seed for the random choices of the expansion method, to make them reproducible')
+    t.add_argument('--shard', metavar='i/N', type=str, default=None, dest="shard",
+                   help='Only test the i-th of N slices of the variables combinations, balanced by the run_cost configuration. Results of all shards can be merged with npf-merge.py')
+    t.add_argument('--setup-ahead', dest='setup_ahead', action='store_true', default=False,
+                   help='Prepare the files and parameters of the next combination while the current one runs')
+    t.add_argument('--output-memory', metavar='chars', type=int, default=1 << 20, dest='output_memory',
+                   help='Size of the output of a script or a run kept in memory. Larger outputs are written to files in the test folder, where results are parsed from')
+    t.add_argument('--dry-run', dest='dry_run', action='store_true', default=False,
+                   help='Do not run any tests, print the combinations that would be tested and their number of runs')
+    t.add_argument('--estimate', dest='estimate', action='store_true', default=False,
+                   help='Like --dry-run, also estimating how long the runs would take from the wall time of the previous runs, or from the delays and timeouts of the scripts')
+    t.add_argument('--trace', metavar='file', type=str, default=None, dest='trace',
+                   help='Write the timeline of the campaign to file in the Chrome trace format, to open with chrome://tracing or ui.perfetto.dev')
+    t.add_argument('--output-archive', metavar='SIZE', type=str, default='0', dest='output_archive',
+                   help='Keep up to SIZE (e.g. 1G) of compressed outputs of the runs for each test and version in the results folder, so they can be parsed again with --reparse. The outputs of the combinations run the longest ago are removed first. 0, the default, disables it')
     t.add_argument('--rand-env', type=int, default=65536, dest="rand_env")
-    t.add_argument('--experimental-design', type=str, default="matrix.csv", help="The path towards the experimental design point selection file")
+    t.add_argument('--experimental-design', type=str, default="matrix.csv", help="The path towards the experimental design point selection file, or the name of a design to generate for ranges with an empty step : lhs, sobol, halton or fracfact")
+    t.add_argument('--experimental-design-points', metavar='N', type=int, default=None, dest="experimental_design_points", help="Number of points of the generated experimental design. Default is 10 per variable")
+    t.add_argument('--experimental-design-seed', metavar='seed', type=int, default=0, dest="experimental_design_seed", help="Seed of the generated experimental design")
 
     c = parser.add_argument_group('Cluster options')
-    c.add_argument('--cluster', metavar='role=user@address:path [...]', type=str, nargs='*', default=[],
-                   help='role to node mapping for remote execution of tests. The format is role=address, where address can be an address or a file in cluster/address.node describing supplementary parameters for the node.')
+    c.add_argument('--cluster', metavar='role=user@address:path [...]', type=str, nargs='*', default=[], action='append',
+                   help='role to node mapping for remote execution of tests. The format is role=address, where address can be an address or a file in cluster/address.node describing supplementary parameters for the node. Repeat --cluster to declare multiple equivalent testbeds (slots), variables combinations will then run concurrently, one per slot.')
     c.add_argument('--cluster-autosave', default=False, action='store_true', dest='cluster_autosave',
                     help='Automatically save NICs found on the machine. If the file cluster/address.node does not exists, NPF will attempt to auto-discover NICs. If this option is set, it will auto-create the file.')
+    c.add_argument('--agent', metavar='ssh|tcp:PORT', type=str, default=None, dest='agent',
+                   help='Run the scripts of remote nodes through the NPF agent deployed on them instead of a SSH session per script, speaking through a SSH session (ssh) or a TCP connection (tcp:PORT). The agent= parameter of a cluster file overrides it. With relay=address in the cluster file or the --cluster mapping of a node, its scripts go through the agent of the relay node, so a single connection serves a whole group of nodes')
+    c.add_argument('--agent-filter', default=False, action='store_true', dest='agent_filter',
+                   help='With --quiet, agents only send back the RESULT and EVENT lines of the output of the scripts')
 
 
     return t
@@ -205,11 +251,29 @@ def add_building_options(parser):
     b.add_argument('--force-build-deps',
                     help='Force to rebuild some dependencies', dest='force_build_deps',
                    action=ExtendAction, default=[], nargs='+')
+    b.add_argument('--build-ahead',
+                    help='Check out and build up to N next versions in the background while the current one is '
+                         'tested, each in a folder of its own', dest='build_ahead', type=int, default=0, metavar='N')
+    b.add_argument('--build-cache',
+                    help='Size of the cache of binaries of past builds, restored instead of building a version '
+                         'again, e.g. 4G. It is disabled by default, as it does not know the versions of the '
+                         'libraries the binaries were built against : empty build/.cache when they change',
+                    dest='build_cache', type=str, default='0', metavar='SIZE')
+    b.add_argument('--build-jobs',
+                    help='Number of parallel jobs shared by the dependencies built at the same time, by default '
+                         'the number of cores', dest='build_jobs', type=int, default=None, metavar='N')
+    b.add_argument('--git-clone',
+                    help='How to clone git repositories. full clones share the objects of all the repositories of '
+                         'the same URL, partial downloads file contents only when needed, shallow only the last '
+                         'commit, when older versions are not tested', dest='git_clone',
+                    choices=['full', 'partial', 'shallow'], default='full')
     return b
 
 nodePattern = regex.compile(
     "(?P<role>[a-zA-Z0-9]+)=(:?(?P<user>[a-zA-Z0-9]+)@)?(?P<addr>[a-zA-Z0-9.-]+)(:?[:](?P<path>[a-zA-Z0-9_./~-]+))?")
 roles = {}
+# One role mapping per equivalent testbed given with a repeated --cluster. roles is the one of the first slot.
+slots = []
 
 
 def nodes_for_role(role, self_role=None, self_node=None, default_role_map={}):
@@ -252,6 +316,13 @@ def parse_nodes(args):
     else:
         options._build_path = npf_writeable_root_path()+'/build/'
 
+    if options.trace:
+        trace.start(options.trace)
+
+    if options.reparse or options.dry_run or options.estimate:
+        # Results are parsed again from the archived outputs, or only planned, nothing is built nor run
+        options.no_build = True
+
     if type(options.use_last) is not int:
         if options.use_last:
             options.use_last = 100
@@ -265,8 +336,6 @@ def parse_nodes(args):
     # Create the test file
     os.close(os.open(experiment_path() + ".access_test" , os.O_CREAT))
     local = Node.makeLocal(options)
-    #Delete the test file
-    os.unlink(experiment_path() + ".access_test")
 
     roles['default'] = [local]
 
@@ -274,10 +343,33 @@ def parse_nodes(args):
     for t in [options.test_files]:
         options.search_path.add(os.path.dirname(t))
 
-    for val in options.cluster:
+    slots.clear()
+    try:
+        for group in options.cluster:
+            slots.append(parse_roles(group, local))
+        # All the nodes are tested at once
+        if not (options.reparse or options.dry_run or options.estimate):
+            Node.bring_up_all([node for slot in slots for nodes in slot.values() for node in nodes if node is not local],
+                              options)
+    finally:
+        #Delete the test file if it still exists (if a remote is the local machine, it won't)
+        if os.path.exists(experiment_path() + ".access_test"):
+            os.unlink(experiment_path() + ".access_test")
+    if not slots:
+        slots.append({})
+    roles.update(slots[0])
+    for slot in slots:
+        slot.setdefault('default', [local])
 
-        # Create the test file
-        os.close(os.open(experiment_path() + ".access_test" , os.O_CREAT))
+def parse_roles(cluster, local):
+    """
+    Parse one --cluster group of role=node mappings
+    :param cluster: List of mapping strings
+    :param local: The local node, used for localhost
+    :return: A dict of role to list of nodes
+    """
+    slot_roles = {}
+    for val in cluster:
 
         variables : list[str] = val.split(',')
         if len(variables) == 0:
@@ -292,14 +384,20 @@ def parse_nodes(args):
         del variables[0]
 
         nfs = None
+        agent = None
+        relay = None
         assert isinstance(variables, list)
-        for opts in variables:
+        for opts in list(variables):
             assert isinstance(opts, str)
             var,val = opts.split('=')
             if var == "nfs":
                 nfs = int(val)
             elif var == "path":
                 path = val
+            elif var == "agent":
+                agent = val
+            elif var == "relay":
+                relay = val
             else:
                 continue
             variables.remove(opts)
@@ -308,13 +406,13 @@ def parse_nodes(args):
             node = local
         else:
             node = Node.makeSSH(user=match.group('user'), addr=match.group('addr'), path=path,
-                            options=options, nfs=nfs)
+                            options=options, nfs=nfs, agent=agent, relay=relay, bring_up=False)
         role = match.group('role')
-        if role in roles:
-            roles[role].append(node)
+        if role in slot_roles:
+            slot_roles[role].append(node)
             print("Role %s has multiple nodes. The role will be executed by multiple machines. If this is not intended, fix your --cluster option." % role)
         else:
-            roles[role] = [node]
+            slot_roles[role] = [node]
 
         for opts in variables:
             var,val = opts.split('=')
@@ -326,10 +424,7 @@ def parse_nodes(args):
                 node.mode = val
             else:
                 raise Exception("Unknown cluster variable : %s" % var)
-
-        #Delete the test file if it still exists (if the remote is the local machine, it won't)
-        if os.path.exists(experiment_path() + ".access_test"):
-            os.unlink(experiment_path() + ".access_test")
+    return slot_roles
 
 def parse_variables(args_variables, tags, sec) -> Dict:
     variables = {}
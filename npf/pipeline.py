@@ -0,0 +1,129 @@
+import os
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class BuildPipeline:
+    """Build the next versions of a repository while the current one is tested. Each build is isolated in a
+    folder of its own, so checking out and compiling a version does not touch the binaries in use. Builds
+    are done one at a time in a background thread, at most depth of them ahead of the build being tested.
+    Iterating gives the builds in order, with whether they succeeded, once they are done. A build is
+    activated before being given, so the repository and the tests use its folder.
+
+    The builds take turns in depth + 1 folders : a folder is used again once the version built in it was
+    tested, so the next versions are built incrementally and the folders do not pile up."""
+
+    def __init__(self, builds, options, depth=1):
+        self.builds = list(builds)
+        self.options = options
+        self.depth = max(depth, 0)
+        for i, build in enumerate(self.builds):
+            build.isolate(str(i % (self.depth + 1)))
+
+    def _build(self, build):
+        return build.build(self.options.force_build, self.options.no_build, self.options.quiet_build,
+                           self.options.show_build_cmd, activate=False)
+
+    def __len__(self):
+        return len(self.builds)
+
+    def __iter__(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = deque()
+            remaining = deque(self.builds)
+
+            def submit():
+                build = remaining.popleft()
+                pending.append((build, executor.submit(self._build, build)))
+
+            while pending or remaining:
+                if not pending:
+                    submit()
+                build, future = pending.popleft()
+                # Keep depth builds going on behind the one about to be tested
+                while remaining and len(pending) < self.depth:
+                    submit()
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    print("Could not build %s : %s" % (build.version, e))
+                    ok = False
+                if ok:
+                    build.prebuilt = True
+                    build.activate()
+                yield build, ok
+
+
+class BuildGraph:
+    """Build repositories concurrently, each once all the repositories it comes after are built. The jobs
+    budget is shared between the builds running at the same time, by replacing the -j of their make command.
+    A repository whose dependency failed to build is not built either."""
+
+    def __init__(self, jobs=None):
+        self.jobs = max(jobs if jobs else os.cpu_count() or 1, 1)
+        self.nodes = OrderedDict()  # name -> (build, kwargs of Build.build)
+        self.after = OrderedDict()  # name -> names of the repositories to build before it
+
+    def add(self, name, build, after=(), **kwargs):
+        self.nodes[name] = (build, kwargs)
+        self.after[name] = set(after)
+
+    def _order(self):
+        """The names in topological order, only to reject cycles before building anything"""
+        order = []
+        visiting = set()
+
+        def visit(name, path):
+            if name in order:
+                return
+            if name in visiting:
+                raise Exception("Circular build dependency : %s" % ' -> '.join(path + [name]))
+            visiting.add(name)
+            for dep in sorted(self.after[name]):
+                if dep in self.nodes:
+                    visit(dep, path + [name])
+            order.append(name)
+
+        for name in self.nodes:
+            visit(name, [])
+        return order
+
+    def run(self) -> list:
+        """Build everything
+        :return: The names of the repositories that could not be built
+        """
+        pending = self._order()
+        built = set()
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            running = {}  # future -> name
+            while pending or running:
+                for name in list(pending):
+                    deps = self.after[name] & set(self.nodes.keys())
+                    if any(dep in failed for dep in deps):
+                        print("Not building %s, as %s could not be built" % (name, ', '.join(d for d in deps if d in failed)))
+                        pending.remove(name)
+                        failed.append(name)
+                ready = [name for name in pending if self.after[name] & set(self.nodes.keys()) <= built]
+                ready = ready[:self.jobs - len(running)]
+                if ready:
+                    share = max(1, self.jobs // (len(running) + len(ready)))
+                    for name in ready:
+                        pending.remove(name)
+                        build, kwargs = self.nodes[name]
+                        running[executor.submit(build.build, jobs=share, **kwargs)] = name
+                if not running:
+                    continue
+                finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        ok = future.result()
+                    except Exception as e:
+                        print("Could not build %s : %s" % (name, e))
+                        ok = False
+                    if ok:
+                        built.add(name)
+                    else:
+                        failed.append(name)
+        return failed
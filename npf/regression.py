@@ -123,19 +123,22 @@ class Regression:
             build.writeversion(test, all_results, allow_overwrite = True)
         return tests_passed, tests_total
 
-    def regress_all_tests(self, tests: List['Test'], options, history: int = 1, on_finish = None, iserie=0, nseries=1) -> Tuple[Build, List[Dataset]]:
+    def regress_all_tests(self, tests: List['Test'], options, history: int = 1, on_finish = None, iserie=0, nseries=1, build: Build = None) -> Tuple[Build, List[Dataset]]:
         """
         Execute all tests passed in argument for the last build of the regressor associated repository
         :param history: Start regression at last build + 1 - history
         :param tests: List of tests
         :param options: Options object
+        :param build: The build to test, if already known, such as one built ahead by a BuildPipeline
         :return: the lastbuild and one Dataset per tests or None if could not build
         """
         repo = self.repo
         data_datasets = []
         kind_datasets = []
 
-        if repo.url:
+        if build is not None:
+            pass
+        elif repo.url:
             build = repo.get_last_build(history=history)
         else:
             build = Build(repo, 'local', result_path=options.result_path )
@@ -0,0 +1,98 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from npf import npf
+from npf.build import Build
+
+
+def local_root(bp, rbp):
+    """The local folder that corresponds to the root of a node, so that sending rbp from there sends bp"""
+    local = os.path.normpath(bp)
+    r = os.path.normpath(rbp)
+    while os.path.basename(local) == os.path.basename(r):
+        local = os.path.dirname(os.path.normpath(local))
+        r = os.path.dirname(os.path.normpath(r))
+    return local
+
+
+class RemoteBuild:
+    """Build a repository on the nodes themselves instead of sending the binaries built by NPF, for repositories
+    with remote_build=1 used on nodes that do not share NPF's build folder (nfs=0), which may have another
+    architecture. Only the sources are sent. Nodes of the same arch share a single build : it is done on the first
+    one, then its bin folder is brought back in build/.arch/<arch>/ and sent to the others. Nodes are built in
+    parallel, and like the local build each one has a .build_version so a version is only built once."""
+
+    def __init__(self, repo, options):
+        self.repo = repo
+        self.options = options
+        self.version = repo.current_version()
+
+    @staticmethod
+    def arch(node):
+        # Nodes without an arch could be anything, they do not share their build
+        return node.arch if node.arch else 'node-' + node.addr
+
+    def mirror(self, arch):
+        return npf.get_build_path() + '.arch/' + arch + '/'
+
+    def _exec(self, node, cmd):
+        env = OrderedDict(self.repo.env)
+        pid, out, err, ret = node.executor.exec(cmd=cmd, options=self.options, title='build ' + self.repo.reponame,
+                                                env=env)
+        return ret, out, err
+
+    def remote_version(self, node):
+        ret, out, err = self._exec(node, 'cat %s/.build_version 2> /dev/null || true' % self.repo.get_remote_build_path(node))
+        return out.strip() if ret == 0 and out.strip() else None
+
+    def _set_version(self, node):
+        ret, out, err = self._exec(node, 'echo %s > %s/.build_version' % (self.version, self.repo.get_remote_build_path(node)))
+        return ret == 0
+
+    def build_on(self, node) -> bool:
+        rbp = self.repo.get_remote_build_path(node)
+        if self.remote_version(node) == self.version and not self.repo.reponame in self.options.force_build_deps:
+            return True
+        if not self.options.quiet_build:
+            print("Building %s on %s..." % (self.repo.name, node.name))
+        node.executor.sendFolder(rbp, local_root(self.repo.get_build_path(), rbp))
+        build = Build(self.repo, self.version)
+        commands = [npf.replace_path(c, build=build) for c in [self.repo.configure, self.repo.clean, self.repo.make] if c]
+        ret, out, err = self._exec(node, 'cd %s && %s' % (rbp, ' && '.join(commands)))
+        if ret != 0:
+            print("Compilation of %s FAILED on %s :" % (self.repo.pretty_name(), node.name))
+            print(out)
+            print(err)
+            return False
+        return self._set_version(node)
+
+    def share(self, arch, builder, node) -> bool:
+        """Give node the bin folder built on builder, both having the same arch"""
+        if self.remote_version(node) == self.version:
+            return True
+        rbin = self.repo.get_remote_bin_folder(builder, version=self.version)
+        mirror = self.mirror(arch)
+        # Brought back once per version, for all the other nodes
+        done = mirror + '.' + self.repo.reponame + '.build_version'
+        if not os.path.exists(done) or open(done).read() != self.version:
+            os.makedirs(mirror, exist_ok=True)
+            builder.executor.recvFolder(rbin, mirror)
+            with open(done, 'w') as f:
+                f.write(self.version)
+        node.executor.sendFolder(self.repo.get_remote_bin_folder(node, version=self.version), mirror)
+        return self._set_version(node)
+
+    def _build_arch(self, arch, nodes) -> bool:
+        builder = nodes[0]
+        if not self.build_on(builder):
+            return False
+        return all(self.share(arch, builder, node) for node in nodes[1:])
+
+    def run(self, nodes) -> bool:
+        archs = OrderedDict()
+        for node in nodes:
+            archs.setdefault(self.arch(node), []).append(node)
+        with ThreadPoolExecutor(max_workers=len(archs)) as executor:
+            results = [executor.submit(self._build_arch, arch, nodes) for arch, nodes in archs.items()]
+            return all(r.result() for r in results)
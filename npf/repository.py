@@ -1,35 +1,106 @@
+import hashlib
 import os
-import tarfile
-import urllib
 from collections import OrderedDict
 from abc import ABCMeta
 from pathlib import Path
 import re
 from urllib.error import URLError
-import urllib.request
 
 import shutil
+import threading
 
 import gitdb
 
 from npf import npf
+from npf.npf import get_valid_filename
 from npf.build import Build
-from .variable import is_numeric, VariableFactory
+from npf.history import HistoryCache
+from npf.download import DownloadCache
+from .variable import is_numeric, VariableFactory, get_bool
 
 import git
 
 repo_variables = ['name', 'branch', 'configure', 'url', 'method', 'parent', 'tags', 'make', 'version', 'clean', 'build_info',
-                  'bin_folder', 'bin_name', 'env']
+                  'bin_folder', 'bin_name', 'env', 'remote_build', 'checksum']
 
 
 class Method(metaclass=ABCMeta):
+    # Whether checkout() can put a version in any folder, for builds having their own folder
+    isolated_checkout = False
+
     def __init__(self, repo):
         self.repo = repo
 
 
+class ObjectStore:
+    """
+    A bare repository per upstream URL, holding the objects of all the repositories cloned from that URL, such as
+    the variants of one project. Clones borrow its objects through git alternates instead of downloading the
+    whole history again, and it is fetched from the upstream once per run. Dependencies being built concurrently,
+    the store of a URL is created and fetched by one of them at a time.
+    """
+    _fetched = set()
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    @staticmethod
+    def path(url):
+        name = get_valid_filename(os.path.basename(url.rstrip('/')))
+        return npf.get_build_path() + '.objects/' + hashlib.sha1(url.encode()).hexdigest()[:12] + '-' + name
+
+    @classmethod
+    def update(cls, url, force=False, quiet=False):
+        """Create the store of url or fetch it if it was not done yet during this run
+        :return: The path of the store
+        """
+        with cls._locks_lock:
+            lock = cls._locks.setdefault(url, threading.Lock())
+        with lock:
+            path = ObjectStore.path(url)
+            if not os.path.exists(path):
+                store = git.Repo.init(path, bare=True)
+                store.create_remote('origin', url)
+            elif url in cls._fetched and not force:
+                return path
+            else:
+                store = git.Repo(path)
+            if not quiet:
+                print("Fetching %s in the shared object store..." % url)
+            store.git.fetch('origin', '--prune', '+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*')
+            cls._fetched.add(url)
+            return path
+
+
 class MethodGit(Method):
     __gitrepo = None
     _fetch_done = False
+    _history = None
+    isolated_checkout = True
+
+    def shared(self, gitrepo=None) -> bool:
+        """Whether the repository uses the shared object store, either the clone to do or the given one"""
+        if gitrepo is not None:
+            return os.path.exists(os.path.join(gitrepo.git_dir, 'objects', 'info', 'alternates'))
+        return getattr(self.repo.options, 'git_clone', 'full') == 'full'
+
+    def fetch(self, gitrepo, force=False):
+        if self.shared(gitrepo):
+            store = ObjectStore.update(self.repo.url, force=force, quiet=self.repo.options.quiet_build)
+            # The store has all the objects, this only updates the branches
+            gitrepo.git.fetch(store, '--prune', '+refs/heads/*:refs/remotes/origin/*', '+refs/tags/*:refs/tags/*')
+        else:
+            gitrepo.remotes.origin.fetch()
+
+    def clone(self, path) -> git.Repo:
+        mode = getattr(self.repo.options, 'git_clone', 'full')
+        if mode == 'shallow':
+            return git.Repo.clone_from(self.repo.url, path, depth=1, no_single_branch=True)
+        if mode == 'partial':
+            return git.Repo.clone_from(self.repo.url, path, filter='blob:none')
+        store = ObjectStore.update(self.repo.url, quiet=self.repo.options.quiet_build)
+        gitrepo = git.Repo.clone_from(store, path, reference=store)
+        gitrepo.remotes.origin.set_url(self.repo.url)
+        return gitrepo
 
     def gitrepo(self) -> git.Repo:
         if (self.__gitrepo):
@@ -38,11 +109,10 @@ class MethodGit(Method):
             return self.checkout()
 
     def get_last_versions(self, limit=100, branch=None, force_fetch=False):
-        origin = self.gitrepo().remote('origin')
         if not self.repo.options.no_build and (force_fetch or not self._fetch_done):
             if not self.repo.options.quiet_build:
                 print("Fetching last versions of %s..." % self.repo.reponame)
-            origin.fetch()
+            self.fetch(self.gitrepo(), force=force_fetch)
             self._fetch_done = True
 
         if branch is None:
@@ -58,16 +128,14 @@ class MethodGit(Method):
         versions = self.get_history(version=b_commit, limit = limit - 1)
         return [b_commit.hexsha[:7]] + versions
 
-    def get_history(self, version, limit=1):
-        versions = []
-        i_commit = next(self.gitrepo().iter_commits(version)).parents[0]
-        while len(versions) < limit:
-            versions.append(i_commit.hexsha[:7])
-            if len(i_commit.parents) == 0:
-                break
-            i_commit = i_commit.parents[0]
+    def history(self) -> HistoryCache:
+        if self._history is None:
+            self._history = HistoryCache(self.gitrepo())
+        return self._history
 
-        return versions
+    def get_history(self, version, limit=1):
+        # The first commit, or the last one of a shallow clone, has no parents
+        return [commit[:7] for commit in self.history().first_parents(version, limit + 1)[1:]]
 
 
     def is_checkout_needed(self, version):
@@ -76,22 +144,25 @@ class MethodGit(Method):
             return True
         return False
 
-    def checkout(self, branch=None) -> git.Repo:
+    def checkout(self, branch=None, path=None) -> git.Repo:
         """
         Checkout the repo to its folder, fetch if it already exists
         :param branch: An optional branch
+        :param path: Check out in this folder instead, as a worktree of the repo's folder
         :return:
         """
         if not branch:
             branch = self.repo.branch
 
+        if path and os.path.normpath(path) != os.path.normpath(self.repo.get_build_path()):
+            return self.checkout_worktree(branch, path)
+
         need_clone=False
         if os.path.exists(self.repo.get_build_path()):
             try:
                 gitrepo = git.Repo(self.repo.get_build_path())
-                o = gitrepo.remotes.origin
                 if not self.repo.options.no_build and not self._fetch_done:
-                    o.fetch()
+                    self.fetch(gitrepo)
                     self._fetch_done = True
             except git.exc.InvalidGitRepositoryError:
                 print("Path %s appear to be invalid" % self.repo.get_build_path())
@@ -103,7 +174,7 @@ class MethodGit(Method):
         if need_clone:
             if not self.repo.options.quiet_build:
                 print("Cloning %s from %s..." % (self.repo.reponame, self.repo.url))
-            gitrepo = git.Repo.clone_from(self.repo.url, self.repo.get_build_path())
+            gitrepo = self.clone(self.repo.get_build_path())
 
         if branch in gitrepo.remotes.origin.refs:
             c = gitrepo.remotes.origin.refs[branch]
@@ -119,6 +190,22 @@ class MethodGit(Method):
         self.__gitrepo = gitrepo
         return gitrepo
 
+    def checkout_worktree(self, version, path) -> git.Repo:
+        """
+        Checkout a version in its own folder. Worktrees share the objects of the repo's folder, but have their
+        own index and HEAD so they can be built concurrently.
+        """
+        gitrepo = self.gitrepo()
+        if not os.path.exists(os.path.join(path, '.git')):
+            gitrepo.git.worktree('prune')
+            if not self.repo.options.quiet_build:
+                print("Creating a worktree for %s at %s..." % (self.repo.reponame, path))
+            gitrepo.git.worktree('add', '--detach', '--force', path, version)
+        worktree = git.Repo(path)
+        if worktree.head.commit.hexsha[:len(version)] != version:
+            worktree.git.checkout('--detach', '--force', version)
+        return worktree
+
 
 class UnversionedMethod(Method, metaclass=ABCMeta):
     def __init__(self, repo):
@@ -134,29 +221,26 @@ class UnversionedMethod(Method, metaclass=ABCMeta):
 
 
 class MethodGet(UnversionedMethod):
-    def checkout(self, branch=None):
+    isolated_checkout = True
+
+    def checkout(self, branch=None, path=None):
         if branch is None:
             branch = self.repo.version
+        if path is None:
+            path = self.repo.get_build_path()
         url = npf.replace_path(self.repo.url,Build(self.repo,branch,self.repo.options.result_path))
-        if not Path(self.repo.get_build_path()).exists():
-            os.makedirs(self.repo.get_build_path())
+        if not Path(path).exists():
+            os.makedirs(path)
+        checksum = npf.replace_path(self.repo.checksum, Build(self.repo, branch)) if self.repo.checksum else None
         try:
-            proxy = urllib.request.ProxyHandler({})
-            opener = urllib.request.build_opener(proxy)
-            opener.addheaders = [('User-Agent', 'NPF')]
-            urllib.request.install_opener(opener)
-            filename, headers = urllib.request.urlretrieve(url, self.repo.get_build_path() + os.path.basename(url))
-        except URLError:
-            print("ERROR : Could not download %s : bad URL?" % url)
+            DownloadCache().get(url, checksum=checksum, extract_to=path)
+        except (URLError, OSError) as e:
+            print("ERROR : Could not download %s : bad URL? (%s)" % (url, e))
             return False
-        t = tarfile.open(filename)
-        t.extractall(self.repo.get_build_path())
-        t.close()
-        os.unlink(filename)
         return True
 
 class MethodLocal(UnversionedMethod):
-    def checkout(self, branch=None):
+    def checkout(self, branch=None, path=None):
         if branch is None:
             branch = self.repo.version
         if not Path(self.repo.get_build_path()).exists():
@@ -166,9 +250,13 @@ class MethodLocal(UnversionedMethod):
 
 
 class MethodPackage(UnversionedMethod):
-    def checkout(self, branch=None):
-        if not Path(self.repo.get_build_path()).exists():
-            os.makedirs(self.repo.get_build_path())
+    isolated_checkout = True
+
+    def checkout(self, branch=None, path=None):
+        if path is None:
+            path = self.repo.get_build_path()
+        if not Path(path).exists():
+            os.makedirs(path)
         return True
 
 
@@ -184,6 +272,7 @@ class Repository:
     def __init__(self, repo, options):
         self.name = None
         self._current_build = None
+        self._results_index = {}
 
         version = repo.split('@')
         if len(version) > 1:
@@ -205,6 +294,10 @@ class Repository:
         self.bin_name = self.reponame  # Wild guess that may work some times...
         self.build_info = None
         self.configure = ''
+        # Build on the nfs=0 nodes themselves instead of sending them the binaries built locally
+        self.remote_build = False
+        # Checksum of the archive of the get method, as algorithm:digest
+        self.checksum = None
         self._last_100 = None
 
         if self.reponame == 'None':
@@ -265,6 +358,8 @@ class Repository:
                     if not val in repo_methods:
                         raise Exception("Unknown method %s" % val)
                     val = repo_methods[val]
+                elif var == "remote_build":
+                    val = get_bool(val)
                 elif var == "tags":
                     if append:
                         self.tags += val.split(',')
@@ -333,9 +428,13 @@ class Repository:
     def get_build_path(self):
         return self._build_path
 
+    #Get the path of one of the build folders used in turn by the builds having their own folder
+    def get_isolated_build_path(self, folder):
+        return os.path.join(npf.get_build_path() + self.reponame + '.versions', get_valid_filename(folder), '')
+
     #Get the path to the binary folder of this build on a remote node
-    def get_remote_build_path(self, node):
-        bp = self.get_build_path()
+    def get_remote_build_path(self, node, build_path=None):
+        bp = build_path if build_path else self.get_build_path()
         if node.nfs:
             return bp
         if not bp:
@@ -350,13 +449,13 @@ class Repository:
         return os.path.basename(bp)
 
 
-    def get_local_bin_folder(self, version=None):
-        return self._get_bin_folder(version=version)
+    def get_local_bin_folder(self, version=None, build_path=None):
+        return self._get_bin_folder(version=version, build_path=build_path)
 
-    def get_remote_bin_folder(self, remote, version=None):
-        return self._get_bin_folder(version=version, remote=remote)
+    def get_remote_bin_folder(self, remote, version=None, build_path=None):
+        return self._get_bin_folder(version=version, remote=remote, build_path=build_path)
 
-    def _get_bin_folder(self, version=None, remote = None):
+    def _get_bin_folder(self, version=None, remote = None, build_path = None):
         if version is None:
             version = self.current_version()
         if version is None:
@@ -366,19 +465,19 @@ class Repository:
 
         # The folder where all the builds are made
         if remote:
-            bp = self.get_remote_build_path(node=remote)
+            bp = self.get_remote_build_path(node=remote, build_path=build_path)
         else:
-            bp = self.get_build_path()
+            bp = build_path if build_path else self.get_build_path()
         return os.path.join(bp,'') + ( os.path.join(bin_folder, '') if bin_folder else '')
 
-    def get_local_bin_path(self, version):
+    def get_local_bin_path(self, version, build_path=None):
         if version is None:
             version = self.current_version()
         if version is None:
             bin_name = self.bin_name
         else:
             bin_name = self.bin_name.replace('$version', version)
-        return self.get_local_bin_folder(version=version) + bin_name
+        return self.get_local_bin_folder(version=version, build_path=build_path) + bin_name
 
     def get_last_build(self, history: int = 1, stop_at: Build = None, with_results=False, force_fetch=False) -> Build:
         if self.version:
@@ -412,20 +511,34 @@ class Repository:
 
     def get_old_results(self, last_graph: Build, num_old: int, test):
         graphs_series = []
-        # Todo
-        parents = self.method.gitrepo().iter_commits(last_graph.version)
-        next(parents)  # The first commit is last_graph itself
-
-        for i, commit in enumerate(parents):  # Get old results for graph
-            g_build = Build(self, commit.hexsha[:7], self.options.result_path)
+        for version in self.method.get_history(last_graph.version, 100):  # Get old results for graph
+            g_build = Build(self, version, self.options.result_path)
             if not g_build.hasResults(test):
                 continue
             g_all_results = g_build.load_results(test)
             graphs_series.append((test, g_build, g_all_results))
-            if (i > 100 or len(graphs_series) == num_old):
+            if len(graphs_series) == num_old:
                 break
         return graphs_series
 
+    def results_index(self, result_folder, script=None) -> set:
+        """
+        The versions having results in result_folder, for the given test or any test. The folder is listed once, then
+        the index is kept until results are written.
+        """
+        key = (result_folder, script.filename if script else None)
+        if key not in self._results_index:
+            versions = set()
+            if os.path.isdir(result_folder):
+                for name in os.listdir(result_folder):
+                    if script is None:
+                        if name.endswith('.results'):
+                            versions.add(name[:-len('.results')])
+                    elif os.path.exists(os.path.join(result_folder, name, script.filename + '.results')):
+                        versions.add(name)
+            self._results_index[key] = versions
+        return self._results_index[key]
+
     def current_build(self):
         if self._current_build:
             return self._current_build
@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+
+from npf.archive import OutputArchive
+from npf.types.dataset import Run
+
+
+def format_duration(seconds) -> str:
+    if seconds < 10:
+        return "%.1fs" % seconds
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "%dh%02dm%02ds" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+    if seconds >= 60:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+
+class RunTimes:
+    """The wall time of the runs of each combination of variables of a test for a build, including the creation of
+    its files and the exit scripts, and the time of its init. They are kept next to the results, to estimate how long
+    the next runs will take."""
+
+    def __init__(self, build, test):
+        self.path = os.path.abspath(os.path.join(build.result_folder() + build.version, test.filename + '.times'))
+        self.test = test
+        self.lock = threading.Lock()
+        # Key of the combination -> {'variables': description, 'time': total seconds, 'runs': n, 'cost': run_cost}
+        self.runs = {}
+        self.init = None
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+                self.runs = data.get('runs', {})
+                self.init = data.get('init', None)
+            except ValueError:
+                print("Could not read the run times in %s, they will be recorded again" % self.path)
+
+    def add(self, run: Run, seconds, n_runs, cost=1):
+        """Record that n_runs runs of the combination run took seconds"""
+        with self.lock:
+            entry = self.runs.setdefault(OutputArchive.key(run), {'variables': run.format_variables(), 'time': 0,
+                                                                  'runs': 0})
+            entry['time'] += seconds
+            entry['runs'] += n_runs
+            entry['cost'] = cost
+
+    def write(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump({'init': self.init, 'runs': self.runs}, f, indent=1)
+            os.replace(self.path + '.tmp', self.path)
+
+    def mean(self, cost=1):
+        """The mean time of a run whose run_cost is cost, or None if no run was recorded"""
+        with self.lock:
+            time = sum(e['time'] for e in self.runs.values())
+            costs = sum(e.get('cost', 1) * e['runs'] for e in self.runs.values())
+        if not costs:
+            return None
+        return time / costs * cost
+
+    def estimate(self, run: Run, cost=1) -> float:
+        """The time a run of the combination run should take, from its history, from the history of the other
+        combinations scaled by their run_cost, or from the delays and timeouts of the scripts"""
+        entry = self.runs.get(OutputArchive.key(run), None)
+        if entry and entry['runs']:
+            return entry['time'] / entry['runs']
+        mean = self.mean(cost)
+        if mean is not None:
+            return mean
+        return self.test.max_run_time()
@@ -3,6 +3,7 @@ import ast
 from typing import List, Set
 
 from npf import npf
+from npf import design
 from npf.repository import Repository
 from .variable import *
 from collections import OrderedDict
@@ -294,6 +295,8 @@ class SectionRequire(Section):
 class BruteVariableExpander:
     """Expand all variables building the full
     matrix first."""
+    # Whether the next combination depends on the results told for the previous ones
+    adaptive = False
 
     def __init__(self, vlist, overriden):
         self.expanded = [OrderedDict()]
@@ -318,14 +321,79 @@ class BruteVariableExpander:
     def __next__(self):
         return self.it.__next__()
 
+    def __len__(self):
+        return len(self.expanded)
+
+    def tell(self, variables, results):
+        """Feed back the results obtained for one of the expanded combinations. Expanders that
+        do not depend on results ignore them."""
+        pass
+
 
 class RandomVariableExpander(BruteVariableExpander):
     """Same as BruteVariableExpander but shuffle the series to test"""
 
-    def __init__(self, vlist):
-        super().__init__(vlist)
+    def __init__(self, vlist, overriden):
+        super().__init__(vlist, overriden)
         shuffle(self.expanded)
-        self.it == self.expanded.__iter__()
+        self.it = self.expanded.__iter__()
+
+
+class ShardVariableExpander(BruteVariableExpander):
+    """Keep only the combinations of one shard out of n, so a campaign can be split between multiple
+    invocations of NPF. Combinations are given to the least loaded shard, most expensive first according
+    to the cost function, and in an order that does not depend on the expansion method so that every
+    invocation computes the same shards."""
+
+    def __init__(self, expander, shard, n_shards, cost=None):
+        combinations = list(expander)
+        costs = [cost(c) if cost else 1 for c in combinations]
+
+        def canonical(i):
+            return str(sorted((k, str(v[1] if type(v) is tuple else v)) for k, v in combinations[i].items()))
+
+        self.loads = [0] * n_shards
+        owner = {}
+        for i in sorted(range(len(combinations)), key=lambda i: (-costs[i], canonical(i))):
+            least = self.loads.index(min(self.loads))
+            owner[i] = least
+            self.loads[least] += costs[i]
+        self.expanded = [c for i, c in enumerate(combinations) if owner[i] == shard]
+        self.it = self.expanded.__iter__()
+
+
+class SearchVariableExpander(BruteVariableExpander):
+    """Expand all variables except the search variable, and run the search
+    of the latter for each combination of the others"""
+    adaptive = True
+
+    def __init__(self, vlist, overriden, search, shuffled=False):
+        self.search = search
+        super().__init__(OrderedDict((k, v) for k, v in vlist.items() if k != search.name), overriden)
+        if shuffled:
+            shuffle(self.expanded)
+        self._feedback = None
+
+    def __iter__(self):
+        for outer in self.expanded:
+            search = self.search.search()
+            value = next(search)
+            while True:
+                z = outer.copy()
+                z[self.search.name] = value
+                self.search.probed.add(value)
+                self._feedback = (z, {})
+                yield z
+                try:
+                    value = search.send(self._feedback)
+                except StopIteration:
+                    break
+
+    def __len__(self):
+        return len(self.expanded) * self.search.expected_probes()
+
+    def tell(self, variables, results):
+        self._feedback = (variables, results)
 
 
 class SectionVariable(Section):
@@ -346,14 +414,41 @@ class SectionVariable(Section):
             values.append(SectionVariable.replace_variables(v, value))
         return values
 
-    def expand(self, method=None, overriden=set()):
-        if method == "shuffle" or method == "rand" or method == "random":
-            return RandomVariableExpander(self.vlist)
+    def expand(self, method=None, overriden=set(), options=None, cost=None):
+        expander = self._expand(method, overriden, options)
+        shard = getattr(options, 'shard', None)
+        if not shard:
+            return expander
+        match = re.match(r"^([0-9]+)/([0-9]+)$", shard)
+        if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+            raise Exception("Bad shard %s, the format is i/N with 1 <= i <= N" % shard)
+        if expander.adaptive:
+            raise Exception("Cannot shard the combinations of the expansion method %s, as they depend on the results" % method)
+        return ShardVariableExpander(expander, int(match.group(1)) - 1, int(match.group(2)), cost)
+
+    def _expand(self, method, overriden, options):
+        if method == "bayesian" or method == "bo":
+            from npf.expander import BayesianVariableExpander
+            return BayesianVariableExpander(self.vlist, overriden, options)
+        if method == "active":
+            from npf.expander import ActiveVariableExpander
+            return ActiveVariableExpander(self.vlist, overriden, options)
+        if method in design.GENERATORS:
+            from npf.expander import DesignVariableExpander
+            return DesignVariableExpander(self.vlist, overriden, method, options)
+        searches = [v for k, v in self.vlist.items() if isinstance(v, SearchVariable) and k not in overriden]
+        if len(searches) > 1:
+            raise Exception("Only one SEARCH variable is supported, got %s" % ', '.join([v.name for v in searches]))
+        shuffled = method == "shuffle" or method == "rand" or method == "random"
+        if searches:
+            return SearchVariableExpander(self.vlist, overriden, searches[0], shuffled=shuffled)
+        if shuffled:
+            return RandomVariableExpander(self.vlist, overriden)
         else:
             return BruteVariableExpander(self.vlist, overriden)
 
     def __iter__(self):
-        return self.expand()
+        return BruteVariableExpander(self.vlist, set()).__iter__()
 
     def __len__(self):
         if len(self.vlist) == 0:
@@ -621,7 +716,9 @@ class SectionConfig(SectionVariable):
         self.__add("critical", False)
         self.__add_dict("env", {})  # Unimplemented yet
         self.__add("timeout", 30)
+        self.__add("run_cost", 1)
         self.__add("hardkill", 5000)
+        self.__add("engine", None)
         self.__add("time_precision", 1)
         self.__add("time_sync", False)
         self.__add_list("glob_sync", [])
@@ -0,0 +1,89 @@
+import multiprocessing
+import traceback
+from queue import Empty
+
+from npf import npf
+
+
+class SlotScheduler:
+    """Run jobs concurrently on equivalent testbeds, the slots given by repeating --cluster, one job at a
+    time per slot. Each job runs in a forked process that sees npf.roles as the role mapping of its slot.
+    The outcome of the jobs is sent back to the parent, which stays the only one to handle and write
+    results."""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.free = list(range(len(slots)))
+        self.running = {}  # slot -> (process, key)
+        self.used = set()
+        self.queue = multiprocessing.Queue()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _run(self, slot, job, first):
+        npf.roles.clear()
+        npf.roles.update(self.slots[slot])
+        try:
+            self.queue.put((slot, job(slot, first)))
+        except Exception as e:
+            traceback.print_exc()
+            self.queue.put((slot, e))
+
+    def submit(self, key, job) -> list:
+        """Run job(slot, first) on the first free slot, waiting for one if needed. first is True for the first job
+        running on that slot, to set it up.
+        :return: The (key, outcome) of the jobs that finished while waiting, the outcome being the return value of
+                 the job or the exception it raised
+        """
+        done = []
+        while not self.free:
+            done.extend(self.wait())
+        slot = self.free.pop(0)
+        p = multiprocessing.Process(target=self._run, args=(slot, job, slot not in self.used))
+        self.used.add(slot)
+        p.start()
+        self.running[slot] = (p, key)
+        return done
+
+    def wait(self) -> list:
+        """Wait for at least one running job to finish
+        :return: The (key, outcome) of the finished jobs
+        """
+        done = {}
+        while self.running and not done:
+            try:
+                slot, outcome = self.queue.get(timeout=1)
+                done[slot] = outcome
+            except Empty:
+                # A job killed without sending anything back would otherwise hold its slot forever
+                for slot, (p, key) in self.running.items():
+                    if not p.is_alive() and self.queue.empty():
+                        done[slot] = Exception("The process running on slot %d died unexpectedly" % slot)
+            while True:
+                try:
+                    slot, outcome = self.queue.get_nowait()
+                    done[slot] = outcome
+                except Empty:
+                    break
+        outcomes = []
+        for slot, outcome in done.items():
+            p, key = self.running.pop(slot)
+            p.join()
+            self.free.append(slot)
+            outcomes.append((key, outcome))
+        return outcomes
+
+    def drain(self) -> list:
+        """Wait for all running jobs to finish"""
+        done = []
+        while self.running:
+            done.extend(self.wait())
+        return done
+
+    def terminate(self):
+        for slot, (p, key) in self.running.items():
+            p.terminate()
+            p.join()
+            self.free.append(slot)
+        self.running.clear()
@@ -19,9 +19,20 @@ from npf.section import *
 from npf.npf import get_valid_filename
 from npf.types.dataset import Run, Dataset
 from npf.eventbus import EventBus
+from npf.slots import SlotScheduler
+from npf.executor.localexecutor import LocalExecutor
+from npf.engine import AsyncEngine, kill_all
+from npf.archive import OutputArchive
+from npf.capture import Capture, tail
+from npf.runtimes import RunTimes, format_duration
+from npf.console import Console
+from npf import trace
+from npf.pipeline import BuildGraph
+from npf.remotebuild import RemoteBuild, local_root
 from .variable import get_bool
 from decimal import *
 from functools import reduce
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from subprocess import PIPE, Popen, TimeoutExpired
 
@@ -37,6 +48,7 @@ class RemoteParameters:
         self.autokill = None
         self.queue = None
         self.timeout = None
+        self.hardkill = 5000
         self.options = None
         self.stdin = None
         self.commands = None
@@ -46,13 +58,20 @@ class RemoteParameters:
         self.title = None
         self.env = None
         self.virt = ""
+        self.capture = None
+        self.critical = False
 
     pass
 
 
 def _parallel_exec(param: RemoteParameters):
-    nodes = npf.nodes_for_role(param.role)
-    executor = nodes[param.role_id].executor
+    node = npf.nodes_for_role(param.role)[param.role_id]
+    with trace.track("%s on %s" % (param.name, node.get_name())):
+        return _script_exec(param, node)
+
+
+def _script_exec(param: RemoteParameters, node):
+    executor = node.executor
     for wf in param.waitfor if type(param.waitfor) is list else [param.waitfor]:
         if wf is None:
             continue
@@ -62,25 +81,33 @@ def _parallel_exec(param: RemoteParameters):
             n=int(wf[0])
             wf=wf[1:]
         for i in range(n):
-            param.event.listen(wf)
+            with trace.span("waitfor " + wf, "event"):
+                param.event.listen(wf)
+            trace.instant("receive " + wf, "event", script=param.name, node=node.get_name())
 
-    param.event.wait_for_termination(param.delay)
+    if param.delay:
+        with trace.span("delay"):
+            param.event.wait_for_termination(param.delay)
     if param.event.is_terminated():
         if param.options.debug:
                 print("[DEBUG] Script %s killed before its execution" % param.name)
         return 1, 'Killed before execution', 'Killed before execution', 0, param.script
-    pid, o, e, c = executor.exec(cmd=param.commands,
-                                 stdin=param.stdin,
-                                 timeout=param.timeout,
-                                 bin_paths=param.bin_paths,
-                                 queue=param.queue,
-                                 options=param.options,
-                                 sudo=param.sudo,
-                                 testdir=param.testdir,
-                                 event=param.event,
-                                 title=param.name,
-                                 env=param.env,
-                                 virt=param.virt)
+    with trace.span("exec", script=param.name, node=node.get_name()):
+        pid, o, e, c = executor.exec(cmd=param.commands,
+                                     stdin=param.stdin,
+                                     timeout=param.timeout,
+                                     bin_paths=param.bin_paths,
+                                     queue=param.queue,
+                                     options=param.options,
+                                     sudo=param.sudo,
+                                     testdir=param.testdir,
+                                     event=param.event,
+                                     title=param.name,
+                                     env=param.env,
+                                     virt=param.virt,
+                                     capture=param.capture)
+    # The pool may be terminated once the results are given, the output must be printed before
+    Console.get().flush()
 
     if pid == 0:
         return False, o, e, c, param.script
@@ -93,12 +120,12 @@ def _parallel_exec(param: RemoteParameters):
             v = param.autokill.value
             param.event.c.release()
             if v == 0:
-                Test.killall(param.queue, param.event)
+                Test.killall(param.queue, param.event, param.hardkill)
         elif pid == -1:
             #Keyboard interrupt
             if param.options.debug:
                 print("[DEBUG] Script %s stopped through keyboard interrupt." % param.name)
-            Test.killall(param.queue, param.event)
+            Test.killall(param.queue, param.event, param.hardkill)
         else:
             if param.options.debug:
                 print("[DEBUG] Script %s finished, autokill=false so it will not terminate the other scripts." % param.name)
@@ -107,12 +134,24 @@ def _parallel_exec(param: RemoteParameters):
         return True, o, e, c, param.script
 
 
+class RunSetup:
+    """Everything prepared by Test.prepare for the runs of a combination"""
+    def __init__(self):
+        self.v = None
+        self.imp_v = []
+        self.file_list = []
+        self.params = []
+        self.autokill = []  # [count, params] for each script killing the others when it finishes
+        self.stage = None
+
+
 class ScriptInitException(Exception):
     pass
 
 
 class Test:
     __test__ = False
+    _n_stage = 0
 
     def get_name(self):
         return self.filename
@@ -284,27 +323,61 @@ class Test:
             else: #is include
                 self.variables.vlist.update(imp.test.variables.vlist)
 
-    def build_deps(self, repo_under_test: List[Repository], v_internals={}, no_build=False, done=None):
-        if done is None:
-            done = set()
-        # Check for dependencies
+    def get_all_deps(self) -> Set[str]:
+        """The dependencies of the scripts of this test and of all its imports"""
         deps = set()
         for script in self.get_scripts():
             deps = deps.union(script.get_deps())
-        for dep in deps:
+        for imp in self.imports:
+            deps = deps.union(imp.test.get_all_deps())
+        return deps
+
+    def build_all_deps(self, repo_under_test: List[Repository]):
+        """
+        Build the dependencies of this test and its imports. Dependencies are built concurrently, a repository
+        being built after its parent if both are dependencies.
+        """
+        graph = BuildGraph(jobs=self.options.build_jobs)
+        for dep in sorted(self.get_all_deps()):
             if dep in [repo.reponame for repo in repo_under_test]:
                 continue
             deprepo = Repository.get_instance(dep, self.options)
             if deprepo.url is None or deprepo.reponame in self.options.no_build_deps:
                 continue
-            if not deprepo.get_last_build().build(force_build=deprepo.reponame in self.options.force_build_deps):
-                raise Exception("Could not build dependency %s" % dep)
+            parent = getattr(deprepo, 'parent', None)
+            graph.add(dep, deprepo.get_last_build(), after=[parent] if parent else [],
+                      force_build=deprepo.reponame in self.options.force_build_deps,
+                      checkout_only=not self.needs_local_build(deprepo))
+        failed = graph.run()
+        if failed:
+            raise Exception("Could not build dependency %s" % ', '.join(failed))
+
+    def needs_local_build(self, repo: Repository, under_test=False) -> bool:
+        """
+        Whether the binaries of repo must be built by NPF, that is unless it is built on the nodes with remote_build
+        and no node using it shares the build folder.
+        """
+        if not repo.remote_build:
+            return True
+        scripts = list(itertools.chain(self.get_scripts(), *[imp.test.get_scripts() for imp in self.imports]))
+        for script in scripts:
+            if under_test or repo.reponame in script.get_deps():
+                if any(node.nfs for node in npf.nodes_for_role(script.get_role())):
+                    return True
+        return False
+
+    def build_deps(self, repo_under_test: List[Repository], v_internals={}, no_build=False, done=None):
+        if done is None:
+            done = set()
+            # The imports are handled below with a done set, their dependencies are built here with ours
+            self.build_all_deps(repo_under_test)
         #Do the same for the imports
         for imp in self.imports:
             imp.test.build_deps(repo_under_test, v_internals, True, done=done)
 
-        # Send dependencies for nfs=0 nodes
+        # Send dependencies for nfs=0 nodes, or build them there with remote_build
         toSend = set()
+        toBuild = OrderedDict()
         for script in self.get_scripts():
             role = script.get_role()
             nodes = npf.nodes_for_role(role)
@@ -312,22 +385,28 @@ class Test:
               if not node.nfs:
                 for repo in repo_under_test:
                     if repo.get_build_path() and not no_build:
+                        if repo.remote_build:
+                            toBuild.setdefault(repo.reponame, (repo, []))[1].append(node)
+                            continue
                         toSend.add((repo.reponame,role,node, repo.get_build_path(), repo.get_remote_build_path(node)))
                 for dep in script.get_deps():
                     deprepo = Repository.get_instance(dep, self.options)
+                    if deprepo.remote_build:
+                        toBuild.setdefault(deprepo.reponame, (deprepo, []))[1].append(node)
+                        continue
 
                     toSend.add((deprepo.reponame,role,node,deprepo.get_build_path(), deprepo.get_remote_build_path(node)))
+        for reponame, (repo, nodes) in toBuild.items():
+            nodes = [node for node in OrderedDict.fromkeys(nodes) if ('build', reponame, node) not in done]
+            if nodes and not RemoteBuild(repo, self.options).run(nodes):
+                raise Exception("Could not build %s on the nodes" % reponame)
+            done.update(('build', reponame, node) for node in nodes)
         for repo,role,node,bp,rbp in toSend.difference(done):
             print("Sending software %s to %s... " % (repo, role), end ='')
             try:
 
                 #We have to find the local path from which the remote start, so we can advance in the folder at the same point
-                local = os.path.normpath(bp)
-                r = os.path.normpath(rbp)
-                while os.path.basename(local) == os.path.basename(r):
-                    local = os.path.dirname(os.path.normpath(local))
-                    r = os.path.dirname(os.path.normpath(r))
-                t,s = node.executor.sendFolder(rbp,local)
+                t,s = node.executor.sendFolder(rbp,local_root(bp, rbp))
             except Exception as e:
                 print ("While sending %s (to folder %s) on node %s= " %  (bp, rbp, node.addr))
                 raise e
@@ -389,7 +468,7 @@ class Test:
             create_list.append((s.filename, p, role))
         return create_list
 
-    def create_files(self, file_list, path_to_root):
+    def create_files(self, file_list, path_to_root, local_path=None):
         unique_list = {}
         for filename, p, role in file_list:
             if filename in unique_list:
@@ -405,9 +484,9 @@ class Test:
                 print("File %s:" % filename)
                 print(p.strip())
             for node in npf.nodes_for_role(role):
-                if not node.executor.writeFile(filename, path_to_root, p):
+                if not node.executor.writeFile(filename, path_to_root, p, local_path=local_path):
                     print("Re-trying with sudo...")
-                    if not node.executor.writeFile(filename, path_to_root, p, sudo=True):
+                    if not node.executor.writeFile(filename, path_to_root, p, sudo=True, local_path=local_path):
                         raise Exception("Could not create file %s on %s" % (filename, node.name))
 
     def test_require(self, v, build):
@@ -431,26 +510,20 @@ class Test:
             print("Could not cleanup file %s" % s.filename)
 
     @staticmethod
-    def killall(queue, event):
-        event.terminate()
-        while not queue.empty():
-            try:
-                killer = queue.get(block=False)
-            except Empty:
-                continue
-            try:
-                killer.kill()
-            except OSError:
-                pass
-
-            i = 0
-            while killer.is_alive() and i < 500:
-                time.sleep(0.010)
-                i += 1
-            try:
-                killer.force_kill()
-            except OSError:
-                pass
+    def killall(queue, event, hardkill=5000):
+        """
+        Kill all the scripts registered in queue, all at once. They are sent SIGTERM, and SIGKILL if they are still
+        alive after hardkill milliseconds. The scripts of a remote node are killed through a single SSH channel.
+        """
+        with trace.span("autokill"):
+            event.terminate()
+            killers = []
+            while not queue.empty():
+                try:
+                    killers.append(queue.get(block=False))
+                except Empty:
+                    continue
+            kill_all(killers, hardkill)
 
     def update_constants(self, v_internals : dict, build : Build, full_test_folder : str, out_path : str = None, node = None):
 
@@ -483,7 +556,9 @@ class Test:
         has_values = False
         try:
             for result_regex in regex_list:
-                for nr in re.finditer(result_regex, output.strip(), re.IGNORECASE):
+                matches = output.finditer(result_regex, re.IGNORECASE) if isinstance(output, Capture) else \
+                    re.finditer(result_regex, output.strip(), re.IGNORECASE)
+                for nr in matches:
                     result_type = nr.group("type")
 
                     kind = nr.group("kind")
@@ -549,14 +624,20 @@ class Test:
             raise e
         return has_err, has_values
 
-    def execute(self, build, run, v, n_runs=1, n_retry=0, allowed_types=SectionScript.ALL_TYPES_SET, do_imports=True,
-                test_folder=None, event=None, v_internals={}, before_test = None) \
-            -> Tuple[Dict, Dict, str, str, int]:
-
+    def prepare(self, build, v, allowed_types=SectionScript.ALL_TYPES_SET, do_imports=True, test_folder=None,
+                v_internals={}, constants=None) -> 'RunSetup':
+        """
+        Prepare a run of the combination v : the variables of the imports, the files to create and the parameters of
+        the scripts. Nothing is sent to the nodes.
+        :param constants: A cache of the constants of each node, that are the same for all combinations. They are
+                          relative to the current directory, so once it is filled the next combination can be prepared
+                          while the current one runs in the test folder.
+        """
         # Get address definition for roles from scripts
         self.parse_script_roles()
 
-        # Create temporary folder
+        setup = RunSetup()
+        setup.v = v
         deps_repo = []
         depscripts = [imp.test.scripts for imp in self.imports]
 
@@ -568,17 +649,6 @@ class Test:
                 v_internals[repo.reponame.upper() + '_VERSION'] = repo.version
         v.update(v_internals)
 
-        if test_folder is None:
-            test_folder = self.make_test_folder()
-            f_mine = True
-        else:
-            f_mine = False
-
-        if not os.path.exists(npf.experiment_path() + '/' + test_folder):
-            os.mkdir(npf.experiment_path() + '/' + test_folder)
-        save_path = os.getcwd()
-        os.chdir(npf.experiment_path() + '/' + test_folder)
-
         # Build file list
         file_list = []
         if SectionScript.TYPE_INIT in allowed_types:
@@ -589,169 +659,272 @@ class Test:
         else:
             file_list.extend(self.build_file_list(v, self.role))
 
-        n_exec = 0
-        n_err = 0
-
         for imp in self.get_imports():
             imp.test.parse_script_roles()
-            imp.imp_v = {}
+            imp_v = {}
             for k, val in imp.test.variables.statics().items():
-                imp.imp_v[k] = val.makeValues()[0]
+                imp_v[k] = val.makeValues()[0]
 
-            imp.imp_v.update(v)
+            imp_v.update(v)
 
             for late_variables in imp.test.get_late_variables():
-                imp.imp_v.update(late_variables.execute(imp.imp_v, imp.test))
+                imp_v.update(late_variables.execute(imp_v, imp.test))
 
             if SectionScript.TYPE_INIT in allowed_types:
-                file_list.extend(imp.test.build_file_list(imp.imp_v, imp.get_role(), files=imp.test.init_files))
+                file_list.extend(imp.test.build_file_list(imp_v, imp.get_role(), files=imp.test.init_files))
             else:
-                file_list.extend(imp.test.build_file_list(imp.imp_v, imp.get_role()))
+                file_list.extend(imp.test.build_file_list(imp_v, imp.get_role()))
+            setup.imp_v.append(imp_v)
+        setup.file_list = file_list
+
+        for t, v, role in ([(imp.test, imp_v, imp.get_role()) for imp, imp_v in
+                            zip(self.imports, setup.imp_v)] if do_imports else []) + [(self, v, None)]:
+          for script in t.scripts:
+            srole = role if role else script.get_role()
+            nodes = npf.nodes_for_role(srole)
+
+            autokill = [0, []] if npf.parseBool(script.params.get("autokill", t.config["autokill"])) else None
+            if autokill is not None:
+                setup.autokill.append(autokill)
+            v["NPF_NODE_MAX"] = len(nodes)
+            for i_node, node in enumerate(nodes):
+              v["NPF_NODE"] = node.get_name()
+              v["NPF_NODE_ID"] = i_node
+              multi = script.multi
+
+              if multi is None:
+                  multi = [0]
+              elif multi == '*':
+                  if node.multi:
+                      multi = range(1, node.multi + 1)
+                  else:
+                      multi = [1]
+              elif type(multi) == str:
+                  multi = [int(multi)]
+
+              for i_multi in multi:
+                if autokill is not None:
+                    autokill[0] += 1
+                if not script.get_type() in (allowed_types.difference(set([SectionScript.TYPE_EXIT]))):
+                    continue
+                param = RemoteParameters()
+                param.sudo = script.params.get("sudo", False)
+
+                if constants is None or node.get_name() not in constants:
+                    node_constants = {}
+                    remote_test_folder = node.experiment_path() + os.sep + test_folder + os.sep
+                    self.update_constants(node_constants, build, remote_test_folder, out_path=None, node=node)
+                    if constants is not None:
+                        constants[node.get_name()] = node_constants
+                else:
+                    node_constants = constants[node.get_name()]
+                v.update(node_constants)
+                v["NPF_MULTI"] = i_multi
+                v["NPF_MULTI_ID"] = i_multi
+                v["NPF_MULTI_MAX"] = node.multi if node.multi is not None else 1
+                v["NPF_ARRAY_ID"] = (i_node * v["NPF_MULTI_MAX"]) + i_multi
+                v["NPF_ARRAY_MAX"] = len(nodes) * v["NPF_MULTI_MAX"]
+
+                #Checking if the script has a filter
+                c = True # Should we continue?
+                for ik, iv in script.params.items():
+                    if ik.startswith('ifeq-'):
+                        ik=ik[5:]
+                        if ik not in v:
+                            print("WARNING: Filtering for %s for script %s but it is not in the variables" % (ik, param.title))
+                        if v[ik] != iv:
+                            c = False
+                            break
+
+                if not c:
+                    continue
 
-        self.create_files(file_list, test_folder)
+                if node.mode == "netns" and i_multi > 0:
+                    param.virt = "ip netns exec npfns%d" % i_multi
+                    param.sudo = True
+
+                param.commands = "mkdir -p " + test_folder + " && cd " + test_folder + ";\n" + SectionVariable.replace_variables(
+                    v,
+                    script.content,
+                    self_role = srole, self_node=node,
+                    default_role_map= self.config.get_dict(
+                        "default_role_map"))
+                param.options = self.options
+                param.stdin = t.stdin.content
+                timeout = t.config['timeout']
+                if 'timeout' in script.params:
+                    timeout = float(script.params['timeout'])
+                if self.config['timeout'] == -1 or self.config['timeout'] > timeout:
+                    timeout = self.config['timeout']
+                if timeout == -1 or timeout == "-1":
+                    timeout = None
+
+                param.timeout = timeout
+                param.hardkill = t.config['hardkill']
+                # The config of the test owning the script, that may be an import
+                param.critical = npf.parseBool(script.params.get("critical", t.config["critical"]))
+                script.timeout = timeout
+                param.role = srole
+                param.role_id = i_node
+                param.default_role_map = self.config.get_dict("default_role_map")
+                param.delay = script.delay()
+
+                deps_bin_path = [repo.get_remote_bin_folder(node) for repo in script.get_deps_repos(self.options) if
+                                 not repo.reponame in self.options.ignore_deps]
+                param.bin_paths = deps_bin_path + [build.get_remote_bin_folder(node)]
+                param.testdir = test_folder
+                param.script = script
+                param.name = script.get_name(True)
+                param.env = OrderedDict()
+                param.env.update(v_internals)
+                param.env.update([(k, v.replace('$NPF_BUILD_PATH', build.repo.get_build_path())) for k, v in
+                                  build.repo.env.items()])
+
+                if 'waitfor' in script.params:
+                    param.waitfor = script.params['waitfor']
+
+                if autokill is not None:
+                    autokill[1].append(param)
+                setup.params.append(param)
+        return setup
+
+    def stage_files(self, setup, test_folder):
+        """
+        Create the files of a prepared run in a subfolder of the test folder of each node, to be swapped in by
+        commit_files when the run starts. It does not depend on the current directory, so it can be done while
+        another run is going on.
+        """
+        Test._n_stage += 1
+        setup.stage = '.npf-stage-%d' % Test._n_stage
+        self.create_files(setup.file_list, test_folder + os.sep + setup.stage,
+                          local_path=npf.experiment_path() + os.sep + test_folder + os.sep + setup.stage)
+
+    def commit_files(self, setup, test_folder):
+        """
+        Move the files staged by stage_files in the test folder, each file being renamed so scripts never see a
+        partially written one. Remote nodes do it with a single command.
+        """
+        stage = npf.experiment_path() + os.sep + test_folder + os.sep + setup.stage
+        if os.path.exists(stage):
+            for dirpath, dirnames, filenames in os.walk(stage):
+                dest = os.path.join(npf.experiment_path() + os.sep + test_folder, os.path.relpath(dirpath, stage))
+                os.makedirs(dest, exist_ok=True)
+                for filename in filenames:
+                    os.replace(os.path.join(dirpath, filename), os.path.join(dest, filename))
+            shutil.rmtree(stage)
+
+        nodes = OrderedDict()
+        for filename, p, role in setup.file_list:
+            for node in npf.nodes_for_role(role):
+                if not isinstance(node.executor, LocalExecutor):
+                    nodes[node.get_name()] = node
+        cmd = ('cd %s && if [ -d %s ] ; then (cd %s && find . -type f) | while read f ; do '
+               'mkdir -p "$(dirname "$f")" && mv -f "%s/$f" "$f" ; done ; rm -rf %s ; fi') % (
+            test_folder, setup.stage, setup.stage, setup.stage, setup.stage)
+        for node in nodes.values():
+            pid, out, err, ret = node.executor.exec(cmd=cmd, options=self.options, title='stage')
+            if ret != 0:
+                raise Exception("Could not move the files of the test in place on %s : %s" % (node.name, err))
+
+    def execute(self, build, run, v, n_runs=1, n_retry=0, allowed_types=SectionScript.ALL_TYPES_SET, do_imports=True,
+                test_folder=None, event=None, v_internals={}, before_test = None, setup = None) \
+            -> Tuple[Dict, Dict, str, str, int]:
+
+        if test_folder is None:
+            test_folder = self.make_test_folder()
+            f_mine = True
+        else:
+            f_mine = False
+
+        if not os.path.exists(npf.experiment_path() + '/' + test_folder):
+            os.mkdir(npf.experiment_path() + '/' + test_folder)
+        # Outputs of the scripts are kept in the results folder, so their results can be parsed again
+        archive = OutputArchive.get(build, self, self.options) if SectionScript.TYPE_SCRIPT in allowed_types else None
+        save_path = os.getcwd()
+        os.chdir(npf.experiment_path() + '/' + test_folder)
+
+        if setup is None:
+            with trace.span("prepare"):
+                setup = self.prepare(build, v, allowed_types=allowed_types, do_imports=do_imports,
+                                     test_folder=test_folder, v_internals=v_internals)
+        v = setup.v
+        for imp, imp_v in zip(self.get_imports(), setup.imp_v):
+            imp.imp_v = imp_v
+
+        n_exec = 0
+        n_err = 0
+
+        with trace.span("create files"):
+            if setup.stage:
+                self.commit_files(setup, test_folder)
+            else:
+                self.create_files(setup.file_list, test_folder)
 
         # Launching the tests in itself
         data_results = OrderedDict()  # dict of result_name -> [val, val, val]
         all_kind_results = {}  # dict of kind -> kind_value -> {result_name -> [val, val, val]}
-        m = multiprocessing.Manager()
+        engine = self.config["engine"] if self.config["engine"] else self.options.engine
+        # The asyncio engine runs all the scripts in this process, without proxies for the queue and the events
+        m = multiprocessing.Manager() if engine != 'async' else None
         all_output = []
         all_err = []
+        capture_folder = os.path.join(os.getcwd(), '.npf-output')
         for i in range(n_runs):
             for i_try in range(n_retry + 1):
                 if i_try > 0 and not self.options.quiet:
                     print("Re-try tests %d/%d..." % (i_try, n_retry + 1))
-                output = ''
-                err = ''
+                # Large outputs are written in the test folder instead of being kept in memory
+                output = Capture(capture_folder, 'run%d-%d.out' % (i, i_try), limit=self.options.output_memory)
+                err = Capture(capture_folder, 'run%d-%d.err' % (i, i_try), limit=self.options.output_memory)
 
                 if before_test:
                     before_test(i,i_try)
 
-                queue = m.Queue()
-
-                event = EventBus(m)
-
-                remote_params = []
-                for t, v, role in (
-                                          [(imp.test, imp.imp_v, imp.get_role()) for imp in
-                                           self.imports] if do_imports else []) + [
-                                      (self, v, None)]:
-                  for script in t.scripts:
-                    srole = role if role else script.get_role()
-                    nodes = npf.nodes_for_role(srole)
-
-                    autokill = m.Value('i', 0) if npf.parseBool(script.params.get("autokill", t.config["autokill"])) else None
-                    v["NPF_NODE_MAX"] = len(nodes)
-                    for i_node, node in enumerate(nodes):
-                      v["NPF_NODE"] = node.get_name()
-                      v["NPF_NODE_ID"] = i_node
-                      multi = script.multi
-
-                      if multi is None:
-                          multi = [0]
-                      elif multi == '*':
-                          if node.multi:
-                              multi = range(1, node.multi + 1)
-                          else:
-                              multi = [1]
-                      elif type(multi) == str:
-                          multi = [int(multi)]
-
-                      for i_multi in multi:
-                        if autokill is not None:
-                            autokill.value = autokill.value + 1
-                        if not script.get_type() in (allowed_types.difference(set([SectionScript.TYPE_EXIT]))):
-                            continue
-                        param = RemoteParameters()
-                        param.sudo = script.params.get("sudo", False)
-
-                        remote_test_folder = node.experiment_path() + os.sep + test_folder + os.sep
-                        self.update_constants(v, build, remote_test_folder, out_path=None, node=node)
-                        v["NPF_MULTI"] = i_multi
-                        v["NPF_MULTI_ID"] = i_multi
-                        v["NPF_MULTI_MAX"] = node.multi if node.multi is not None else 1
-                        v["NPF_ARRAY_ID"] = (i_node * v["NPF_MULTI_MAX"]) + i_multi
-                        v["NPF_ARRAY_MAX"] = len(nodes) * v["NPF_MULTI_MAX"]
-
-                        #Checking if the script has a filter
-                        c = True # Should we continue?
-                        for ik, iv in script.params.items():
-                            if ik.startswith('ifeq-'):
-                                ik=ik[5:]
-                                if ik not in v:
-                                    print("WARNING: Filtering for %s for script %s but it is not in the variables" % (ik, param.title))
-                                if v[ik] != iv:
-                                    c = False
-                                    break
-
-                        if not c:
-                            continue
-
-                        if node.mode == "netns" and i_multi > 0:
-                            param.virt = "ip netns exec npfns%d" % i_multi
-                            param.sudo = True
-
-                        param.commands = "mkdir -p " + test_folder + " && cd " + test_folder + ";\n" + SectionVariable.replace_variables(
-                            v,
-                            script.content,
-                            self_role = srole, self_node=node,
-                            default_role_map= self.config.get_dict(
-                                "default_role_map"))
-                        param.options = self.options
+                if m:
+                    queue = m.Queue()
+
+                    event = EventBus(m)
+
+                    for count, params in setup.autokill:
+                        autokill = m.Value('i', count)
+                        for param in params:
+                            param.autokill = autokill
+                remote_params = setup.params
+                for iparam, param in enumerate(remote_params):
+                    param.capture = (Capture(capture_folder, 'run%d-%d-script%d.out' % (i, i_try, iparam),
+                                             limit=self.options.output_memory),
+                                     Capture(capture_folder, 'run%d-%d-script%d.err' % (i, i_try, iparam),
+                                             limit=self.options.output_memory))
+                    if m:
                         param.queue = queue
-                        param.stdin = t.stdin.content
-                        timeout = t.config['timeout']
-                        if 'timeout' in script.params:
-                            timeout = float(script.params['timeout'])
-                        if self.config['timeout'] == -1 or self.config['timeout'] > timeout:
-                            timeout = self.config['timeout']
-                        if timeout == -1 or timeout == "-1":
-                            timeout = None
-
-                        param.timeout = timeout
-                        script.timeout = timeout
-                        param.role = srole
-                        param.role_id = i_node
-                        param.default_role_map = self.config.get_dict("default_role_map")
-                        param.delay = script.delay()
-
-                        deps_bin_path = [repo.get_remote_bin_folder(node) for repo in script.get_deps_repos(self.options) if
-                                         not repo.reponame in self.options.ignore_deps]
-                        param.bin_paths = deps_bin_path + [build.get_remote_bin_folder(node)]
-                        param.testdir = test_folder
                         param.event = event
-                        param.script = script
-                        param.name = script.get_name(True)
-                        param.autokill = autokill
-                        param.env = OrderedDict()
-                        param.env.update(v_internals)
-                        param.env.update([(k, v.replace('$NPF_BUILD_PATH', build.repo.get_build_path())) for k, v in
-                                          build.repo.env.items()])
-
-                        if self.options.rand_env:
-                            param.env['RANDENV'] = ''.join(random.choice(string.ascii_lowercase) for i in range(random.randint(0,self.options.rand_env)))
-                        if 'waitfor' in script.params:
-                            param.waitfor = script.params['waitfor']
-
-                        remote_params.append(param)
+                    if self.options.rand_env:
+                        param.env['RANDENV'] = ''.join(random.choice(string.ascii_lowercase) for i in range(random.randint(0,self.options.rand_env)))
 
                 n = len(remote_params)
                 n_exec += n
                 if n == 0:
                     break
                 try:
-                    if self.options.allow_mp:
-                        p = multiprocessing.Pool(n)
-                        parallel_execs = p.map(_parallel_exec,
-                                               remote_params)
-                    else:
-                        print("Sequential execution...")
-                        parallel_execs = []
-                        for remoteParam in remote_params:
-                            parallel_execs.append(_parallel_exec(remoteParam))
+                    with trace.span("run", run=i, retry=i_try, variables=run.format_variables()):
+                        if engine == 'async':
+                            # Scripts are started from the parent of the test folder, like the executors do
+                            parallel_execs = AsyncEngine(self.options, os.path.dirname(os.getcwd())).run(
+                                remote_params, setup.autokill)
+                        elif self.options.allow_mp:
+                            with trace.span("pool spawn", processes=n):
+                                p = multiprocessing.Pool(n)
+                            parallel_execs = p.map(_parallel_exec,
+                                                   remote_params)
+                        else:
+                            print("Sequential execution...")
+                            parallel_execs = []
+                            for remoteParam in remote_params:
+                                parallel_execs.append(_parallel_exec(remoteParam))
 
                 except KeyboardInterrupt:
                     print("Program is interrupted")
-                    if self.options.allow_mp:
+                    if self.options.allow_mp and engine != 'async':
                         p.close()
                         p.terminate()
 
@@ -766,7 +939,7 @@ class Test:
                         print("Test files have been preserved in :" + test_folder)
                     sys.exit(1)
 
-                if self.options.allow_mp:
+                if self.options.allow_mp and engine != 'async':
                     p.close()
                     p.terminate()
                 worked = False
@@ -778,9 +951,9 @@ class Test:
                             script.timeout, script.get_name(), script.get_role()))
                         if self.options.quiet:
                             print("stdout:")
-                            print(o)
+                            print(tail(o))
                             print("stderr:")
-                            print(e)
+                            print(tail(e))
                         continue
                     if r == -1:
                         os.chdir('..')
@@ -789,16 +962,16 @@ class Test:
                         sys.exit(1)
                     if c != 0:
                         n_err = n_err + 1
-                        if npf.parseBool(script.params.get("critical", t.config["critical"])):
+                        if remote_params[iscript].critical:
                             critical_failed = True
                             print("[ERROR] A critical script failed ! Results will be ignored")
                         print("Bad return code (%d) for script %s on %s ! Something probably went wrong..." % (
                             c, script.get_name(), script.get_role()))
                         if self.options.quiet:
                             print("stdout:")
-                            print(o)
+                            print(tail(o))
                             print("stderr:")
-                            print(e)
+                            print(tail(e))
                         continue
 
                 for iparallel, (r, o, e, c, script) in enumerate(parallel_execs):
@@ -810,6 +983,9 @@ class Test:
                         worked = True
                         output += o
                         err += e
+                    for capture in [o, e]:
+                        if isinstance(capture, Capture):
+                            capture.discard()
 
                 if SectionScript.TYPE_EXIT in allowed_types:
                  for s,vlist in [(t.test,t.imp_v) for t in self.imports] + [(self, v)]:
@@ -832,7 +1008,8 @@ class Test:
                         executor=node.executor
                         ncmd = "mkdir -p " + test_folder + " && cd " + test_folder + ";\n" + cmd
                         try:
-                            pid, s_output, s_err, c = executor.exec(cmd=ncmd, options=self.options)
+                            with trace.span("exit script", node=node.get_name()):
+                                pid, s_output, s_err, c = executor.exec(cmd=ncmd, options=self.options)
                         except Exception as e:
                             print("An error occured!", e)
                         #print(s_output, s_err)
@@ -840,122 +1017,23 @@ class Test:
                         err += s_err
 
 
+                Console.get().flush()
                 all_output.append(output)
                 all_err.append(err)
 
                 if not worked or critical_failed:
                     continue
 
+                if archive:
+                    with trace.span("archive outputs"):
+                        archive.store(run, output, err)
+
                 if not self.config["result_regex"]:
                     break
 
-                has_values = False
-                has_err = False
-                new_data_results = {}
-                new_kind_results = {}
-                new_kind_results.setdefault("time", {})
-                regex_list = self.config.get_list("result_regex")
-
-                this_has_err, this_has_value = self.parse_results(regex_list, output, new_kind_results,
-                                                                  new_data_results)
-
-                if this_has_err:
-                    has_err = True
-                if this_has_value:
-                    has_values = True
-                if hasattr(self, 'pyexit') and allowed_types != set([SectionScript.TYPE_INIT]):
-                    vs = {'RESULTS': new_data_results, 'TIME_RESULTS': new_kind_results["time"], 'KIND_RESULTS':new_kind_results}
-                    vs.update(v)
-                    try:
-                        exec(self.pyexit.content, vs)
-                    except SystemExit as e:
-                        if e.code != 0:
-                            print("ERROR WHILE EXECUTING PYEXIT SCRIPT: returned code %d" % e.code)
-                        pass
-                    except Exception as e:
-                        print("ERROR WHILE EXECUTING PYEXIT SCRIPT:")
-                        print(e)
-
-
-                glob_sync = self.config.get_list("glob_sync")
-                glob_min = []
-                for g in glob_sync:
-                    for kind, kind_results in new_kind_results.items():
-                        if kind in glob_sync:
-                            mg = min(kind_results.keys())
-                            glob_min.append(mg)
-
-                for kind, kind_results in new_kind_results.items():
-                  if kind_results:
-                    all_kind_results.setdefault(kind,{})
-                    if kind in glob_sync:
-                        min_kind_value = min(glob_min)
-                    else:
-                        min_kind_value = min(kind_results.keys())
-                    nonzero = set()
-                    update = {}
-                    all_result_types = set()
-                    nz = False
-                    accept_zero = not self.config.match("accept_zero", kind)
-                    if accept_zero:
-                        nz = False
-
-                    last_val = {}
-                    acc = self.config.get_list("time_sync")
-                    for kind_value, results in sorted(kind_results.items()):
-                        if not nz: #We still haven't found a non zero kind_value
-                            for result_type, result in results.items():
-                                if result_type in self.config.get_list("var_repeat"):
-                                    last_val[result_type] = result
-
-                                if result != 0:
-                                    nz = True
-                                    if (not acc or result_type in acc) and not kind in glob_sync:
-                                        min_kind_value = kind_value
-                            if not nz:
-                                continue
-                            else:
-                                for result_type, result in last_val.items():
-                                    results[result_type] = result
-
-                        for result_type, result in results.items():
-                            if result_type in self.config.get_dict("var_n_runs") and i >= int(
-                                    self.config.get_dict("var_n_runs")[result_type]):
-                                continue
-                            nonzero.add(result_type)
-                            all_result_types.add(result_type)
-                            event_t = Decimal(
-                                ("%.0" + str(self.config['time_precision']) + "f") % round(float(kind_value - (min_kind_value if self.config.get_bool_or_in("time_sync", kind) else 0)), int(
-                                    self.config['time_precision'])))
-                            update.setdefault(event_t, {}).setdefault(result_type, [])
-                            update[event_t][result_type].extend(result if type(result) is list else [result])
-                            if result_type in self.config.get_list("var_repeat"):
-                                # Replicate existing time series for all new incoming time points
-                                self.ensure_time(event_t, result_type, all_kind_results[kind])
-
-                    # Replicate new results for every time point
-                    for event_t, results in update.items():
-                        for result_type, result in results.items():
-                            if result_type in self.config.get_list("var_repeat"):
-                                self.ensure_time(event_t, result_type, update)
-
-                    for kind_value, results in update.items():
-                        for result_type, result in results.items():
-                            all_kind_results[kind].setdefault(kind_value, {}).setdefault(result_type, []).extend(result)
-
-                    last_v=0
-                    for kind_value, results in update.items():
-                        for result_type, result in results.items():
-                            if not result:
-                                continue
-                            last_v = np.mean(result)
-
-                    diff = all_result_types.difference(nonzero)
-                    if diff:
-                        print("Result for %s is 0 !" % ', '.join(diff))
-                        has_err = True
-                for result_type, result in new_data_results.items():
-                    data_results.setdefault(result_type, []).extend(result if type(result) == list else [result])
+                with trace.span("parse results"):
+                    has_values, has_err = self.process_results(i, output, v, allowed_types, data_results,
+                                                               all_kind_results)
                 if has_values:
                     break
 
@@ -972,10 +1050,12 @@ class Test:
 
                 if has_err and self.options.quiet:
                     print("stdout:")
-                    print(output)
+                    print(tail(output))
                     print("stderr:")
-                    print(err)
+                    print(tail(err))
 
+        for capture in all_output + all_err:
+            capture.close()
         if not self.options.preserve_temp:
             for imp in self.imports:
                 imp.test.cleanup()
@@ -988,6 +1068,145 @@ class Test:
                 print("Could not delete folder %s..." % test_folder)
         return data_results, all_kind_results, all_output, all_err, n_exec, n_err
 
+    def process_results(self, i, output, v, allowed_types, data_results, all_kind_results) -> Tuple[bool, bool]:
+        """
+        Parse the results of the i-th run of the combination v from its output, run the pyexit script on them, and
+        add them to data_results and all_kind_results
+        :return: Whether results were found and whether something went wrong
+        """
+        has_values = False
+        has_err = False
+        new_data_results = {}
+        new_kind_results = {}
+        new_kind_results.setdefault("time", {})
+        regex_list = self.config.get_list("result_regex")
+
+        this_has_err, this_has_value = self.parse_results(regex_list, output, new_kind_results,
+                                                          new_data_results)
+
+        if this_has_err:
+            has_err = True
+        if this_has_value:
+            has_values = True
+        if hasattr(self, 'pyexit') and allowed_types != set([SectionScript.TYPE_INIT]):
+            vs = {'RESULTS': new_data_results, 'TIME_RESULTS': new_kind_results["time"], 'KIND_RESULTS':new_kind_results}
+            vs.update(v)
+            try:
+                exec(self.pyexit.content, vs)
+            except SystemExit as e:
+                if e.code != 0:
+                    print("ERROR WHILE EXECUTING PYEXIT SCRIPT: returned code %d" % e.code)
+                pass
+            except Exception as e:
+                print("ERROR WHILE EXECUTING PYEXIT SCRIPT:")
+                print(e)
+
+
+        glob_sync = self.config.get_list("glob_sync")
+        glob_min = []
+        for g in glob_sync:
+            for kind, kind_results in new_kind_results.items():
+                if kind in glob_sync:
+                    mg = min(kind_results.keys())
+                    glob_min.append(mg)
+
+        for kind, kind_results in new_kind_results.items():
+          if kind_results:
+            all_kind_results.setdefault(kind,{})
+            if kind in glob_sync:
+                min_kind_value = min(glob_min)
+            else:
+                min_kind_value = min(kind_results.keys())
+            nonzero = set()
+            update = {}
+            all_result_types = set()
+            nz = False
+            accept_zero = not self.config.match("accept_zero", kind)
+            if accept_zero:
+                nz = False
+
+            last_val = {}
+            acc = self.config.get_list("time_sync")
+            for kind_value, results in sorted(kind_results.items()):
+                if not nz: #We still haven't found a non zero kind_value
+                    for result_type, result in results.items():
+                        if result_type in self.config.get_list("var_repeat"):
+                            last_val[result_type] = result
+
+                        if result != 0:
+                            nz = True
+                            if (not acc or result_type in acc) and not kind in glob_sync:
+                                min_kind_value = kind_value
+                    if not nz:
+                        continue
+                    else:
+                        for result_type, result in last_val.items():
+                            results[result_type] = result
+
+                for result_type, result in results.items():
+                    if result_type in self.config.get_dict("var_n_runs") and i >= int(
+                            self.config.get_dict("var_n_runs")[result_type]):
+                        continue
+                    nonzero.add(result_type)
+                    all_result_types.add(result_type)
+                    event_t = Decimal(
+                        ("%.0" + str(self.config['time_precision']) + "f") % round(float(kind_value - (min_kind_value if self.config.get_bool_or_in("time_sync", kind) else 0)), int(
+                            self.config['time_precision'])))
+                    update.setdefault(event_t, {}).setdefault(result_type, [])
+                    update[event_t][result_type].extend(result if type(result) is list else [result])
+                    if result_type in self.config.get_list("var_repeat"):
+                        # Replicate existing time series for all new incoming time points
+                        self.ensure_time(event_t, result_type, all_kind_results[kind])
+
+            # Replicate new results for every time point
+            for event_t, results in update.items():
+                for result_type, result in results.items():
+                    if result_type in self.config.get_list("var_repeat"):
+                        self.ensure_time(event_t, result_type, update)
+
+            for kind_value, results in update.items():
+                for result_type, result in results.items():
+                    all_kind_results[kind].setdefault(kind_value, {}).setdefault(result_type, []).extend(result)
+
+            last_v=0
+            for kind_value, results in update.items():
+                for result_type, result in results.items():
+                    if not result:
+                        continue
+                    last_v = np.mean(result)
+
+            diff = all_result_types.difference(nonzero)
+            if diff:
+                print("Result for %s is 0 !" % ', '.join(diff))
+                has_err = True
+        for result_type, result in new_data_results.items():
+            data_results.setdefault(result_type, []).extend(result if type(result) == list else [result])
+        return has_values, has_err
+
+    def reparse(self, build, run, v, v_internals):
+        """
+        Parse again the archived outputs of the combination run, without running anything
+        :return: The data results and kind results of all its archived runs, or None, None if nothing was archived
+        """
+        archive = OutputArchive(build, self)
+        folder = os.path.join(npf.experiment_path(), self.make_test_folder())
+        runs = archive.load(run, folder, limit=self.options.output_memory)
+        if not runs:
+            return None, None
+        data_results = OrderedDict()
+        all_kind_results = {}
+        v = {**v, **v_internals}
+        try:
+            for i, output, err in runs:
+                with trace.span("parse results", run=i):
+                    self.process_results(i, output, v, {SectionScript.TYPE_SCRIPT, SectionScript.TYPE_EXIT},
+                                         data_results, all_kind_results)
+                output.discard()
+                err.discard()
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        return data_results, all_kind_results
+
     def ensure_time(self, event_t, result_type, update):
         if event_t in update:
             if result_type in update[event_t]:
@@ -1013,11 +1232,14 @@ class Test:
             update[event_t][result_type] = []
 
     def do_init_all(self, build, options, do_test, allowed_types=SectionScript.ALL_TYPES_SET, test_folder=None,
-                    v_internals={}):
-        if not build.build(options.force_build, options.no_build, options.quiet_build, options.show_build_cmd):
-            raise ScriptInitException()
-        if not self.build_deps([build.repo], v_internals=v_internals, no_build=options.no_build):
-            raise ScriptInitException()
+                    v_internals={}, do_build=True):
+        if do_build:
+            with trace.span("build", version=build.version):
+                if not build.build(options.force_build, options.no_build, options.quiet_build, options.show_build_cmd,
+                                   checkout_only=not self.needs_local_build(build.repo, under_test=True)):
+                    raise ScriptInitException()
+                if not self.build_deps([build.repo], v_internals=v_internals, no_build=options.no_build):
+                    raise ScriptInitException()
 
         if (allowed_types is None or "init" in allowed_types) and options.do_init:
             if not options.quiet:
@@ -1027,20 +1249,18 @@ class Test:
                 vs[k] = v.makeValues()[0]
             for late_variables in self.get_late_variables():
                 vs.update(late_variables.execute(vs, self, fail=False))
-            data_results, all_kind_results, output, err, num_exec, num_err = self.execute(build, Run(vs), v=vs, n_runs=1,
-                                                                                      n_retry=0,
-                                                                                      allowed_types={"init"},
-                                                                                      do_imports=True,
-                                                                                      test_folder=test_folder,
-                                                                                      v_internals=v_internals)
+            with trace.span("init scripts"):
+                data_results, all_kind_results, output, err, num_exec, num_err = self.execute(
+                    build, Run(vs), v=vs, n_runs=1, n_retry=0, allowed_types={"init"}, do_imports=True,
+                    test_folder=test_folder, v_internals=v_internals)
 
             if num_err > 0:
                 if not options.quiet:
                     print("Aborting as init scripts did not run correctly !")
                     print("Stdout:")
-                    print("\n".join(output))
+                    print("\n".join(str(o) for o in output))
                     print("Stderr:")
-                    print("\n".join(err))
+                    print("\n".join(str(e) for e in err))
                 raise ScriptInitException()
 
     def execute_all(self, build, options, prev_results: Dataset = None, do_test=True, on_finish=None,
@@ -1071,24 +1291,212 @@ class Test:
         if not SectionScript.TYPE_SCRIPT in allowed_types:
             # If scripts is not in allowed_types, we have to run the init by force now
 
-            self.do_init_all(build, options, do_test=do_test, allowed_types=allowed_types, v_internals=v_internals)
+            self.do_init_all(build, options, do_test=do_test, allowed_types=allowed_types, test_folder=test_folder,
+                             v_internals=v_internals)
             if not self.options.preserve_temp:
                 shutil.rmtree(test_folder)
             return {}, True
 
         all_data_results = OrderedDict()
         all_kind_results = OrderedDict()
+
+        # The wall time of the runs is recorded to estimate the next ones, with --dry-run nothing is run at all
+        times = RunTimes(build, self)
+        dry_run = options.dry_run or options.estimate
+        planned = [0, 0, 0.]  # Combinations, runs and estimated time of a dry run
+        campaign = [0., 0., 0]  # Wall time, estimated time and number of the runs done by this campaign
+        campaign_lock = threading.Lock()
+
+        def record(run, variables, seconds, n_runs):
+            """Record that n_runs runs of a combination took seconds"""
+            cost = self.run_cost(variables)
+            estimate = times.estimate(run, cost) * n_runs
+            times.add(run, seconds, n_runs, cost)
+            with campaign_lock:
+                campaign[0] += seconds
+                campaign[1] += estimate
+                campaign[2] += n_runs
+
+        def clock(run, variables, print_header, record_run):
+            """
+            Measure each run of a combination : a run lasts until the next one starts, and the last one until execute()
+            returns, so the first one includes the creation of the files and the last one the cleanup
+            :return: The before_test callback of execute() and the function to call once it returned
+            """
+            last = [time.time()]
+
+            def before_test(i, i_try):
+                now = time.time()
+                if i > 0 or i_try > 0:
+                    # A try that is retried does not count as a run, but its time does
+                    record_run(run, variables, now - last[0], 0 if i_try > 0 else 1)
+                last[0] = now
+                print_header(i, i_try)
+
+            def done():
+                record_run(run, variables, time.time() - last[0], 1)
+            return before_test, done
+
+        def eta(run, variables, i, n_runs, n, n_tests, runs_per_test):
+            """Time left when the run i of n_runs of the n-th combination starts. The estimates of the history are
+            corrected by how far they were from the runs done so far"""
+            with campaign_lock:
+                ratio = campaign[0] / campaign[1] if campaign[1] else 1
+                mean = campaign[0] / campaign[2] if campaign[2] else None
+            current = times.estimate(run, self.run_cost(variables)) * ratio
+            if mean is None:
+                mean = current
+            left = (n_runs - i) * current + (n_tests - n) * runs_per_test * mean
+            return left / (len(npf.slots) if scheduler else 1)
+
+        # With multiple equivalent testbeds, each one has its own test folder and runs one combination at a time
+        scheduler = None
+        if len(npf.slots) > 1 and do_test:
+            scheduler = SlotScheduler(npf.slots)
+            slot_folders = []
+            slot_internals = []
+            for slot in npf.slots:
+                slot_folder = self.make_test_folder()
+                slot_folders.append(slot_folder)
+                slot_internals.append({})
+                self.update_constants(slot_internals[-1], build, npf.from_experiment_path(slot_folder) + os.sep, out_path)
+
         # If one first, we first ensure 1 result per variables then n_runs
         if options.onefirst:
             total_runs = [1, self.config["n_runs"]]
         else:
             total_runs = [self.config["n_runs"]]
 
+        def collect(run, run_results, kind_results, new_data_results, new_all_kind_results):
+            """Merge the new results of a run, feed them to the expander and save them"""
+            nonlocal prev_results, prev_kind_results
+            have_new_results = False
+            if new_data_results:
+                for result_type, values in new_data_results.items():
+                    if values is None:
+                        continue
+                    if options.force_retest:
+                        run_results[result_type] = values
+                    else:
+                        if result_type in run_results and run_results[result_type] is not None:
+                            run_results[result_type].extend(values)
+                        else:
+                            run_results[result_type] = values
+
+                    have_new_results = True
+            if new_all_kind_results:
+                have_new_results = True
+
+            if len(run_results) > 0:
+                if not self.options.quiet:
+                    if scheduler:
+                        print(run.format_variables(self.config["var_hide"]), end=' : ')
+                    if len(run_results) == 1:
+                        print(list(run_results.values())[0])
+                    else:
+                        print(", ".join(['{0}: {1}'.format(k, run_results[k]) for k in sorted(run_results)]))
+
+                all_data_results[run] = run_results
+            else:
+                all_data_results[run] = {}
+            all_variables.tell(run.variables, run_results)
+
+            if have_new_results and sum([len(r) for kind,r in new_all_kind_results.items()]) > 0:
+                for kind, kresults in new_all_kind_results.items():
+                  kind_results.setdefault(kind, OrderedDict())
+                  for time, results in sorted(kresults.items()):
+                    time_run = Run(run.variables.copy())
+                    time_run.variables[kind] = time
+                    for result_type, result in results.items():
+                        rt = kind_results[kind].setdefault(time_run, {}).setdefault(result_type, [])
+                        if options.force_retest:
+                            rt.clear()
+                        rt.extend(result)
+            for kind, kresults in kind_results.items():
+              all_kind_results.setdefault(kind, OrderedDict())
+              for result_type, result in kresults.items():
+                all_kind_results[kind][result_type] = result
+
+            if self.options.print_time_results:
+                for kind, kresults in all_kind_results.items():
+                    print("%s:" % kind)
+                    print(kresults)
+
+            if on_finish and have_new_results:
+                def call_finish():
+                    on_finish(all_data_results, all_kind_results)
+
+                thread = threading.Thread(target=call_finish, args=())
+                thread.daemon = True
+                thread.start()
+
+            # Save results
+            if all_data_results and have_new_results:
+                with trace.span("write results"):
+                    if prev_results or prev_kind_results:
+                        if all_data_results[run]:
+                            if prev_results is None:
+                                prev_results = {}
+                            prev_results[run] = all_data_results[run]
+                        build.writeversion(self, prev_results, allow_overwrite=True)
+                        for kind, kr in kind_results.items():
+                            prev_kind_results.setdefault(kind,OrderedDict())
+                            prev_kind_results[kind].update(kind_results[kind])
+                        build.writeversion(self, prev_kind_results, allow_overwrite=True, kind=True, reload=False)
+                    else:
+                        build.writeversion(self, all_data_results, allow_overwrite=True)
+                        build.writeversion(self, all_kind_results, allow_overwrite=True, kind=True)
+                    times.write()
+
+        def collect_slot(key, outcome):
+            if isinstance(outcome, Exception):
+                scheduler.terminate()
+                raise outcome
+            # The runs are measured in the process of the slot, and recorded here
+            for measure in outcome[2]:
+                record(*measure)
+            collect(*key, *outcome[:2])
+
+        def launch(run, variables, n_runs, run_results, kind_results, print_header, setup=None):
+            if isinstance(setup, Future):
+                setup = setup.result()
+            before_test, done = clock(run, variables, print_header, record)
+            new_data_results, new_all_kind_results, output, err, n_exec, n_err = self.execute(build, run, variables,
+                                                                                          n_runs,
+                                                                                          n_retry=self.config[
+                                                                                              "n_retry"],
+                                                                                          allowed_types={
+                                                                                              SectionScript.TYPE_SCRIPT, SectionScript.TYPE_EXIT},
+                                                                                          test_folder=test_folder,
+                                                                                          v_internals=v_internals, before_test = before_test,
+                                                                                          setup=setup)
+            done()
+            collect(run, run_results, kind_results, new_data_results, new_all_kind_results)
+
+        constants = {}
+
+        def prepare_ahead(variables):
+            with trace.span("prepare ahead"):
+                setup = self.prepare(build, variables,
+                                     allowed_types={SectionScript.TYPE_SCRIPT, SectionScript.TYPE_EXIT},
+                                     test_folder=test_folder, v_internals=v_internals, constants=constants)
+                self.stage_files(setup, test_folder)
+            return setup
+
+        # With --setup-ahead, a combination is prepared in the background as soon as it is known to need runs, and
+        # runs once the previous one is finished. It does not apply when the next combination depends on the results.
+        ahead = ThreadPoolExecutor(max_workers=1) if options.setup_ahead and not scheduler and do_test else None
+
         for runs_this_pass in total_runs:  # Number of results to ensure for this run
             n = 0
             overriden = set(build.repo.overriden_variables.keys())
-            all_variables = list(self.variables.expand(method=options.expand, overriden=overriden))
+            all_variables = self.variables.expand(method=options.expand, overriden=overriden, options=options,
+                                                  cost=self.run_cost)
+            if prev_results and not (options.force_test or options.force_retest):
+                for prev_run, results in prev_results.items():
+                    all_variables.tell(prev_run.variables, results)
             n_tests = len(all_variables)
+            pending = None  # The arguments of launch() for the combination prepared in the background
             for root_variables in all_variables:
                 n += 1
 
@@ -1118,7 +1526,9 @@ class Test:
                     for late_variables in imp.test.get_late_variables():
                         variables.update(late_variables.execute({**variables, **v_internals}, imp.test))
 
-                r_status, r_out, r_err = self.test_require(variables, build)
+                # The requirements were met by the combinations whose outputs are archived
+                r_status, r_out, r_err = self.test_require(variables, build) if not (options.reparse or dry_run) \
+                    else (True, '', '')
                 if not r_status:
                     if not self.options.quiet:
                         print("Requirement not met for %s" % run.format_variables(self.config["var_hide"]))
@@ -1127,6 +1537,7 @@ class Test:
                         if r_err.strip():
                             print(r_err.strip())
 
+                    all_variables.tell(run.variables, {})
                     continue
 
                 if prev_results and prev_results is not None and not (options.force_test or options.force_retest):
@@ -1192,8 +1603,6 @@ class Test:
                                 prev_kind_results = {}
 
 
-                have_new_results = False
-
                 #Compute the minimal number of existing results, so we know how much runs we must do
                 l=[]
                 dall=True
@@ -1219,10 +1628,46 @@ class Test:
 
                 n_runs = runs_this_pass - (
                     0 if (options.force_test or options.force_retest) or len(run_results) == 0 else n_existing_results)
+                if options.reparse:
+                    if pending:
+                        launch(*pending)
+                        pending = None
+                    if not self.options.quiet:
+                        print(run.format_variables(self.config["var_hide"]))
+                    new_data_results, new_all_kind_results = self.reparse(build, run, variables, v_internals)
+                    if new_data_results is None:
+                        if not self.options.quiet:
+                            print("No archived output, keeping the previous results")
+                        collect(run, run_results, kind_results, None, None)
+                        continue
+                    # The results of the combination are replaced by the ones parsed again
+                    run_results = {}
+                    kind_results = {kind: OrderedDict() for kind in kind_results}
+                    collect(run, run_results, kind_results, new_data_results, new_all_kind_results)
+                    continue
+                if dry_run:
+                    if n_runs > 0:
+                        estimate = times.estimate(run, self.run_cost(variables)) * n_runs
+                        planned[0] += 1
+                        planned[1] += n_runs
+                        planned[2] += estimate
+                        print("%s : %d run%s%s" % (run.format_variables(self.config["var_hide"]), n_runs,
+                                                   's' if n_runs > 1 else '',
+                                                   (", %s" % format_duration(estimate)) if options.estimate else ''))
+                    all_data_results[run] = run_results
+                    all_variables.tell(run.variables, run_results)
+                    continue
                 if n_runs > 0 and do_test:
+                    archive = OutputArchive.get(build, self, self.options)
+                    if (options.force_test or options.force_retest) and archive:
+                        archive.clear(run)
                     if not init_done:
-                        self.do_init_all(build, options, do_test, allowed_types=allowed_types, test_folder=test_folder,
-                                         v_internals=v_internals)
+                        # With slots, the init scripts run on each slot before its first run
+                        start = time.time()
+                        self.do_init_all(build, options, do_test, allowed_types=set() if scheduler else allowed_types,
+                                         test_folder=test_folder, v_internals=v_internals)
+                        if not scheduler and options.do_init:
+                            times.init = time.time() - start
                         init_done = True
 
                     def print_header(i, i_try):
@@ -1232,104 +1677,91 @@ class Test:
                             if not dall:
                                 print("Results %s are missing some points..." % ", ".join(l))
                         if n_tests > 0:
-                            def print_header(i, i_try):
+                            def print_header(i, i_try, run=run, n=n, n_runs=n_runs, variables=variables,
+                                             runs_per_test=runs_this_pass):
                                 n_try=int(self.config["n_retry"])
                                 desc = run.format_variables(self.config["var_hide"])
                                 if desc:
                                     print(desc, end=' ')
+                                # The ETA is only shown on a terminal, so outputs compared with the expected ones do not change
+                                left = eta(run, variables, i, n_runs, n, n_tests, runs_per_test) if sys.stdout.isatty() else 0
                                 print(
-                                  ("[%srun %d/%d for test %d/%d"+(" of serie %d/%d" %(iserie+1,nseries) if nseries > 1 else "")+"]") % (  ("retrying %d/%d " % (i_try + 1,n_try)) if i_try > 0 else "", i+1, n_runs, n, n_tests))
-
-                    new_data_results, new_all_kind_results, output, err, n_exec, n_err = self.execute(build, run, variables,
-                                                                                                  n_runs,
-                                                                                                  n_retry=self.config[
-                                                                                                      "n_retry"],
-                                                                                                  allowed_types={
-                                                                                                      SectionScript.TYPE_SCRIPT, SectionScript.TYPE_EXIT},
-                                                                                                  test_folder=test_folder,
-                                                                                                  v_internals=v_internals, before_test = print_header)
-                    if new_data_results:
-                        for result_type, values in new_data_results.items():
-                            if values is None:
-                                continue
-                            if options.force_retest:
-                                run_results[result_type] = values
-                            else:
-                                if result_type in run_results and run_results[result_type] is not None:
-                                    run_results[result_type].extend(values)
-                                else:
-                                    run_results[result_type] = values
+                                  ("[%srun %d/%d for test %d/%d"+(" of serie %d/%d" %(iserie+1,nseries) if nseries > 1 else "")+"]") % (  ("retrying %d/%d " % (i_try + 1,n_try)) if i_try > 0 else "", i+1, n_runs, n, n_tests)
+                                  + ((" ETA %s" % format_duration(left)) if left else ""))
+
+                    if scheduler:
+                        def job(slot, first):
+                            if first:
+                                self.do_init_all(build, options, do_test, allowed_types=allowed_types, test_folder=slot_folders[slot],
+                                                 v_internals=slot_internals[slot], do_build=False)
+                            measures = []
+                            before_test, done = clock(run, variables, print_header,
+                                                      lambda *measure: measures.append(measure))
+                            outcome = self.execute(build, run, variables, n_runs, n_retry=self.config["n_retry"],
+                                                   allowed_types={SectionScript.TYPE_SCRIPT, SectionScript.TYPE_EXIT},
+                                                   test_folder=slot_folders[slot], v_internals=slot_internals[slot],
+                                                   before_test=before_test)[:2]
+                            done()
+                            return outcome + (measures,)
+
+                        done = scheduler.submit((run, run_results, kind_results), job)
+                        if all_variables.adaptive:
+                            # The next combination depends on the results of this one, that must be told to the
+                            # expander before it is asked for the next
+                            done.extend(scheduler.drain())
+                        for key, outcome in done:
+                            collect_slot(key, outcome)
+                        continue
 
-                            have_new_results = True
-                    if new_all_kind_results:
-                        have_new_results = True
+                    if ahead and not all_variables.adaptive:
+                        if constants:
+                            setup = ahead.submit(prepare_ahead, variables)
+                        else:
+                            # The first one fills the constants of the nodes, seen from the test folder like execute()
+                            save_path = os.getcwd()
+                            os.chdir(npf.experiment_path() + os.sep + test_folder)
+                            try:
+                                setup = prepare_ahead(variables)
+                            finally:
+                                os.chdir(save_path)
+                        if pending:
+                            launch(*pending)
+                        pending = (run, variables, n_runs, run_results, kind_results, print_header, setup)
+                        continue
+                    launch(run, variables, n_runs, run_results, kind_results, print_header)
                 else:
+                    if pending:
+                        launch(*pending)
+                        pending = None
                     if not self.options.quiet:
                         print(run.format_variables(self.config["var_hide"]))
+                    collect(run, run_results, kind_results, None, None)
 
-                if len(run_results) > 0:
-                    if not self.options.quiet:
-                        if len(run_results) == 1:
-                            print(list(run_results.values())[0])
-                        else:
-                            print(", ".join(['{0}: {1}'.format(k, run_results[k]) for k in sorted(run_results)]))
+            if pending:
+                launch(*pending)
+            if scheduler:
+                for key, outcome in scheduler.drain():
+                    collect_slot(key, outcome)
+        if ahead:
+            ahead.shutdown()
 
-                    all_data_results[run] = run_results
-                else:
-                    all_data_results[run] = {}
-
-                if have_new_results and sum([len(r) for kind,r in new_all_kind_results.items()]) > 0:
-                    for kind, kresults in new_all_kind_results.items():
-                      kind_results.setdefault(kind, OrderedDict())
-                      for time, results in sorted(kresults.items()):
-                        time_run = Run(run.variables.copy())
-                        time_run.variables[kind] = time
-                        for result_type, result in results.items():
-                            rt = kind_results[kind].setdefault(time_run, {}).setdefault(result_type, [])
-                            if options.force_retest:
-                                rt.clear()
-                            rt.extend(result)
-                for kind, kresults in kind_results.items():
-                  all_kind_results.setdefault(kind, OrderedDict())
-                  for result_type, result in kresults.items():
-                    all_kind_results[kind][result_type] = result
-
-                if self.options.print_time_results:
-                    for kind, kresults in all_kind_results.items():
-                        print("%s:" % kind)
-                        print(kresults)
-
-                if on_finish and have_new_results:
-                    def call_finish():
-                        on_finish(all_data_results, all_kind_results)
-
-                    thread = threading.Thread(target=call_finish, args=())
-                    thread.daemon = True
-                    thread.start()
-
-                # Save results
-                if all_data_results and have_new_results:
-                    if prev_results or prev_kind_results:
-                        if all_data_results[run]:
-                            if prev_results is None:
-                                prev_results = {}
-                            prev_results[run] = all_data_results[run]
-                        build.writeversion(self, prev_results, allow_overwrite=True)
-                        for kind, kr in kind_results.items():
-                            prev_kind_results.setdefault(kind,OrderedDict())
-                            prev_kind_results[kind].update(kind_results[kind])
-                        build.writeversion(self, prev_kind_results, allow_overwrite=True, kind=True, reload=False)
-                    else:
-                        build.writeversion(self, all_data_results, allow_overwrite=True)
-                        build.writeversion(self, all_kind_results, allow_overwrite=True, kind=True)
+        if dry_run:
+            init = (times.init or 0) if planned[1] and options.do_init else 0
+            print("%d runs of %d combinations to do" % (planned[1], planned[0]) +
+                  ((", estimated to take %s" % format_duration((init + planned[2]) / len(npf.slots)))
+                   if options.estimate else ""))
+
+        if options.expand == "active" and all_data_results:
+            all_variables.write_surface(npf.build_filename(self, build, None, {}, 'csv', suffix='surface'))
 
         if not self.options.preserve_temp:
-            try:
-                shutil.rmtree(npf.experiment_path() + os.sep + test_folder)
-            except PermissionError:
-                pass
-            except OSError:
-                pass
+            for folder in [test_folder] + (slot_folders if scheduler else []):
+                try:
+                    shutil.rmtree(npf.experiment_path() + os.sep + folder)
+                except PermissionError:
+                    pass
+                except OSError:
+                    pass
         else:
             print("Test files have been kept in folder %s" % test_folder)
 
@@ -1344,6 +1776,25 @@ class Test:
             title = self.filename
         return title
 
+    def run_cost(self, variables) -> float:
+        """Estimated cost of running one combination of variables, as given by the run_cost configuration.
+        It may use variables and math expressions, such as $(( $DURATION * 2 ))"""
+        return float(SectionVariable.replace_variables(variables, str(self.config["run_cost"])))
+
+    def max_run_time(self) -> float:
+        """The longest a run can take according to the delays and timeouts of its scripts, 0 if they have none"""
+        longest = 0
+        for script in self.scripts:
+            if script.type != SectionScript.TYPE_SCRIPT:
+                continue
+            timeout = float(script.params.get('timeout', self.config['timeout']))
+            if self.config['timeout'] == -1 or self.config['timeout'] > timeout:
+                timeout = self.config['timeout']
+            if timeout == -1:
+                continue
+            longest = max(longest, script.delay() + timeout)
+        return longest
+
     def reject_outliers(self, data):
         m = self.config["accept_outliers_mult"]
         mean = np.mean(data)
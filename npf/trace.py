@@ -0,0 +1,132 @@
+"""
+Timeline of a campaign, enabled with --trace. The phases of the runs are recorded as spans and the events of the
+scripts as instants, then written in the Chrome trace event format, that chrome://tracing and ui.perfetto.dev open.
+
+Events are appended as JSON lines to a file next to the trace by all the processes of the campaign, including the
+workers of the pool engine, and converted to the final trace when NPF exits. When tracing is disabled, span() only
+returns a context manager doing nothing.
+"""
+import atexit
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+
+_path = None
+_main = None
+_fd = None
+_fd_pid = None
+_lock = threading.Lock()
+# Tracks of the scripts, that do not run in a thread of their own with the async engine
+_tracks = itertools.count(1 << 24)
+_track = contextvars.ContextVar('track', default=None)
+_null = contextlib.nullcontext()
+
+
+def _after_fork():
+    global _lock
+    # The lock may have been held by another thread of the parent
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def enabled() -> bool:
+    return _path is not None
+
+
+def start(path):
+    """Record the events of this process and its children, the trace being written to path at exit"""
+    global _path, _main
+    _path = os.path.abspath(path)
+    _main = os.getpid()
+    if os.path.exists(_path + '.events'):
+        os.unlink(_path + '.events')
+    atexit.register(finish)
+
+
+def _write(event):
+    global _fd, _fd_pid
+    pid = os.getpid()
+    event['pid'] = pid
+    if 'tid' not in event:
+        event['tid'] = _track.get() or threading.get_native_id()
+    line = (json.dumps(event, default=str) + '\n').encode()
+    with _lock:
+        if _fd_pid != pid:
+            # A process forked by the pool engine opens its own descriptor, lines appended at once do not mix
+            _fd = os.open(_path + '.events', os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            _fd_pid = pid
+            name = 'npf' if pid == _main else 'npf worker %d' % pid
+            os.write(_fd, (json.dumps({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                                       'args': {'name': name}}) + '\n').encode())
+        os.write(_fd, line)
+
+
+@contextlib.contextmanager
+def _span(name, cat, args):
+    start = time.time()
+    try:
+        yield
+    finally:
+        _write({'name': name, 'cat': cat, 'ph': 'X', 'ts': start * 1000000, 'dur': (time.time() - start) * 1000000,
+                'args': args})
+
+
+def span(name, cat='npf', **args):
+    """A context manager recording the time spent in it"""
+    if _path is None:
+        return _null
+    return _span(name, cat, args)
+
+
+def instant(name, cat='npf', **args):
+    """Record that something happened now"""
+    if _path is None:
+        return
+    _write({'name': name, 'cat': cat, 'ph': 'i', 's': 't', 'ts': time.time() * 1000000, 'args': args})
+
+
+@contextlib.contextmanager
+def _track_context(name):
+    tid = next(_tracks)
+    _write({'name': 'thread_name', 'ph': 'M', 'tid': tid, 'args': {'name': name}})
+    token = _track.set(tid)
+    try:
+        yield
+    finally:
+        _track.reset(token)
+
+
+def track(name):
+    """A context manager giving the spans and instants recorded in it, by the current thread or asyncio task, a track
+    of their own named name. The scripts of the async engine all run in the same thread."""
+    if _path is None:
+        return _null
+    return _track_context(name)
+
+
+def finish():
+    """Write the trace from the events recorded so far"""
+    global _fd, _fd_pid
+    if _path is None or os.getpid() != _main or not os.path.exists(_path + '.events'):
+        return
+    with _lock:
+        if _fd is not None:
+            os.close(_fd)
+            _fd = None
+            _fd_pid = None
+        events = []
+        with open(_path + '.events') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    pass
+        with open(_path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        os.unlink(_path + '.events')
@@ -4,6 +4,7 @@ from collections import OrderedDict
 import regex
 import random
 from npf import npf
+from npf import design
 from npf.nic import NIC
 from asteval import Interpreter
 import itertools
@@ -231,6 +232,10 @@ class VariableFactory:
                 raise Exception("IF variable without vsection",vsection)
             return IfVariable(name, vsection.replace_all(result.group(1))[0], result.group(2), result.group(3))
 
+        result = regex.match(r"SEARCH[ ]*\([ ]*([^,]+)[ ]*,[ ]*([^,]+)[ ]*,[ ]*(.+?)(?:[ ]*,[ ]*([0-9.]+))?[ ]*\)[ ]*$", valuedata)
+        if result:
+            return SearchVariable(name, result.group(1).strip(), result.group(2).strip(), result.group(3).strip(), result.group(4))
+
         return SimpleVariable(name, valuedata)
 
 
@@ -249,25 +254,45 @@ class Variable:
                      r'[{](?P<varname_in>' + NAME_REGEX + ')[}]|' \
                      r'(?P<varname_sp>' + NAME_REGEX + ')(?=}|[^a-zA-Z0-9_]|$))'
     MATH_REGEX = r'(?P<prefix>\\)?[$][(][(](?P<expr>.*?)[)][)]'
-    ALLOWED_NODE_VARS = 'path|user|addr|tags|nfs|arch|port'
+    ALLOWED_NODE_VARS = 'path|user|addr|tags|nfs|arch|port|agent|relay'
     NICREF_REGEX = r'(?P<role>[a-z0-9]+)[:](:?(?P<nic_idx>[0-9]+)[:](?P<type>' + NIC.TYPES + '+)|(?P<node>'+ALLOWED_NODE_VARS+'|ip|ip6|multi|mode|node))'
     VARIABLE_NICREF_REGEX = r'(?<!\\)[$][{]' + NICREF_REGEX + '[}]'
 
 class ExperimentalDesign:
+    """Values of the experimental design variables, ranges with an empty step such as [0-100#].
+    The design is either read from a CSV file with one row per variable, or generated in-process
+    when --experimental-design names one of the generators of npf.design."""
     matrix = None
     varmap = OrderedDict()
 
+    @classmethod
+    def declare(cls, v:Variable):
+        if v.name not in cls.varmap:
+            cls.varmap[v.name] = len(cls.varmap)
+
     @classmethod
     def getVals(cls, v:Variable):
+        cls.declare(v)
         if cls.matrix is None:
             cls.load()
-        if v.name not in cls.varmap:
-            cls.varmap[v.name] = len(cls.varmap)
+        elif cls.varmap[v.name] >= len(cls.matrix) and cls.is_generated():
+            cls.extend()
         return cls.matrix[cls.varmap[v.name]]
 
+    @staticmethod
+    def is_generated():
+        return sys.modules["npf.npf"].options.experimental_design in design.GENERATORS
+
     @classmethod
     def load(cls):
-        path = npf.find_local(sys.modules["npf.npf"].options.experimental_design)
+        options = sys.modules["npf.npf"].options
+        if cls.is_generated():
+            d = len(cls.varmap)
+            n = options.experimental_design_points if options.experimental_design_points else design.default_points(d)
+            ExperimentalDesign.matrix = design.generate(options.experimental_design, n, d, options.experimental_design_seed).T
+            return
+
+        path = npf.find_local(options.experimental_design)
         assert path is not None
 
         with open(path) as fd:
@@ -278,6 +303,19 @@ class ExperimentalDesign:
 
         # TODO: assert that the number of rows of the matrix is sufficient for all the values of the experimental design variables
 
+    @classmethod
+    def extend(cls):
+        """Add the columns of the variables declared after the design was generated. They come from a design of
+        their own with the same points, so the values the other variables already took do not change."""
+        options = sys.modules["npf.npf"].options
+        known, n = cls.matrix.shape
+        columns = design.generate(options.experimental_design, n, len(cls.varmap) - known,
+                                  options.experimental_design_seed + known).T
+        if columns.shape[1] != n:
+            raise Exception("The %s design of %d points cannot be extended with the variables %s, declared after it "
+                            "was generated" % (options.experimental_design, n, ', '.join(list(cls.varmap)[known:])))
+        ExperimentalDesign.matrix = np.concatenate([cls.matrix, columns])
+
 class CoVariable(Variable):
     def __init__(self, name = "covariable"):
         super().__init__(name)
@@ -502,6 +540,8 @@ class RangeVariable(Variable):
         else:
             self.step = step
         self.force_int = force_int
+        if self.step == "":
+            ExperimentalDesign.declare(self)
 
     def count(self):
         """todo: think"""
@@ -586,3 +626,108 @@ class RandomVariable(Variable):
 
     def is_numeric(self):
         return True
+
+class SearchVariable(Variable):
+    """ Search for the value where a condition on the results stops to be true, such as the
+        highest rate without drops with SEARCH(1, 100, DROPPED == 0, 5). It is an RFC 2544-like binary
+        search : the upper bound is tried first, then the middle of the interval that still contains
+        the flip, until that interval is smaller than the precision. The condition is evaluated with
+        the mean of each result type and the variables of the run. If it uses "baseline", the lower
+        bound is tried first and baseline is the value of the first result type of the condition
+        at that point, eg SEARCH(1, 100, LATENCY < 2*baseline)."""
+    def __init__(self, name, a, b, condition, precision = None):
+        super().__init__(name)
+        if is_integer(a) and is_integer(b):
+            a, b = int(a), int(b)
+        else:
+            a, b = float(a), float(b)
+        self.a = min(a, b)
+        self.b = max(a, b)
+        self.condition = condition
+        if precision:
+            self.precision = get_numeric(precision)
+        else:
+            self.precision = 1 if type(self.a) is int else (self.b - self.a) / 100
+        self.uses_baseline = re.search(r'\bbaseline\b', condition) is not None
+        self.probed = set()
+
+    def makeValues(self):
+        if self.probed:
+            return sorted(self.probed)
+        return [self.a, self.b]
+
+    def count(self):
+        return len(self.makeValues())
+
+    def expected_probes(self):
+        """Number of runs the search will need for one combination of the other variables"""
+        n = int(np.ceil(np.log2(max((self.b - self.a) / self.precision, 1)))) + 1
+        return n + 1 if self.uses_baseline else n
+
+    def format(self):
+        return self.name, dtype(self.a)
+
+    def is_numeric(self):
+        return True
+
+    def evaluate(self, variables, results, baseline=None):
+        """Evaluate the condition for one probe. A probe without results does not pass"""
+        if not results:
+            return False
+        ae = Interpreter()
+        for k, v in variables.items():
+            v = v[1] if type(v) is tuple else v
+            if is_numeric(v):
+                ae.symtable[k] = get_numeric(v)
+        for result_type, result in results.items():
+            if result:
+                ae.symtable[result_type if result_type else 'RESULT'] = np.mean(result)
+        if baseline is not None:
+            ae.symtable['baseline'] = baseline
+        r = ae(self.condition)
+        if ae.error:
+            print("WARNING: condition '%s' of %s could not be evaluated : %s" % (self.condition, self.name, ae.error[0].get_error()[1]))
+            return False
+        return bool(r)
+
+    def _baseline(self, results):
+        for name in re.findall(r'[A-Za-z_][A-Za-z0-9_]*', self.condition):
+            key = '' if name == 'RESULT' else name
+            if results and results.get(key):
+                return np.mean(results[key])
+        return None
+
+    def _middle(self, lo, hi):
+        m = (lo + hi) / 2
+        return int(m) if type(self.a) is int else m
+
+    def search(self):
+        """Generator of the values to probe. The variables and results of each probe must be sent
+        back to get the next value."""
+        passing = None
+        baseline = None
+        if self.uses_baseline:
+            variables, results = yield self.a
+            baseline = self._baseline(results)
+            if not self.evaluate(variables, results, baseline):
+                return
+            passing = self.a
+
+        variables, results = yield self.b
+        if self.evaluate(variables, results, baseline):
+            return
+        lo = self.a
+        hi = self.b
+        while hi - lo > self.precision:
+            mid = self._middle(lo, hi)
+            if mid == lo or mid == hi:
+                break
+            variables, results = yield mid
+            if self.evaluate(variables, results, baseline):
+                lo = passing = mid
+            else:
+                hi = mid
+
+        # The lower bound was never confirmed
+        if passing is None:
+            yield self.a
@@ -10,6 +10,7 @@ supported in comparator.
 import argparse
 
 from npf import npf
+from npf.pipeline import BuildPipeline
 from npf.regression import *
 from pathlib import Path
 
@@ -27,12 +28,23 @@ class Comparator():
          on_finish(self.graphs_series + [(test,build,data_datasets[0])], self.kind_graphs_series + [(test,build,kind_datasets[0])])
 
     def run(self, test_name, options, tags, on_finish=None):
+        pipeline = None
+        if options.build_ahead > 0:
+            # The next repositories are built while the previous ones are tested
+            pipeline = iter(BuildPipeline([repo.get_last_build() for repo in self.repo_list if repo.url], options,
+                                          depth=options.build_ahead))
         for irepo,repo in enumerate(self.repo_list):
             regressor = Regression(repo)
+            last_build = None
+            if pipeline and repo.url:
+                last_build, built = next(pipeline)
+                if not built:
+                    print("Could not build %s, skipping it" % repo.name)
+                    continue
             tests = Test.expand_folder(test_name, options=options, tags=repo.tags + tags)
             tests = npf.override(options, tests)
             for itest,test in enumerate(tests):
-                build, data_dataset, kind_dataset  = regressor.regress_all_tests(tests=[test], options=options, on_finish=lambda b,dd,td: self.build_list(on_finish,test,b,dd,td) if on_finish else None,iserie=irepo,nseries=len(self.repo_list) )
+                build, data_dataset, kind_dataset  = regressor.regress_all_tests(tests=[test], options=options, on_finish=lambda b,dd,td: self.build_list(on_finish,test,b,dd,td) if on_finish else None,iserie=irepo,nseries=len(self.repo_list), build=last_build)
             if len(tests) > 0 and not build is None:
                 build._pretty_name = repo.name
                 self.graphs_series.append((test, build, data_dataset[0]))
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+NPF results merger. Combines the results databases of multiple invocations of NPF, typically the shards of a
+campaign run with --shard i/N on different testbeds, into a single one that npf-run and npf-compare can graph
+as if everything was run at once.
+"""
+import argparse
+import sys
+
+from npf.merge import merge
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NPF results merger')
+    parser.add_argument('sources', metavar='results', type=str, nargs='+',
+                        help='Results folders to merge, such as the results folder of each shard')
+    parser.add_argument('--output', '--result-path', metavar='path', type=str, default='results', dest='output',
+                        help='Results folder to write the merged results to. It may be one of the merged folders. Default is "results"')
+    parser.add_argument('--on-conflict', choices=['error', 'first', 'last', 'append'], default='error', dest='on_conflict',
+                        help='What to do when a run has different results in multiple folders. By default nothing is written, '
+                             'first and last keep the results of the first or last folder given, append keeps all of them')
+    parser.add_argument('--quiet', action='store_true', default=False, help='Do not print merged files')
+    args = parser.parse_args()
+
+    conflicts = merge(args.sources, args.output, on_conflict=args.on_conflict, quiet=args.quiet)
+    if conflicts and args.on_conflict == 'error':
+        print("%d conflicting runs, nothing was written. Use --on-conflict to choose which results to keep." % len(conflicts))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
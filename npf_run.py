@@ -8,6 +8,7 @@ import errno
 import sys
 
 from npf import npf
+from npf.pipeline import BuildPipeline
 from npf.regression import *
 from npf.statistics import Statistics
 from npf.test import Test, ScriptInitException
@@ -179,7 +180,16 @@ def main():
 
     returncode = 0
 
-    for build in reversed(builds):
+    if args.build_ahead > 0 and repo.url:
+        to_test = BuildPipeline(reversed(builds), args, depth=args.build_ahead)
+    else:
+        to_test = ((build, True) for build in reversed(builds))
+
+    for build, built in to_test:
+        if not built:
+            print("Could not build version %s, skipping its tests" % build.version)
+            returncode += 1
+            continue
         if len(builds) > 1 or repo.version:
             if build.version == "local":
                 print("Starting tests")
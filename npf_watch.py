@@ -16,6 +16,7 @@ from email.mime.text import MIMEText
 import sys
 
 from npf import npf
+from npf.pipeline import BuildPipeline
 from npf.regression import *
 from npf.test import Test
 
@@ -105,16 +106,32 @@ class Watcher():
     def run(self,options):
         terminate = False
         while not terminate:
+            changed = []
             for repo, tests in self.repo_list:
                 build = repo.get_last_build(with_results=False,force_fetch=(self.history==1))
                 if repo.last_build.version == build.version:
                     if not options.quiet:
                         print("[%s] Last version is %s, no changes." % (repo.name,build.version))
                     continue
+                changed.append((repo, tests))
+
+            pipeline = None
+            if options.build_ahead > 0:
+                # The next repositories are built while the previous ones are tested
+                pipeline = iter(BuildPipeline([repo.get_last_build(history=self.history) for repo, tests in changed],
+                                              options, depth=options.build_ahead))
+
+            for repo, tests in changed:
+                last_build = None
+                if pipeline:
+                    last_build, built = next(pipeline)
+                    if not built:
+                        self.mail(subject="[%s] Could not compile %s !" % (repo.name, last_build.version), body='')
+                        continue
 
                 regressor = Regression(repo)
 
-                build,datasets,time_datasets = regressor.regress_all_tests(tests=tests, options=options, history = self.history)
+                build,datasets,time_datasets = regressor.regress_all_tests(tests=tests, options=options, history = self.history, build=last_build)
 
                 if (build is None):
                     continue
@@ -42,7 +42,7 @@ setuptools.setup(
     url="https://github.com/tbarbette/npf",
     packages=setuptools.find_packages(),
     package_data={'': ['*.repo', '*.npf']},
-    py_modules=['npf_run','npf_compare','npf_watch'],
+    py_modules=['npf_run','npf_compare','npf_watch','npf_merge'],
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -56,9 +56,11 @@ setuptools.setup(
                   'npf-run=npf_run:main',
                   'npf-compare=npf_compare:main',
                   'npf-watch=npf_watch:main',
+                  'npf-merge=npf_merge:main',
                   'npf-run.py=npf_run:main',
                   'npf-compare.py=npf_compare:main',
                   'npf-watch.py=npf_watch:main',
+                  'npf-merge.py=npf_merge:main',
               ],
           },
 )